@@ -2,24 +2,98 @@
 creates flask server and initializes the data ingestor and task runner
 '''
 from os import environ
+from threading import Thread
 from flask import Flask
 from app.data_ingestor import DataIngestor
 from app.task_runner import ThreadPool
 from app.my_logging import CustomLogging
+from app import json_codec
+
+def load_data(webserver, csv_path, options, progress, background = False):
+    '''
+    reads the data and gives it to the thread pool, when the data is read in the background
+    the post endpoints answer that the server is not ready until this is done
+
+    an error in the background is kept in progress, so the readiness endpoint shows it,
+    otherwise it stops the server from starting; the data read in the foreground is logged
+    by log_ingest() once the logger is set up
+    '''
+    try:
+        data_ingestor = DataIngestor(csv_path, progress=progress, **options)
+    except Exception as error: # pylint: disable=broad-exception-caught
+        if not background:
+            raise
+        progress['error'] = str(error)
+        webserver.my_logger.error("Data ingestion failed: %s", error)
+        return
+
+    webserver.tasks_runner.data_ingestor = data_ingestor
+    webserver.data_ingestor = data_ingestor
+    if background:
+        log_ingest(webserver)
+
+def log_ingest(webserver):
+    '''
+    logs how long the ingestion took and how much memory it needed
+    '''
+    stats = webserver.data_ingestor.ingest_stats
+    webserver.my_logger.info("Data ingested in %.3f seconds with %d workers, peak RSS %d kB "
+    "(workers %d kB), snapshot %s", stats['seconds'], stats['workers'], stats['peak_rss_kb'],
+    stats['workers_peak_rss_kb'], stats['snapshot'])
 
 # if env variables is not set, open server
 if 'NO_SERVER' not in environ:
     webserver = Flask(__name__)
-    webserver.tasks_runner = ThreadPool()
 
-    webserver.tasks_runner.start()
+    # jsonify and request.json use orjson when it is installed, the json module writes the
+    # characters that are not ascii in utf-8 too, like the pre-encoded responses
+    if json_codec.orjson is not None:
+        webserver.json = json_codec.FastJSONProvider(webserver)
+    else:
+        webserver.json.ensure_ascii = json_codec.ENSURE_ASCII
 
+    # the numpy backed columnar store is used only if DI_COLUMNAR is set, otherwise the
+    # csv is parsed by DI_WORKERS processes
+    # if DI_SNAPSHOT is set, the parsed data is loaded from the snapshot file it names when
+    # the csv did not change since the snapshot was written
+    ingest_options = {
+        'columnar': 'DI_COLUMNAR' in environ,
+        'num_workers': int(environ.get('DI_WORKERS', 1)),
+        'snapshot': environ.get('DI_SNAPSHOT')
+    }
 
-    webserver.data_ingestor = DataIngestor("./nutrition_activity_obesity_usa_subset.csv")
+    # the csv file the data is read from, DI_CSV can give another one
+    csv_path = environ.get('DI_CSV', "./nutrition_activity_obesity_usa_subset.csv")
 
-    webserver.job_counter = 1
+    # the rows and bytes read so far, shown by the /api/ready endpoint
+    webserver.ingest_progress = {'rows': 0, 'bytes': 0, 'total_bytes': 0, 'error': None}
 
-    # make the logger an attribute of the webserver instance for easy access
+    # the data ingestor is None until the data is read
+    webserver.data_ingestor = None
+    webserver.tasks_runner = ThreadPool()
+
+    # the worker processes of the parallel ingestion (DI_WORKERS > 1) are forked, so they
+    # are started before any thread, the logging listener included: a lock held by another
+    # thread at the time of the fork would stay locked in the workers
+    forks = ingest_options['num_workers'] > 1 and not ingest_options['columnar']
+
+    # with DI_BACKGROUND the server starts right away and the data is read by a background
+    # thread, unless reading it forks worker processes
+    background = 'DI_BACKGROUND' in environ and not forks
+    if not background:
+        load_data(webserver, csv_path, ingest_options, webserver.ingest_progress)
+
+    # make the logger an attribute of the webserver instance for easy access, its listener
+    # thread is the first thread started
     webserver.my_logger = CustomLogging().get_logger()
+    webserver.my_logger.info("Using the %s json backend", json_codec.BACKEND)
+
+    if background:
+        Thread(target=load_data, args=(webserver, csv_path, ingest_options,
+               webserver.ingest_progress, True), daemon=True).start()
+    else:
+        log_ingest(webserver)
+
+    webserver.tasks_runner.start()
 
     from app import routes
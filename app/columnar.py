@@ -0,0 +1,208 @@
+'''
+columnar.py
+'''
+from array import array
+
+try:
+    import numpy as np
+except ImportError:
+    # numpy is optional, the columnar store can only be used when it is installed
+    np = None
+
+# indexes of the code columns
+STATE_COL = 0
+QUESTION_COL = 1
+STRATCAT_COL = 2
+STRAT_COL = 3
+
+def code_dtype(size):
+    '''
+    returns the smallest unsigned integer type that can hold the codes of a table
+    with size entries
+    '''
+    return np.min_scalar_type(max(size - 1, 0))
+
+class ColumnarStore:
+    '''
+    class that keeps the csv data in columns: a float64 array for the data values and a small
+    integer code column for the state, question, stratification category and stratification
+
+    the tables decode the codes back to strings (the code is the index in the table)
+
+    the rows are sorted by question, then by state and then by the order in which each
+    (stratification category, stratification) pair was first seen for the state and question,
+    which is the order the dictionary based state_data keeps the values in, so the grouped
+    reductions add up the values in the same order as the dict based path
+    '''
+    def __init__(self, values, codes, tables):
+        '''
+        values is the float64 array of data values, codes is a tuple of the four code columns
+        and tables is a tuple of the four lists of strings decoding them
+        '''
+        self.values = values
+        self.codes = codes
+        self.tables = tables
+        self.states, self.questions, self.stratcats, self.strats = tables
+
+        # reverse lookup tables from string to code
+        self.state_index = {state: code for code, state in enumerate(self.states)}
+        self.question_index = {question: code for code, question in enumerate(self.questions)}
+
+        # the rows are sorted by question so the rows of every question are a contiguous slice
+        question_codes = np.arange(len(self.questions))
+        starts = np.searchsorted(codes[QUESTION_COL], question_codes, side='left')
+        stops = np.searchsorted(codes[QUESTION_COL], question_codes, side='right')
+        self.question_slices = {
+            question: slice(int(starts[code]), int(stops[code]))
+            for code, question in enumerate(self.questions)
+        }
+
+    @classmethod
+    def from_rows(cls, rows):
+        '''
+        builds the store from an iterable of (state, question, data_value, stratification
+        category, stratification) rows
+
+        the rows are appended to compact arrays while reading, so no python object is kept
+        per data value, and are sorted only once at the end
+        '''
+        if np is None:
+            raise ImportError("numpy is required for the columnar store")
+
+        tables = ([], [], [], [])
+        indexes = ({}, {}, {}, {})
+        codes = tuple(array('I') for _ in tables)
+        values = array('d')
+
+        # id of every (state, question, stratification category, stratification) group
+        # given in the order the groups are first seen
+        groups = {}
+        group_codes = array('I')
+
+        for state, question, data_value, stratcat, strat in rows:
+            row = (state, question, stratcat, strat)
+            for col, key in enumerate(row):
+                code = indexes[col].get(key)
+                if code is None:
+                    code = indexes[col][key] = len(tables[col])
+                    tables[col].append(key)
+                codes[col].append(code)
+
+            group_codes.append(groups.setdefault(row, len(groups)))
+            values.append(float(data_value))
+
+        # stable sort by question, state and group so the values of a group keep the csv order
+        order = np.lexsort((
+            np.frombuffer(group_codes, dtype=np.uint32),
+            np.frombuffer(codes[STATE_COL], dtype=np.uint32),
+            np.frombuffer(codes[QUESTION_COL], dtype=np.uint32)
+        ))
+
+        columns = tuple(
+            np.frombuffer(column, dtype=np.uint32)[order].astype(code_dtype(len(table)))
+            for column, table in zip(codes, tables)
+        )
+
+        return cls(np.frombuffer(values, dtype=np.float64)[order], columns, tables)
+
+    def dump(self, file):
+        '''
+        writes the value column and the code columns one after the other to a binary file
+        and returns the layout needed to map them back: a (dtype, offset, length) tuple
+        for every column
+        '''
+        layout = []
+        for column in (self.values,) + tuple(self.codes):
+            layout.append((column.dtype.str, file.tell(), len(column)))
+            file.write(column.tobytes())
+        return layout
+
+    @classmethod
+    def map(cls, path, layout, tables):
+        '''
+        builds a store over the columns written by dump() without reading them: the file is
+        memory mapped read only, so all the processes that map it share the same pages
+        '''
+        columns = [
+            np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=(length,))
+            if length else np.empty(0, dtype=dtype)
+            for dtype, offset, length in layout
+        ]
+        return cls(columns[0], tuple(columns[1:]), tables)
+
+    def __len__(self):
+        '''
+        number of rows in the store
+        '''
+        return len(self.values)
+
+    def rows_for(self, question, state=None):
+        '''
+        returns the slice of rows for the question and, if given, the state or None
+        when the question or state is unknown
+
+        the states are contiguous inside the rows of a question, so the result is a slice too
+        '''
+        rows = self.question_slices.get(question)
+        if rows is None or state is None:
+            return rows
+
+        code = self.state_index.get(state)
+        if code is None:
+            return None
+
+        states = self.codes[STATE_COL][rows]
+        start = int(np.searchsorted(states, code, side='left'))
+        stop = int(np.searchsorted(states, code, side='right'))
+        return slice(rows.start + start, rows.start + stop)
+
+    def reduce(self, groups, rows, size):
+        '''
+        grouped reduction of the values in rows, groups gives the group of every row
+
+        returns the sums, counts, minimums and maximums of the values of every group; bincount
+        adds up the values one after the other, like sum() over a list
+        '''
+        values = self.values[rows]
+        sums = np.bincount(groups, weights=values, minlength=size)
+        counts = np.bincount(groups, minlength=size)
+        minimums = np.full(size, np.inf)
+        np.minimum.at(minimums, groups, values)
+        maximums = np.full(size, -np.inf)
+        np.maximum.at(maximums, groups, values)
+        return sums, counts, minimums, maximums
+
+    @staticmethod
+    def group_totals(reduced, group):
+        '''
+        returns the (sum, count, min, max) tuple of a group from the result of reduce()
+        '''
+        sums, counts, minimums, maximums = reduced
+        return (float(sums[group]), int(counts[group]), float(minimums[group]),
+                float(maximums[group]))
+
+    def totals_by_category(self, rows):
+        '''
+        returns a dictionary from (state, stratification category, stratification) to
+        (sum, count, min, max) of the values in rows, with the groups in the order their
+        first row is in, which is the order the dict based state_data keeps them in, so the
+        partials are merged in the same order in both modes
+        '''
+        num_stratcats = len(self.stratcats)
+        num_strats = len(self.strats)
+
+        # combine the three code columns in a single group key
+        keys = (self.codes[STATE_COL][rows].astype(np.int64) * num_stratcats
+                + self.codes[STRATCAT_COL][rows]) * num_strats + self.codes[STRAT_COL][rows]
+        groups, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+        reduced = self.reduce(inverse, rows, len(groups))
+
+        totals = {}
+        # np.unique sorts the groups by key, they are put back in the order of their first row
+        for group in np.argsort(first, kind='stable').tolist():
+            key = int(groups[group])
+            key, strat = divmod(key, num_strats)
+            state, stratcat = divmod(key, num_stratcats)
+            totals[(self.states[state], self.stratcats[stratcat], self.strats[strat])] = \
+                self.group_totals(reduced, group)
+        return totals
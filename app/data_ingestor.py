@@ -1,7 +1,16 @@
 '''
 data_ingestor.py
 '''
+from ast import literal_eval
+from copy import copy
 from csv import DictReader
+from os import path
+from resource import getrusage, RUSAGE_SELF, RUSAGE_CHILDREN
+from time import perf_counter
+from app.columnar import ColumnarStore
+from app.parallel_ingest import read_state_data
+from app.snapshot import source_key, read_snapshot, write_snapshot
+from app.operations import Partial, aggregate
 
 # constants for dictionary keys
 STATE = 'LocationDesc'
@@ -10,11 +19,54 @@ DATA_VALUE = 'Data_Value'
 STRATIF1 = 'Stratification1'
 STRATIFCAT1 = 'StratificationCategory1'
 
+def read_lines(file, progress):
+    '''
+    generator that decodes the lines of a binary file and counts the bytes read in progress
+    '''
+    for line in file:
+        progress['bytes'] += len(line)
+        yield line.decode('utf-8')
+
+def read_rows(csv_path, progress = None):
+    '''
+    generator that reads the csv file line by line and yields only the columns we need as a
+    (state, question, data value, stratification category 1, stratification 1) tuple
+
+    if progress is a dictionary, its rows and bytes counters are updated while reading
+    '''
+    if progress is None:
+        progress = {'rows': 0, 'bytes': 0}
+
+    with open(csv_path, 'rb') as file:
+        yield from parse_rows(read_lines(file, progress), progress)
+
+def parse_rows(lines, progress = None):
+    '''
+    generator that parses csv lines, the first one being the header, and yields the
+    tuples of read_rows()
+
+    raises ValueError if the header misses one of the columns we need, no header (no lines)
+    gives no rows
+    '''
+    reader = DictReader(lines)
+    if reader.fieldnames is not None:
+        missing = [column for column in (STATE, QUESTION, DATA_VALUE, STRATIFCAT1, STRATIF1)
+                   if column not in reader.fieldnames]
+        if missing:
+            raise ValueError(f"missing columns {', '.join(missing)}")
+
+    for line in reader:
+        if progress is not None:
+            progress['rows'] += 1
+        yield (line[STATE], line[QUESTION], line[DATA_VALUE], line[STRATIFCAT1],
+               line[STRATIF1])
+
 class DataIngestor:
     '''
     class that reads from csv file
     '''
-    def __init__(self, csv_path: str):
+    def __init__(self, csv_path: str, columnar: bool = False, store: ColumnarStore = None,
+                 num_workers: int = 1, snapshot: str = None, progress: dict = None):
         '''
             read the csv file line by line so that we do not load the entire file into memory
             at once
@@ -23,18 +75,53 @@ class DataIngestor:
             dictionary of questions, where each question is a key and the value is another
             dictionary where the key is a string tuple of stratification category 1 and
             stratification 1 and the value is a list of data values
+
+            if columnar is True, the rows are kept in a numpy backed ColumnarStore instead
+            and state_data stays empty
+
+            store is an already built ColumnarStore (for example one mapped from a file by a
+            worker process) used instead of reading csv_path
+
+            if num_workers is more than 1, state_data is built by that many worker processes
+            that parse row aligned chunks of the mapped csv file, the result is the same
+
+            snapshot is the path of a binary snapshot of the parsed data and of the indexes:
+            if it was written for the same csv file (same size, modification time and hash)
+            and the same mode, the data is loaded from it (the columns of the columnar store
+            are mapped), otherwise the csv file is read and the snapshot is written again
+
+            progress is a dictionary where the number of rows and bytes read so far and the
+            size of the csv file are kept, so the ingestion can be followed from another thread
         '''
+        start = perf_counter()
         self.state_data = {}
+        self.columnar = store
 
-        with open(csv_path, 'r', encoding='utf-8') as file:
-            reader = DictReader(file)
-            for line in reader:
-                state = line[STATE]
-                question = line[QUESTION]
-                data_value = line[DATA_VALUE]
-                stratcat1 = line[STRATIFCAT1]
-                strat1 = line[STRATIF1]
+        if progress is None:
+            progress = {}
+        progress.update(rows=0, bytes=0,
+                        total_bytes=path.getsize(csv_path) if store is None else 0)
 
+        # the snapshot status reported in ingest_stats: loaded, written or failed
+        snapshot_status = None
+        key = source_key(csv_path) if snapshot is not None and store is None else None
+        saved = read_snapshot(snapshot, key, columnar) if key is not None else None
+
+        if saved is not None:
+            self.state_data = saved['state_data']
+            self.columnar = saved['store']
+            snapshot_status = 'loaded'
+        elif store is not None:
+            columnar = True
+        elif columnar:
+            self.columnar = ColumnarStore.from_rows(read_rows(csv_path, progress))
+        elif num_workers > 1:
+            self.state_data = read_state_data(csv_path, [STATE, QUESTION, DATA_VALUE,
+                                                         STRATIFCAT1, STRATIF1], num_workers,
+                                              progress)
+        else:
+            for state, question, data_value, stratcat1, strat1 in read_rows(csv_path,
+                                                                               progress):
                 if state not in self.state_data:
                     self.state_data[state] = {}
                 if question not in self.state_data[state]:
@@ -42,7 +129,50 @@ class DataIngestor:
 
                 if str((stratcat1, strat1)) not in self.state_data[state][question]:
                     self.state_data[state][question][str((stratcat1, strat1))] = []
-                self.state_data[state][question][str((stratcat1, strat1))].append(float(data_value))
+                self.state_data[state][question][str((stratcat1, strat1))].append(
+                    float(data_value))
+
+        if saved is not None:
+            self.aggregates = saved['aggregates']
+            self.row_counts = saved['row_counts']
+        else:
+            # the sum, count, min and max of every (state, question, stratification) are
+            # computed once here, so the mean requests do not have to go over all the values
+            self.aggregates = self.build_aggregates()
+
+            # the number of rows of every question, in total and for every state, used to
+            # estimate the cost of the jobs before extracting their data
+            self.row_counts = self.build_row_counts()
+
+            if key is not None:
+                try:
+                    write_snapshot(snapshot, key, self)
+                    snapshot_status = 'written'
+                except OSError:
+                    # the server works without the snapshot, the next start reads the csv
+                    snapshot_status = 'failed'
+
+        # the partial aggregates of the stratifications of every question, with the keys of the
+        # mean_by_category and state_mean_by_category results built once here
+        self.category_index = self.build_category_index(self.row_counts)
+
+        # incremented for every new version of the data made by with_rows()
+        self.version = 0
+
+        # the data loaded from a snapshot is counted as read at the end
+        if saved is not None:
+            progress.update(rows=sum(rows for rows, _ in self.row_counts.values()),
+                            bytes=progress['total_bytes'])
+
+        # how long the ingestion took, the peak resident memory of this process and of
+        # the largest worker process, in kilobytes, and what happened to the snapshot
+        self.ingest_stats = {
+            'seconds': perf_counter() - start,
+            'workers': num_workers if self.columnar is None else 1,
+            'peak_rss_kb': getrusage(RUSAGE_SELF).ru_maxrss,
+            'workers_peak_rss_kb': getrusage(RUSAGE_CHILDREN).ru_maxrss,
+            'snapshot': snapshot_status
+        }
 
         self.questions_best_is_min = [
             'Percent of adults aged 18 years and older who have an overweight classification',
@@ -65,3 +195,152 @@ activity (or an equivalent combination)',
             'Percent of adults who engage in muscle-strengthening activities on 2 or more \
 days a week',
         ]
+
+    def build_aggregates(self):
+        '''
+        builds the aggregate index: a dictionary with the same nesting as state_data (state,
+        question and string tuple of stratification category 1 and stratification 1), where
+        the list of data values is replaced by its Partial aggregate
+        '''
+        if self.columnar is None:
+            return {
+                state: {
+                    question: {key: aggregate(values) for key, values in categories.items()}
+                    for question, categories in questions.items()
+                }
+                for state, questions in self.state_data.items()
+            }
+
+        # the states are added first so they keep the order in which they were seen in the csv
+        store = self.columnar
+        aggregates = {state: {} for state in store.states}
+        for question, rows in store.question_slices.items():
+            for (state, stratcat, strat), totals in store.totals_by_category(rows).items():
+                aggregates[state].setdefault(question, {})[str((stratcat, strat))] = \
+                    Partial(*totals)
+        return aggregates
+
+    def build_category_index(self, questions):
+        '''
+        builds the stratification index of the given questions: a dictionary from question
+        to a (groups, groups_by_state) tuple, where
+        - groups maps the string tuple of the state, stratification category 1 and
+        stratification 1 to the Partial aggregate of the group, only for the groups with a
+        stratification, like the keys of mean_by_category
+        - groups_by_state maps every state to a dictionary from the string tuple of the
+        stratification category 1 and stratification 1 to the Partial aggregate, like the keys
+        of state_mean_by_category
+
+        the keys are sorted, the string tuples of the aggregate index are parsed only once for
+        every distinct stratification, not for every request
+        '''
+        stratifications = {}
+        index = {}
+        for question in questions:
+            groups = {}
+            groups_by_state = {}
+            for state, state_questions in self.aggregates.items():
+                if question not in state_questions:
+                    continue
+                categories = state_questions[question]
+                groups_by_state[state] = dict(sorted(categories.items()))
+                for key, partial in categories.items():
+                    if key not in stratifications:
+                        stratifications[key] = literal_eval(key)
+                    stratcat1, strat1 = stratifications[key]
+                    if stratcat1 != '' and strat1 != '':
+                        groups[str((state, stratcat1, strat1))] = partial
+            index[question] = (dict(sorted(groups.items())), groups_by_state)
+        return index
+
+    def build_row_counts(self):
+        '''
+        builds a dictionary from question to a (total rows, {state: rows}) tuple from the
+        counts of the aggregate index
+        '''
+        row_counts = {}
+        for state, questions in self.aggregates.items():
+            for question, categories in questions.items():
+                rows = sum(partial.count for partial in categories.values())
+                total_rows, rows_by_state = row_counts.get(question, (0, {}))
+                rows_by_state[state] = rows
+                row_counts[question] = (total_rows + rows, rows_by_state)
+        return row_counts
+
+    def with_rows(self, rows):
+        '''
+        returns a new version of the data ingestor with the (state, question, data value,
+        stratification category 1, stratification 1) rows added, this one is not changed,
+        so the jobs that are running with it see the data they started with
+
+        the dictionaries on the path to every new value are copied (copy on write) and the
+        rest is shared with this version: the work grows with the number of new rows and the
+        size of the groups they are added to, not with the size of the data; the partial
+        aggregates of the groups are updated with the new values, not computed again, the
+        values are added in the same order as sum() over the list, so the total is the same
+
+        raises ValueError if there are no rows, if a row misses a field (the csv reader gives
+        None for the fields of a short row), if a data value is not a number or if the data
+        is columnar
+        '''
+        if self.columnar is not None:
+            raise ValueError("rows can be added only to the dictionary data")
+
+        # check and convert all the rows first, so an invalid row does not leave a half
+        # built version
+        checked = []
+        for number, row in enumerate(rows, 1):
+            if None in row:
+                raise ValueError(f"row {number} has missing fields")
+            state, question, data_value, stratcat1, strat1 = row
+            checked.append((state, question, float(data_value), stratcat1, strat1))
+        rows = checked
+        if not rows:
+            raise ValueError("no rows to add")
+
+        new = copy(self)
+        new.version = self.version + 1
+        new.state_data = dict(self.state_data)
+        new.aggregates = dict(self.aggregates)
+        new.row_counts = dict(self.row_counts)
+
+        # the states, (state, question) pairs, groups and row counts already copied
+        states, questions, groups, counts = set(), set(), set(), set()
+        for state, question, data_value, stratcat1, strat1 in rows:
+            key = str((stratcat1, strat1))
+            if state not in states:
+                states.add(state)
+                new.state_data[state] = dict(self.state_data.get(state, {}))
+                new.aggregates[state] = dict(self.aggregates.get(state, {}))
+            if (state, question) not in questions:
+                questions.add((state, question))
+                new.state_data[state][question] = dict(new.state_data[state].get(question, {}))
+                new.aggregates[state][question] = dict(new.aggregates[state].get(question, {}))
+            if (state, question, key) not in groups:
+                groups.add((state, question, key))
+                new.state_data[state][question][key] = list(
+                    new.state_data[state][question].get(key, []))
+            new.state_data[state][question][key].append(data_value)
+
+            # the aggregates of the question were copied above, the Partial is replaced
+            partial = new.aggregates[state][question].get(key)
+            if partial is None:
+                partial = Partial(data_value, 1, data_value, data_value)
+            else:
+                partial = Partial(partial.total + data_value, partial.count + 1,
+                                  min(partial.minimum, data_value),
+                                  max(partial.maximum, data_value))
+            new.aggregates[state][question][key] = partial
+
+            if question not in counts:
+                counts.add(question)
+                total_rows, rows_by_state = new.row_counts.get(question, (0, {}))
+                new.row_counts[question] = (total_rows, dict(rows_by_state))
+            total_rows, rows_by_state = new.row_counts[question]
+            rows_by_state[state] = rows_by_state.get(state, 0) + 1
+            new.row_counts[question] = (total_rows + 1, rows_by_state)
+
+        # the stratification index of the questions that got new values is built again
+        new.category_index = dict(self.category_index)
+        new.category_index.update(new.build_category_index(counts))
+        return new
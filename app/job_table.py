@@ -0,0 +1,251 @@
+'''
+job_table.py
+'''
+from collections import deque
+from threading import Lock, Event
+from time import monotonic
+
+# states of a job
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+# the stages of the life of a job, in the order they happen: the request is received, the
+# job is submitted to the ThreadPool, taken from the queue by a TaskRunner, computed, its
+# result is stored in the job table and written to disk if the results are persisted
+STAGES = ('received', 'submitted', 'dequeued', 'compute_start', 'compute_end', 'stored',
+          'persisted')
+
+class JobTable:
+    '''
+    thread safe table with the state and the result of every job submitted to the ThreadPool,
+    so the status endpoints do not have to look for the result files on disk
+
+    only the last max_finished jobs that are done or failed are kept and the oldest ones are
+    also evicted while the encoded responses take more than max_body_bytes (0 for no limit),
+    the job_ids of the evicted jobs become unknown
+    '''
+    def __init__(self, max_finished = 0, max_body_bytes = 0):
+        '''
+        jobs maps a job_id to a [state, reason, body, timings] list, the reason is the one of
+        the failure for the failed jobs, body is the encoded response of the done jobs, so
+        it is not encoded again every time the result is read (the result itself is not kept),
+        and timings maps the stages the job went through to their monotonic times
+
+        the number of jobs in every state and the size of the encoded responses are kept up
+        to date so they can be read in O(1); the jobs that got the same result share the
+        same body, it is counted once
+        '''
+        self.jobs = {}
+        self.counts = {QUEUED: 0, RUNNING: 0, DONE: 0, FAILED: 0}
+        self.body_bytes = 0
+
+        # maps the id of every body in the table to the number of jobs that have it
+        self.body_refs = {}
+        self.last_job_id = 0
+
+        # no job_id below first_job_id is in the table, it moves up as the jobs are evicted
+        self.first_job_id = 1
+        self.lock = Lock()
+
+        # the job_ids of the finished jobs, in the order they finished, the oldest ones are
+        # evicted first
+        self.max_finished = max_finished
+        self.max_body_bytes = max_body_bytes
+        self.finished = deque()
+        self.evicted = 0
+
+        # completion events of the jobs someone is waiting for, created by wait()
+        self.events = {}
+
+    def set_state(self, job_id, state, reason = None, body = None, timings = None):
+        '''
+        adds the job to the table or moves it to a new state, the given timings are added
+        to the ones of the job and the time the job is done or failed is stored as well
+        '''
+        with self.lock:
+            entry = self.jobs.get(job_id)
+            if entry is None:
+                entry = self.jobs[job_id] = [state, reason, body, {}]
+                self.last_job_id = max(self.last_job_id, job_id)
+            else:
+                self.counts[entry[0]] -= 1
+                self.drop_body(entry[2])
+                entry[0] = state
+                entry[1] = reason
+                entry[2] = body
+            self.counts[state] += 1
+            self.add_body(body)
+
+            # the job that computed the result shares its timings dictionary with the table
+            if timings is not None:
+                if not entry[3]:
+                    entry[3] = timings
+                else:
+                    entry[3].update(timings)
+            if state in (DONE, FAILED):
+                entry[3]['stored'] = monotonic()
+                self.finished.append(job_id)
+                self.evict()
+
+            # wake up the clients waiting for the job
+            if state in (DONE, FAILED) and job_id in self.events:
+                self.events.pop(job_id).set()
+
+    def add_body(self, body):
+        '''
+        counts a job that has the body, its size is added the first time, called while
+        holding the lock
+        '''
+        if body is None:
+            return
+        refs = self.body_refs.get(id(body), 0)
+        if refs == 0:
+            self.body_bytes += len(body)
+        self.body_refs[id(body)] = refs + 1
+
+    def drop_body(self, body):
+        '''
+        stops counting a job that had the body, its size is taken away when no job has it,
+        called while holding the lock
+
+        the table keeps a reference to the body while it is counted, so its id is not reused
+        '''
+        if body is None:
+            return
+        refs = self.body_refs.pop(id(body)) - 1
+        if refs == 0:
+            self.body_bytes -= len(body)
+        else:
+            self.body_refs[id(body)] = refs
+
+    def evict(self):
+        '''
+        removes the oldest finished jobs while there are more than max_finished of them or
+        their bodies take more than max_body_bytes, the last finished job is always kept;
+        called while holding the lock
+        '''
+        while len(self.finished) > 1 and (
+                (self.max_finished and len(self.finished) > self.max_finished) or
+                (self.max_body_bytes and self.body_bytes > self.max_body_bytes)):
+            entry = self.jobs.pop(self.finished.popleft())
+            self.counts[entry[0]] -= 1
+            self.drop_body(entry[2])
+            self.evicted += 1
+
+        # every job_id is passed over once, so this takes O(1) per evicted job on average
+        while self.first_job_id <= self.last_job_id and self.first_job_id not in self.jobs:
+            self.first_job_id += 1
+
+    def add(self, job_id, timings = None):
+        '''
+        adds a queued job, with the dictionary its timings are written to
+        '''
+        self.set_state(job_id, QUEUED, timings=timings)
+
+    def start(self, job_id):
+        '''
+        marks the job as running
+        '''
+        self.set_state(job_id, RUNNING)
+
+    def finish(self, job_id, body, timings = None):
+        '''
+        marks the job as done and stores its encoded response
+        '''
+        self.set_state(job_id, DONE, body=body, timings=timings)
+
+    def fail(self, job_id, reason, timings = None):
+        '''
+        marks the job as failed and stores the reason
+        '''
+        self.set_state(job_id, FAILED, reason, timings=timings)
+
+    def stamp(self, job_id, stage):
+        '''
+        stores the current time as the time the job reached the stage
+        '''
+        with self.lock:
+            entry = self.jobs.get(job_id)
+            if entry is not None:
+                entry[3][stage] = monotonic()
+
+    def timings(self, job_id):
+        '''
+        returns the times of the stages the job went through, in seconds since the first
+        one, or None if there is no such job
+        '''
+        with self.lock:
+            entry = self.jobs.get(job_id)
+            if entry is None:
+                return None
+            stamps = dict(entry[3])
+
+        start = min(stamps.values(), default=0)
+        return {stage: round(stamps[stage] - start, 6) for stage in STAGES if stage in stamps}
+
+    def get(self, job_id):
+        '''
+        returns the (state, data) of the job or (None, None) if there is no such job, data is
+        the encoded response of a done job and the reason of a failed one
+        '''
+        with self.lock:
+            entry = self.jobs.get(job_id)
+            if entry is None:
+                return None, None
+            return entry[0], entry[2] if entry[0] == DONE else entry[1]
+
+    def wait(self, job_id, timeout):
+        '''
+        waits at most timeout seconds for the job to be done or to fail and returns its
+        (state, data) like get()
+        '''
+        with self.lock:
+            entry = self.jobs.get(job_id)
+            if entry is None:
+                return None, None
+            if entry[0] in (DONE, FAILED):
+                return entry[0], entry[2] if entry[0] == DONE else entry[1]
+            event = self.events.setdefault(job_id, Event())
+
+        event.wait(timeout)
+        return self.get(job_id)
+
+    def num_pending(self):
+        '''
+        returns the number of jobs that are queued or running
+        '''
+        with self.lock:
+            return self.counts[QUEUED] + self.counts[RUNNING]
+
+    def page(self, start = 1, limit = None):
+        '''
+        returns a list of (job_id, state) for the jobs with job_id starting at start,
+        at most limit of them or all the rest if limit is None
+
+        the job_ids of the evicted jobs before the oldest job in the table are skipped, so
+        the time taken grows with the size of the page, not with the number of job_ids given
+        '''
+        with self.lock:
+            start = max(start, self.first_job_id)
+            stop = self.last_job_id + 1
+            if limit is not None:
+                stop = min(stop, start + limit)
+            return [(job_id, self.jobs[job_id][0]) for job_id in range(start, stop)
+                    if job_id in self.jobs]
+
+    def stats(self):
+        '''
+        returns the number of jobs in every state, the size of the encoded responses and the
+        number of finished jobs evicted
+        '''
+        with self.lock:
+            return dict(self.counts), self.body_bytes, self.evicted
+
+    def __len__(self):
+        '''
+        number of jobs in the table
+        '''
+        with self.lock:
+            return len(self.jobs)
@@ -0,0 +1,65 @@
+'''
+json_codec.py
+'''
+import json
+from os import environ
+from flask.json.provider import DefaultJSONProvider
+
+# orjson is used when it is installed, unless TP_JSON=stdlib is set
+try:
+    if environ.get('TP_JSON') == 'stdlib':
+        raise ImportError
+    import orjson
+except ImportError:
+    orjson = None
+
+# the name of the json backend, shown in the logs
+BACKEND = 'stdlib' if orjson is None else 'orjson'
+
+# the keys are sorted like jsonify does and the numpy numbers of the columnar store are
+# encoded like floats, as the json module does
+OPTIONS = None if orjson is None else orjson.OPT_SORT_KEYS | orjson.OPT_SERIALIZE_NUMPY
+
+# orjson writes the characters that are not ascii as they are, in utf-8, so the json module
+# does not escape them either (and neither does jsonify, see the app package)
+ENSURE_ASCII = False
+
+def stdlib_dumps(obj):
+    '''
+    encodes obj like dumps() with the json module
+    '''
+    return json.dumps(obj, sort_keys=True, separators=(',', ':'),
+                      ensure_ascii=ENSURE_ASCII).encode('utf-8')
+
+def dumps(obj):
+    '''
+    encodes obj as compact json with sorted keys, like jsonify does, and returns the bytes
+    '''
+    if orjson is not None:
+        return orjson.dumps(obj, option=OPTIONS)
+    return stdlib_dumps(obj)
+
+def encode_response(obj):
+    '''
+    returns the body of the json response for obj, the same bytes jsonify sends (with the
+    new line at the end), so it can be encoded once and sent many times
+    '''
+    return dumps(obj) + b'\n'
+
+class FastJSONProvider(DefaultJSONProvider):
+    '''
+    json provider of the flask app that uses orjson for jsonify and request.json, the
+    responses are the same as with the default provider
+    '''
+    def dumps(self, obj, **kwargs):
+        '''
+        encodes obj with orjson, the values orjson does not know are given to the default
+        function of the default provider
+        '''
+        return orjson.dumps(obj, default=self.default, option=OPTIONS).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        '''
+        decodes json with orjson
+        '''
+        return orjson.loads(s)
@@ -0,0 +1,191 @@
+'''
+metrics.py
+'''
+from bisect import bisect_left
+from collections import deque
+from threading import Lock, local, current_thread
+
+# upper bounds, in seconds, of the buckets of the latency histograms
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# the type and the help text of every metric, in the order they are shown
+METRICS = {
+    'http_requests_total': ('counter', 'Requests answered, by endpoint, method and status'),
+    'http_request_duration_seconds': ('histogram', 'Time to build the response, by endpoint'),
+    'tp_job_wait_seconds': ('histogram', 'Time from submit to the start of the computation'),
+    'tp_job_run_seconds': ('histogram', 'Time to compute the job'),
+    'tp_slow_jobs_total': ('counter', 'Jobs that took longer than TP_SLOW_JOB seconds'),
+    'tp_queue_depth': ('gauge', 'Jobs waiting in the queue'),
+    'tp_queue_cost': ('gauge', 'Estimated cost of the jobs waiting in the queue'),
+    'tp_queue_rejected_total': ('counter', 'Jobs rejected because the queue was full'),
+    'tp_runner_busy_seconds_total': ('counter', 'Time the TaskRunner spent computing jobs'),
+    'tp_runner_idle_seconds_total': ('counter', 'Time the TaskRunner spent waiting for jobs'),
+    'tp_runner_jobs_total': ('counter', 'Jobs taken from the queue by the TaskRunner'),
+    'tp_jobs': ('gauge', 'Jobs in the job table, by state'),
+    'tp_result_bytes': ('gauge', 'Size of the encoded results kept in the job table'),
+    'tp_jobs_evicted_total': ('counter', 'Finished jobs removed from the job table'),
+    'tp_stream_events_dropped_total': ('counter', 'Job events dropped for slow job streams'),
+    'tp_result_cache_entries': ('gauge', 'Results in the result cache'),
+    'di_ingest_seconds': ('gauge', 'Time it took to read the data'),
+    'di_ingest_workers': ('gauge', 'Processes that parsed the csv file'),
+    'di_peak_rss_bytes': ('gauge', 'Peak resident memory of the server while reading the data'),
+    'di_rows_read': ('gauge', 'Rows read from the csv file'),
+    'di_data_version': ('gauge', 'Number of times rows were added to the data')
+}
+
+def new_shard():
+    '''
+    the counters and the histograms of one thread, both map a (name, labels) key to the
+    value, the histograms to the list of the counts of the buckets (the last one is +Inf)
+    followed by the sum of the observed values
+    '''
+    return {'counters': {}, 'histograms': {}}
+
+def merge(into, shard):
+    '''
+    adds the values of the shard to the ones of into
+
+    the dictionaries of a shard are copied before they are read, the copy of a dictionary
+    is done in one step so it cannot change while it is copied
+    '''
+    counters = into['counters']
+    for key, value in dict(shard['counters']).items():
+        counters[key] = counters.get(key, 0) + value
+
+    histograms = into['histograms']
+    for key, values in dict(shard['histograms']).items():
+        total = histograms.setdefault(key, [0] * len(values))
+        for index, value in enumerate(list(values)):
+            total[index] += value
+
+class Metrics:
+    '''
+    counters and histograms that are written without a lock: every thread writes to its own
+    shard and the shards are merged only when the metrics are scraped
+
+    the shards of the threads that ended (the server starts a thread for every connection)
+    are merged into the retired shard a few at a time, every time a new thread registers its
+    shard, and all of them when the metrics are scraped, so the shards of the ended threads
+    are not kept even if the metrics are never scraped
+    '''
+    # number of shards checked every time a new shard is registered, more than one, so the
+    # shards of the ended threads are retired faster than the new ones are added
+    RETIRE_STEP = 2
+
+    def __init__(self):
+        # the (thread, shard) pairs of the threads, appending to a deque is thread safe, so
+        # a thread registers its shard without waiting for the lock
+        self.shards = deque()
+        self.retired = new_shard()
+        self.lock = Lock()
+        self.local = local()
+
+    def shard(self):
+        '''
+        returns the shard of the calling thread, the first time a thread writes a metric its
+        shard is registered and the oldest shards are checked, only if the lock is free
+        '''
+        shard = getattr(self.local, 'shard', None)
+        if shard is None:
+            shard = self.local.shard = new_shard()
+            self.shards.append((current_thread(), shard))
+            if self.lock.acquire(blocking=False):
+                try:
+                    self.retire(self.RETIRE_STEP)
+                finally:
+                    self.lock.release()
+        return shard
+
+    def retire(self, count = None):
+        '''
+        checks the count oldest shards (all of them if count is None) and merges the ones of
+        the threads that ended into the retired shard, the others are put back at the end;
+        called while holding the lock
+        '''
+        if count is None:
+            count = len(self.shards)
+        for _ in range(min(count, len(self.shards))):
+            thread, shard = self.shards.popleft()
+            if thread.is_alive():
+                self.shards.append((thread, shard))
+            else:
+                merge(self.retired, shard)
+
+    def inc(self, name, labels = (), value = 1):
+        '''
+        adds value to the counter with the name and the labels, a tuple of (label, value)
+        '''
+        counters = self.shard()['counters']
+        key = (name, labels)
+        counters[key] = counters.get(key, 0) + value
+
+    def observe(self, name, labels, seconds):
+        '''
+        adds the value to the histogram with the name and the labels
+        '''
+        histograms = self.shard()['histograms']
+        key = (name, labels)
+        values = histograms.get(key)
+        if values is None:
+            values = histograms[key] = [0] * (len(BUCKETS) + 1) + [0.0]
+        values[bisect_left(BUCKETS, seconds)] += 1
+        values[-1] += seconds
+
+    def collect(self):
+        '''
+        returns the counters and the histograms of all the threads merged together
+        '''
+        with self.lock:
+            self.retire()
+            merged = new_shard()
+            merge(merged, self.retired)
+            # the deque is copied in one step, the new threads can add their shards to it
+            for _, shard in list(self.shards):
+                merge(merged, shard)
+        return merged
+
+def format_labels(labels):
+    '''
+    the labels in the text format, {label="value",...}
+    '''
+    if not labels:
+        return ''
+    pairs = ','.join(f'{label}="{value_text(value)}"' for label, value in labels)
+    return '{' + pairs + '}'
+
+def value_text(value):
+    '''
+    escapes a label value
+    '''
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def render(collected, gauges):
+    '''
+    returns the metrics in the prometheus text format: the counters and the histograms
+    collected from the threads and the gauges, a list of (name, labels, value) read when
+    the metrics are scraped; the gauges with a None value are left out
+    '''
+    samples = {}
+    for (name, labels), value in sorted(collected['counters'].items(), key=str):
+        samples.setdefault(name, []).append(f'{name}{format_labels(labels)} {value}')
+
+    for (name, labels), values in sorted(collected['histograms'].items(), key=str):
+        lines = samples.setdefault(name, [])
+        count = 0
+        for bound, bucket in zip(BUCKETS + ('+Inf',), values):
+            count += bucket
+            lines.append(f'{name}_bucket{format_labels(labels + (("le", bound),))} {count}')
+        lines.append(f'{name}_sum{format_labels(labels)} {values[-1]}')
+        lines.append(f'{name}_count{format_labels(labels)} {count}')
+
+    for name, labels, value in gauges:
+        if value is not None:
+            samples.setdefault(name, []).append(f'{name}{format_labels(labels)} {value}')
+
+    output = []
+    for name, (kind, text) in METRICS.items():
+        if name in samples:
+            output.append(f'# HELP {name} {text}')
+            output.append(f'# TYPE {name} {kind}')
+            output.extend(samples[name])
+    return '\n'.join(output) + '\n'
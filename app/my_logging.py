@@ -1,37 +1,109 @@
 '''
 module my_logging.py
 '''
-from logging import getLogger, Formatter, INFO
-from logging.handlers import RotatingFileHandler
+from atexit import register
+from logging import getLogger, Filter, Formatter, INFO
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
+from os import environ
+from queue import SimpleQueue
+from random import random
+from threading import Lock
 from time import gmtime
 
+# the lock that makes sure the handlers are set up only once, even if several threads
+# create a CustomLogging instance at the same time
+setup_lock = Lock()
+
+def file_handler(max_bytes = 10000, backup_count = 1):
+    '''
+    create the rotating file handler that writes to webserver.log
+    '''
+    handler = RotatingFileHandler('webserver.log', maxBytes=max_bytes, backupCount=backup_count)
+    formatter = Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    # set the formatter to use gmtime
+    formatter.converter = gmtime
+    handler.setFormatter(formatter)
+    handler.setLevel(INFO)
+    return handler
+
+class SampleFilter(Filter):
+    '''
+    keeps only a fraction of the info messages, the warnings and errors are always kept
+    '''
+    def __init__(self, rate):
+        '''
+        rate is the fraction of the info messages that are kept, between 0 and 1
+        '''
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        '''
+        returns True if the record is kept: always for a warning or an error, with the
+        probability rate for an info message
+        '''
+        return record.levelno > INFO or random() < self.rate
+
+def queue_handler(target, rate = 1):
+    '''
+    create a handler that puts the records in a queue and the started listener thread that
+    gives them to the target handler, only a fraction rate of the info messages is queued
+    '''
+    log_queue = SimpleQueue()
+    handler = QueueHandler(log_queue)
+    if rate < 1:
+        handler.addFilter(SampleFilter(rate))
+
+    listener = QueueListener(log_queue, target)
+    listener.start()
+    return handler, listener
+
 class CustomLogging:
     '''
     custom class for logging
+
+    the threads that log (the request threads and the TaskRunners) only put the records
+    in an in-memory queue, a single background thread writes them to webserver.log, so
+    the disk writes and the rotations of the file do not happen on the hot paths
     '''
+    # the listener that writes the queued records, None until the first instance is created
+    listener = None
+
     def __init__(self, max_bytes = 10000, backup_count = 1):
         '''
-        create a rotating file handler for logging to webserver.log
+        set up the queue handler and the listener thread the first time, the next
+        instances share them
         '''
 
         # create logger
         self.logger = getLogger(__name__)
-        self.logger.setLevel(INFO)
 
-        # create a rotating file handler
-        handler = RotatingFileHandler('webserver.log', max_bytes, backup_count)
-        formatter = Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+        with setup_lock:
+            if CustomLogging.listener is not None:
+                return
+
+            self.logger.setLevel(INFO)
+
+            # the records go through the queue to the rotating file handler; with
+            # TP_LOG_SAMPLE=<rate> only that fraction of the info messages is logged
+            handler, CustomLogging.listener = queue_handler(
+                file_handler(max_bytes, backup_count), float(environ.get('TP_LOG_SAMPLE', 1)))
 
-        # set the formatter to use gmtime
-        formatter.converter = gmtime
-        handler.setFormatter(formatter)
-        handler.setLevel(INFO)
+            # the records still in the queue are written when the server exits
+            register(CustomLogging.listener.stop)
 
-        # add the handler to the logger
-        self.logger.addHandler(handler)
+            # add the handler to the logger
+            self.logger.addHandler(handler)
 
     def get_logger(self):
         '''
         return the logger instance
         '''
         return self.logger
+
+def get_logger():
+    '''
+    return the logger of the server, setting it up if it was not used before
+    '''
+    return CustomLogging().get_logger()
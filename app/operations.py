@@ -2,20 +2,72 @@
 operations.py
 '''
 from ast import literal_eval
+from collections import namedtuple
+from heapq import nsmallest, nlargest
+
+# partial aggregate (sum, count, min and max) of a group of data values, used instead of the
+# list of values when the values are already reduced, by the columnar store or by the
+# aggregate index of the DataIngestor
+Partial = namedtuple('Partial', ['total', 'count', 'minimum', 'maximum'])
+
+def aggregate(values):
+    '''
+    reduces a list of data values to a partial aggregate
+    '''
+    return Partial(sum(values), len(values), min(values), max(values))
+
+def merge(partials):
+    '''
+    merges partial aggregates of disjoint groups of values in the partial aggregate of
+    all the values
+
+    the totals of the groups are added together instead of all the values one after the
+    other, so the total can differ from sum() over all the values in the last bits: the
+    means match the ones computed from the lists of values to about 1e-12, not exactly
+    '''
+    partials = list(partials)
+    return Partial(
+        sum(partial.total for partial in partials),
+        sum(partial.count for partial in partials),
+        min((partial.minimum for partial in partials), default=None),
+        max((partial.maximum for partial in partials), default=None)
+    )
+
+# the endpoints that can be computed by plan_query and the ones that need a state
+ENDPOINTS = ('states_mean', 'state_mean', 'best5', 'worst5', 'global_mean', 'diff_from_mean',
+             'state_diff_from_mean', 'mean_by_category', 'state_mean_by_category', 'top_k')
+STATE_ENDPOINTS = ('state_mean', 'state_diff_from_mean', 'state_mean_by_category')
+
+# the orders and the grouping levels of the top_k endpoint: best and worst depend on the
+# question, like for best5 and worst5; the states are ranked by their means for all the
+# values of the question or separately for every stratification
+TOP_K_ORDERS = ('best', 'worst', 'lowest', 'highest')
+TOP_K_LEVELS = ('state', 'stratification')
+
+# the (k, order, level) parameters of a top_k job without parameters
+TOP_K_DEFAULTS = (5, 'best', 'state')
+
+def mean(values):
+    '''
+    calculates the mean of a list of data values or of a partial aggregate
+    '''
+    if isinstance(values, Partial):
+        return values.total / values.count
+    return sum(values) / len(values)
 
 def state_mean():
     '''
     calculates the mean of the values for a certain state
     '''
 
-    return lambda data: {key: sum(values) / len(values) for key, values in data.items()}
+    return lambda data: {key: mean(values) for key, values in data.items()}
 
 def global_mean():
     '''
     calculates the global mean of the values for all the states
     '''
 
-    return lambda data: {key: sum(values) / len(values) for key, values in data.items()}
+    return lambda data: {key: mean(values) for key, values in data.items()}
 
 def states_means():
     '''
@@ -24,7 +76,7 @@ def states_means():
 
     return lambda data: dict(
         sorted(
-            {key: sum(values) / len(values) for key, values in data.items()}.items(),
+            {key: mean(values) for key, values in data.items()}.items(),
             key=lambda item: item[1]
         )
     )
@@ -37,7 +89,7 @@ def category_means():
 
     return lambda data: dict(
         sorted(
-            {key: sum(values) / len(values) for key, values in data.items()}.items(),
+            {key: mean(values) for key, values in data.items()}.items(),
             key=lambda item: item[0]
         )
     )
@@ -50,7 +102,7 @@ def state_mean_by_category():
 
     return lambda data: {state: dict(
         sorted(
-            {key: sum(values) / len(values) for key, values in categories.items()}.items(),
+            {key: mean(values) for key, values in categories.items()}.items(),
             key=lambda item: item[0]
         )
     ) for state, categories in data.items()}
@@ -68,134 +120,267 @@ def diff_from_mean():
 
     return lambda data, global_data: dict(
         sorted(
-            {key: global_data['global_mean'] - sum(values) / len(values)
+            {key: global_data['global_mean'] - mean(values)
             for key, values in data.items()}.items(),
             key=lambda item: item[1],
             reverse=True
         )
     )
 
-def best5():
+def top_k(k = 5, lowest = True):
     '''
     returns a lambda function that has as input a dictionary with the key being the state and
-    the value a list of data values and calculates the mean of the data values for each state key,
-    sorts them in ascending order and gets the first 5 states with the lowest mean
+    the value a list of data values and calculates the mean of the data values for each state key
+    and gets the k states with the lowest (or highest) mean, in order
+
+    the means are not all sorted, a heap keeps only the k best ones; the states with equal
+    means keep their order, like with a stable sort
     '''
+    select = nsmallest if lowest else nlargest
 
     return lambda data: dict(
-            sorted(
-                {key: sum(values) / len(values) for key, values in data.items()}.items(),
-                key=lambda item: item[1]
-            )[:5]
+            select(k, ((key, mean(values)) for key, values in data.items()),
+                   key=lambda item: item[1])
         )
 
-def worst5():
+def top_k_by_group(k = 5, lowest = True):
+    '''
+    same as top_k, but for a dictionary with the key being a group (a stratification) and
+    the value the dictionary of the states of the group, the groups are sorted by key
+    '''
+    select = top_k(k, lowest)
+
+    return lambda data: {group: select(states) for group, states in sorted(data.items())}
+
+def best5():
     '''
     returns a lambda function that has as input a dictionary with the key being the state and
-    the value a list of data values and calculates the mean of the data values for each state key,
-    sorts them in descending order and gets the first 5 states with the highest mean
+    the value a list of data values and calculates the mean of the data values for each state key
+    and gets the 5 states with the lowest mean, in ascending order
     '''
 
-    return lambda data: dict(
-            sorted(
-                {key: sum(values) / len(values) for key, values in data.items()}.items(),
-                key=lambda item: item[1], reverse=True
-            )[:5]
-        )
+    return top_k(5, lowest=True)
 
-def get_job_data_for_question(question, data, global_data = False, normal_data = True):
+def worst5():
+    '''
+    returns a lambda function that has as input a dictionary with the key being the state and
+    the value a list of data values and calculates the mean of the data values for each state key
+    and gets the 5 states with the highest mean, in descending order
     '''
-    function that extracts the data needed for the job when the request to the server contains a
-    question
 
-    if the request needs the mean for every state than normal_data should be True, the function
-    will return a dictionary with the key being the state and the value a list of data values
-    for the question
+    return top_k(5, lowest=False)
 
-    if the request needs the mean for all the states than global_data should be True, the function
-    will return a dictionary with the key being 'global_mean' and the value a list of all data the
-    values for the question for all the states
+def get_aggregates_for_question(question, aggregates, global_data = False, normal_data = True):
+    '''
+    extracts the data needed for the job when the request to the server contains a question,
+    from the aggregate index of the DataIngestor
 
-    in the for loop, the function will get all the data values for the question for the given state
-    irrespective of the stratification category and stratification
+    if normal_data is True the first dictionary has the key being the state and the value the
+    partial aggregate of all the values of the state for the question, if global_data is True
+    the second one has the key 'global_mean' and the partial aggregate of all the states
 
-    for each stratification category and stratification key, the value is a list of data values
-    so the lists will be concatenated in one list
+    the partial aggregates of the stratifications of each state are merged, so the work grows
+    with the number of states, not with the number of rows
     '''
 
     data_for_job = {}
-    data_for_global = {'global_mean': []}
-    for state in data:
-        if question in data[state]:
-            values_for_question = data[state][question].values()
-            list_of_values = [item for list in values_for_question for item in list]
-            if normal_data:
-                data_for_job[state] = list_of_values
-            if global_data:
-                data_for_global['global_mean'].extend(list_of_values)
+    data_for_global = {'global_mean': merge([])}
+    for state in aggregates:
+        if question in aggregates[state]:
+            data_for_job[state] = merge(aggregates[state][question].values())
+
+    if global_data:
+        data_for_global['global_mean'] = merge(data_for_job.values())
+    if not normal_data:
+        data_for_job = {}
 
     return data_for_job, data_for_global
 
-def get_job_data_for_state(question, state, data):
+def get_aggregates_for_state(question, state, aggregates):
+    '''
+    extracts the partial aggregate of the values of a state for a question from the aggregate
+    index of the DataIngestor, or a dictionary with a status key if the state or the question
+    is not in the csv file
     '''
-    function that extracts the data needed for the job when the request to the server contains a
-    question and a state
 
-    function returns a dictionary with the key being the state and the value a list of data values
+    if state not in aggregates:
+        # when given state is not in the csv file
+        return {"status": "Invalid state"}
+    if question not in aggregates[state]:
+        # when given question is not in the csv file
+        return {"status": "Invalid question"}
 
-    the function will get all the data values for the question for the given state
-    irrespective of the stratification category and stratification
+    return {state: merge(aggregates[state][question].values())}
 
-    for each stratification category and stratification key, the value is a list of data values
-    so the lists will be concatenated in one list
+def get_categories_for_question(question, category_index):
+    '''
+    reads the stratification index of the DataIngestor and returns a dictionary with the key
+    being the string tuple of the state, stratification category and stratification and the
+    value the Partial aggregate of the values of the group
     '''
 
-    data_for_job = {}
-    if state in data:
-        if question in data[state]:
-            values_for_question = data[state][question].values()
-            data_for_job[state] = [item for list in values_for_question for item in list]
-        else:
-            # when given question is not in the csv file
-            return {"status": "Invalid question"}
-    else:
+    if question not in category_index:
+        return {}
+    return category_index[question][0]
+
+def get_categories_for_state(question, state, category_index, aggregates):
+    '''
+    reads the stratification index of the DataIngestor and returns a dictionary with the state
+    as the key and as the value the dictionary of the Partial aggregates of its stratifications,
+    or a dictionary with a status key if the state or the question is not in the csv file
+    '''
+
+    if state not in aggregates:
         # when given state is not in the csv file
         return {"status": "Invalid state"}
+    if question not in aggregates[state]:
+        # when given question is not in the csv file
+        return {"status": "Invalid question"}
 
-    return data_for_job
+    return {state: category_index[question][1][state]}
 
-def get_job_data_for_categories(question, data):
+def get_categories_by_stratification(question, category_index):
     '''
-    function returns a dictionary with the key being a tuple of the state, stratification category
-    and stratification and the value a list of data values
+    reads the stratification index of the DataIngestor and returns a dictionary with the key
+    being the string tuple of the stratification category and stratification and the value a
+    dictionary with the Partial aggregate of every state for the stratification
     '''
 
-    data_for_job = {}
-    for state in data:
-        if question in data[state]:
-            for str_categories in data[state][question]:
-                # categories is a tuple made string, so we need to convert it back to a tuple
-                try:
-                    tuple_categories = literal_eval(str_categories)
-                except (ValueError, SyntaxError):
-                    return {"status": "Invalid syntax for categories key"}
-
-                # if the tuple is not empty, we will create a new key for the dictionary
-                if tuple_categories[0] != '' and tuple_categories[1] != '':
-                    new_key = str((state, tuple_categories[0], tuple_categories[1]))
-                    data_for_job[new_key] = data[state][question][str_categories]
-    return data_for_job
+    groups = {}
+    if question in category_index:
+        for state, categories in category_index[question][1].items():
+            for key, partial in categories.items():
+                groups.setdefault(key, {})[state] = partial
+    return groups
 
-def get_job_data_for_categ_per_state(question, state, data):
+def validate_top_k(k, order, level):
     '''
-    function that returns a dictionary with the key being the state and the value a dictionary with
-    the key being a tuple of the stratification category and stratification and the value a list of
-    data values
+    checks the parameters of a top_k query and returns a dictionary with a status key if
+    they are invalid or None
     '''
+    if not isinstance(k, int) or isinstance(k, bool) or k < 1:
+        return {"status": "Invalid k"}
+    if order not in TOP_K_ORDERS:
+        return {"status": "Invalid order"}
+    if level not in TOP_K_LEVELS:
+        return {"status": "Invalid level"}
+    return None
+
+def plan_query(endpoint, question, state, ingestor, plan = None, params = None):
+    '''
+    creates the job, without a job_id, for a query given by an endpoint, a question and a
+    state (None for the endpoints that do not need one) over the data of a DataIngestor
 
-    data_for_job = {}
-    if state in data:
-        data_for_job[state] = data[state][question]
+    plan keeps the data extracted for every question, it is extracted the first time a
+    question is seen and shared by all the following queries on the same question
+
+    params are the (k, order, level) parameters of a top_k query, the defaults are used if
+    they are not given
+
+    returns a dictionary with a status key if the query is invalid
+    '''
+    if plan is None:
+        plan = {}
+
+    if endpoint == 'top_k':
+        k, order, level = params or TOP_K_DEFAULTS
+        if order in ('best', 'worst'):
+            # best is the lowest means for the best is min questions and the highest for
+            # the other ones, worst the opposite
+            lowest = (order == 'best') == (question in ingestor.questions_best_is_min)
+        else:
+            lowest = order == 'lowest'
+        key = (endpoint, question, state, (k, order, level))
+
+        if level == 'stratification':
+            return {'key': key, 'operation': top_k_by_group(k, lowest),
+                    'data': get_categories_by_stratification(question, ingestor.category_index)}
+
+        if question not in plan:
+            plan[question] = get_aggregates_for_question(question, ingestor.aggregates,
+            global_data=True)
+        return {'key': key, 'operation': top_k(k, lowest), 'data': plan[question][0]}
+
+    if endpoint in ('mean_by_category', 'state_mean_by_category'):
+        # the groups are read from the stratification index, they are shared by all the
+        # queries and are not changed by the operations
+        if endpoint == 'state_mean_by_category':
+            data_for_job = get_categories_for_state(question, state, ingestor.category_index,
+            ingestor.aggregates)
+            operation = state_mean_by_category()
+        else:
+            data_for_job = get_categories_for_question(question, ingestor.category_index)
+            operation = category_means()
+
+        if 'status' in data_for_job:
+            return data_for_job
+        return {'key': (endpoint, question, state), 'operation': operation,
+                'data': data_for_job}
+
+    # the other endpoints use the partial aggregates of every state and of all the states
+    if question not in plan:
+        plan[question] = get_aggregates_for_question(question, ingestor.aggregates,
+        global_data=True)
+    data_for_states, data_for_global = plan[question]
+
+    if endpoint in ('state_mean', 'state_diff_from_mean'):
+        if state not in data_for_states:
+            # get the reason why the state has no data for the question
+            return get_aggregates_for_state(question, state, ingestor.aggregates)
+        data_for_job = {state: data_for_states[state]}
     else:
-        return {"status": "Invalid state"}
-    return data_for_job
+        data_for_job = data_for_states
+
+    job = {'key': (endpoint, question, state), 'data': data_for_job}
+    if endpoint == 'states_mean':
+        job['operation'] = states_means()
+    elif endpoint == 'state_mean':
+        job['operation'] = state_mean()
+    elif endpoint in ('best5', 'worst5'):
+        # best5 is the lowest means for the best is min questions, worst5 the opposite
+        lowest = (endpoint == 'best5') == (question in ingestor.questions_best_is_min)
+        job['operation'] = best5() if lowest else worst5()
+    elif endpoint == 'global_mean':
+        job['operation'] = global_mean()
+        job['data'] = data_for_global
+    elif endpoint in ('diff_from_mean', 'state_diff_from_mean'):
+        job['operation'] = diff_from_mean()
+        job['global_operation'] = global_mean()
+        job['global_data'] = data_for_global
+    else:
+        return {"status": "Invalid endpoint"}
+    return job
+
+def validate_query(endpoint, question, state, ingestor):
+    '''
+    checks a query without extracting its data, using the aggregate index of the
+    DataIngestor, and returns a dictionary with a status key if it is invalid or None
+    '''
+    if endpoint not in ENDPOINTS:
+        return {"status": "Invalid endpoint"}
+
+    if endpoint in STATE_ENDPOINTS:
+        if state not in ingestor.aggregates:
+            # when given state is not in the csv file
+            return {"status": "Invalid state"}
+        if question not in ingestor.aggregates[state]:
+            # when given question is not in the csv file
+            return {"status": "Invalid question"}
+    return None
+
+def estimate_cost(endpoint, question, state, ingestor):
+    '''
+    estimates the cost of a query from the indexes of the DataIngestor: the categories
+    endpoints go over the stratifications of the question (or of the state) in the category
+    index, the other ones merge one partial aggregate per state
+    '''
+    if endpoint in ('mean_by_category', 'state_mean_by_category'):
+        groups, groups_by_state = ingestor.category_index.get(question, ({}, {}))
+        if endpoint == 'mean_by_category':
+            return len(groups)
+        return len(groups_by_state.get(state, ()))
+
+    _, rows_by_state = ingestor.row_counts.get(question, (0, {}))
+    if endpoint == 'state_mean':
+        return 1
+    return len(rows_by_state)
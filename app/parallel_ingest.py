@@ -0,0 +1,150 @@
+'''
+parallel_ingest.py
+'''
+from csv import reader
+from io import StringIO
+from mmap import mmap, ACCESS_READ
+from multiprocessing import get_context
+
+def column_indices(header, columns):
+    '''
+    returns the positions in the header of the columns we need, in the order of columns
+    '''
+    fields = next(reader(StringIO(header.decode('utf-8'), newline='')))
+    return [fields.index(column) for column in columns]
+
+def split_chunks(file_map, start, num_chunks):
+    '''
+    splits the bytes of the mapped file from start to the end in about num_chunks
+    (begin, end) ranges, every range ends right after a new line so no row is cut
+    '''
+    size = len(file_map)
+    chunks = []
+    begin = start
+    for i in range(1, num_chunks + 1):
+        end = size if i == num_chunks else start + (size - start) * i // num_chunks
+        if end < size:
+            newline = file_map.find(b'\n', end)
+            end = size if newline == -1 else newline + 1
+        if end > begin:
+            chunks.append((begin, end))
+            begin = end
+    return chunks
+
+def parse_chunk(csv_path, indices, chunk):
+    '''
+    parses the rows between the (begin, end) offsets of the chunk of the csv file, keeping
+    only the columns at the given indices (state, question, data value, stratification
+    category 1 and stratification 1) and returns the number of rows and the state_data
+    of these rows
+
+    it runs in a worker process, which maps the file itself, so only the offsets are given
+    to it and only the state_data of its rows is sent back
+    '''
+    begin, end = chunk
+    with open(csv_path, 'rb') as file, mmap(file.fileno(), 0, access=ACCESS_READ) as file_map:
+        text = file_map[begin:end].decode('utf-8')
+
+    state_index, question_index, value_index, stratcat_index, strat_index = indices
+    state_data = {}
+    rows = 0
+    for line in reader(StringIO(text, newline='')):
+        # skip the empty lines, like DictReader does
+        if not line:
+            continue
+        rows += 1
+        questions = state_data.setdefault(line[state_index], {})
+        categories = questions.setdefault(line[question_index], {})
+        categories.setdefault(str((line[stratcat_index], line[strat_index])), []).append(
+            float(line[value_index]))
+    return rows, state_data
+
+def parse_chunks(csv_path, indices, chunks, conn):
+    '''
+    target of a worker process: parses its chunks one after the other and sends the result of
+    parse_chunk() for every one through conn, or the error that stopped it
+    '''
+    try:
+        for chunk in chunks:
+            conn.send(parse_chunk(csv_path, indices, chunk))
+    except Exception as error: # pylint: disable=broad-exception-caught
+        conn.send(error)
+    finally:
+        conn.close()
+
+def merge_state_data(state_data, chunk_data):
+    '''
+    adds the state_data of a chunk to the state_data of the chunks before it: the lists of
+    values are concatenated and the new keys are added after the existing ones, so merging
+    the chunks in file order gives the same state_data as reading the file line by line
+    '''
+    for state, questions in chunk_data.items():
+        state_questions = state_data.setdefault(state, {})
+        for question, categories in questions.items():
+            question_categories = state_questions.setdefault(question, {})
+            for key, values in categories.items():
+                if key in question_categories:
+                    question_categories[key].extend(values)
+                else:
+                    question_categories[key] = values
+    return state_data
+
+def read_state_data(csv_path, columns, num_workers, progress = None):
+    '''
+    builds the state_data of the csv file with num_workers processes: the file is mapped,
+    split in row aligned chunks (a few per worker, so the workers finish together) and every
+    chunk is parsed by a worker, then the state_data of the chunks is merged in file order, as
+    soon as each one is ready, so only a few of them are kept in memory at the same time
+
+    the workers are forked with their chunks and send back their results through pipes, no
+    thread is started here: the server reads the data while the app package is imported,
+    so the threads of a worker pool, which import the module of the function to pickle the
+    tasks, would wait forever for the import to finish; since the workers are forked, this
+    should be called before any other thread is started
+
+    the rows must not contain new lines inside quoted fields, like the rows of the
+    nutrition_activity_obesity_usa_subset.csv file
+
+    if progress is a dictionary, its rows and bytes counters are updated after every chunk
+    '''
+    if progress is None:
+        progress = {'rows': 0, 'bytes': 0}
+
+    with open(csv_path, 'rb') as file, mmap(file.fileno(), 0, access=ACCESS_READ) as file_map:
+        header_end = file_map.find(b'\n') + 1
+        progress['bytes'] += header_end
+        indices = column_indices(file_map[:header_end], columns)
+        chunks = split_chunks(file_map, header_end, num_workers * 4)
+
+    # worker i parses the chunks i, i + num_workers, ... so the chunks are received in file
+    # order by reading from the workers in turn
+    context = get_context('fork')
+    workers = []
+    for index in range(num_workers):
+        receiver, sender = context.Pipe(duplex=False)
+        process = context.Process(target=parse_chunks, daemon=True, args=(
+            csv_path, indices, chunks[index::num_workers], sender))
+        process.start()
+        sender.close()
+        workers.append((process, receiver))
+
+    state_data = {}
+    try:
+        for number, (begin, end) in enumerate(chunks):
+            result = workers[number % num_workers][1].recv()
+            if isinstance(result, Exception):
+                raise result
+            rows, chunk_data = result
+            merge_state_data(state_data, chunk_data)
+            progress['rows'] += rows
+            progress['bytes'] += end - begin
+    except BaseException:
+        # the other workers are stopped instead of waiting for them to send their chunks
+        for process, _ in workers:
+            process.terminate()
+        raise
+    finally:
+        for process, receiver in workers:
+            receiver.close()
+            process.join()
+    return state_data
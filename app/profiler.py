@@ -0,0 +1,64 @@
+'''
+profiler.py
+'''
+import sys
+from collections import Counter
+from os import path
+from threading import Lock, get_ident
+from time import monotonic, sleep
+
+# only one profile runs at a time, a second request is refused while it holds the lock
+profile_lock = Lock()
+
+def frame_name(frame):
+    '''
+    the name of the function of the frame in the collapsed stacks, with the file (and the
+    directory it is in) and the line the function starts at, so the frames of the same
+    function are merged whatever line it was at
+    '''
+    code = frame.f_code
+    name = getattr(code, 'co_qualname', code.co_name)
+    file = path.join(path.basename(path.dirname(code.co_filename)),
+                     path.basename(code.co_filename))
+    return f"{name} ({file}:{code.co_firstlineno})"
+
+def sample_stacks(seconds, interval = 0.01, idents = None):
+    '''
+    samples the stacks of the threads every interval seconds for the given seconds and
+    returns a Counter of the stacks, as tuples of frame names from the outermost one
+
+    only the threads with an ident in idents are sampled if it is given, the calling thread
+    is never sampled; nothing runs in the other threads, the stacks are read with
+    sys._current_frames(), so there is no overhead when no profile is running
+    '''
+    me = get_ident()
+    stacks = Counter()
+    # the name of a function is built once, the first time it is sampled
+    names = {}
+    deadline = monotonic() + seconds
+    while True:
+        for ident, frame in sys._current_frames().items(): # pylint: disable=protected-access
+            if ident == me or (idents is not None and ident not in idents):
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                name = names.get(code)
+                if name is None:
+                    name = names[code] = frame_name(frame)
+                stack.append(name)
+                frame = frame.f_back
+            stacks[tuple(reversed(stack))] += 1
+        # the frames are not kept, so the threads can free them
+        frame = None
+
+        if monotonic() + interval > deadline:
+            return stacks
+        sleep(interval)
+
+def collapse(stacks):
+    '''
+    returns the stacks in the collapsed format of the flame graph tools, one line for every
+    stack with its frames separated by ; and the number of samples, the most frequent first
+    '''
+    return ''.join(f"{';'.join(stack)} {count}\n" for stack, count in stacks.most_common())
@@ -0,0 +1,112 @@
+'''
+result_cache.py
+'''
+from collections import OrderedDict
+from threading import Lock
+
+class ResultCache:
+    '''
+    class that caches the results of the jobs and keeps track of the jobs that are
+    queued or running, so identical jobs are computed only once
+
+    the key of a job is a tuple (endpoint, question, state), state is None for the
+    endpoints that do not need one
+    '''
+    def __init__(self, max_size = 128):
+        '''
+        the results are kept in an OrderedDict used as a LRU list: the most recently used
+        result is moved to the end and the first one is evicted when there are more than
+        max_size results (max_size 0 disables the cache, but not the deduplication)
+        '''
+        self.max_size = max_size
+        self.results = OrderedDict()
+
+        # the queued or running job for every key
+        self.in_flight = {}
+
+        # incremented on every invalidation, so the results of the jobs submitted
+        # before the invalidation are not cached
+        self.version = 0
+
+        self.lock = Lock()
+
+    def claim(self, job):
+        '''
+        called before submitting a job, returns:
+        - ('cached', result) if the result for the job key is cached
+        - ('attached', leader) if an identical job is queued or running, the job_id is added
+        to the followers of that job and will get its result
+        - ('submit', None) if the job has to be computed, it becomes the in flight job
+        for its key
+        '''
+        key = job['key']
+        with self.lock:
+            if key in self.results:
+                self.results.move_to_end(key)
+                return 'cached', self.results[key]
+
+            leader = self.in_flight.get(key)
+            if leader is not None:
+                leader['followers'].append(job['job_id'])
+                return 'attached', leader
+
+            job['followers'] = []
+            job['cache_version'] = self.version
+            self.in_flight[key] = job
+            return 'submit', None
+
+    def contains(self, key):
+        '''
+        checks whether the result for the key is cached or being computed, so a job with
+        this key would not be queued
+        '''
+        with self.lock:
+            return key in self.results or key in self.in_flight
+
+    def complete(self, job, result, cacheable = True):
+        '''
+        called when a job is done, caches its result and returns the ids of the jobs that
+        were attached to it
+
+        cacheable is False for the failed jobs, their followers fail too but the next
+        identical job is computed again
+        '''
+        key = job['key']
+        with self.lock:
+            if self.in_flight.get(key) is job:
+                del self.in_flight[key]
+
+                if cacheable and self.max_size > 0 and job['cache_version'] == self.version:
+                    self.results[key] = result
+                    self.results.move_to_end(key)
+                    if len(self.results) > self.max_size:
+                        self.results.popitem(last=False)
+
+            return list(job['followers'])
+
+    def invalidate(self, question = None):
+        '''
+        drops the cached results for the question or all of them if question is None,
+        called when the dataset changes
+
+        the in flight jobs are forgotten too, they keep their followers but new jobs will
+        not attach to them and their results will not be cached
+        '''
+        with self.lock:
+            self.version += 1
+            if question is None:
+                self.results.clear()
+                self.in_flight.clear()
+                return
+
+            for key in [key for key in self.results if key[1] == question]:
+                del self.results[key]
+            for key in [key for key in self.in_flight if key[1] == question]:
+                del self.in_flight[key]
+
+    def __len__(self):
+        '''
+        number of cached results
+        '''
+        with self.lock:
+            return len(self.results)
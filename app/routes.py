@@ -1,16 +1,32 @@
 '''
 route.py
 '''
-import os
-import json
-from flask import request, jsonify
+from queue import Empty
+from time import monotonic
+from flask import request, jsonify, Response, g
 from app import webserver
+from app.job_table import DONE, FAILED
+from app.json_codec import dumps
+from app.metrics import render
+from app.profiler import profile_lock, sample_stacks, collapse
+from app.task_runner import QueueFullError
+from app.data_ingestor import parse_rows
 import app.operations as op
 
 # constants
 STATE = 'state'
 QUESTION = 'question'
 
+# maximum number of seconds a get_results request can wait for a job
+MAX_WAIT = 30
+
+# seconds after which a keep alive comment is sent on an idle job stream
+KEEPALIVE = 15
+
+# maximum number of seconds a profile can run for and the shortest sampling interval
+MAX_PROFILE = 60
+MIN_INTERVAL = 0.001
+
 def shutting_down():
     '''
     function that returns the value of the shutdown flag from the thread pool
@@ -18,13 +34,110 @@ def shutting_down():
     '''
     return webserver.tasks_runner.shutdown_flag
 
-def type_of_question(question):
+def loading():
+    '''
+    function that returns True while the data is read in the background, the post
+    endpoints do not accept jobs until the data is loaded
+    '''
+    return webserver.data_ingestor is None
+
+def job_status(state):
+    '''
+    get the status of a job as shown to the clients: the queued jobs are shown as running
+    and the failed ones as error
+    '''
+    if state == DONE:
+        return 'done'
+    if state == FAILED:
+        return 'error'
+    return 'running'
+
+def sync_mode(data):
+    '''
+    checks whether the client asked for the job to be computed synchronously, with "sync" in
+    the request body or the sync query parameter; if it did not, the server config decides
+    '''
+    sync = data.get('sync', request.args.get('sync'))
+    if sync is None:
+        return webserver.tasks_runner.sync_default
+    return sync in (True, 1, '1', 'true')
+
+def query_key(endpoint, question, state, data):
+    '''
+    returns the key of the job for a query and None or the error if the query is invalid;
+    the key of a top_k query also has its (k, order, level) parameters, read from the
+    request data, with the defaults for the missing ones
+    '''
+    key = (endpoint, question, state)
+    error = op.validate_query(endpoint, question, state, webserver.data_ingestor)
+    if error is None and endpoint == 'top_k':
+        k, order, level = op.TOP_K_DEFAULTS
+        params = (data.get('k', k), data.get('order', order), data.get('level', level))
+        error = op.validate_top_k(*params)
+        key = key + (params,)
+    return key, error
+
+def with_job_id(body, job_id):
+    '''
+    returns the encoded response of a done job with the job_id added as its last key
+    '''
+    return body[:-2] + b',"job_id":' + str(job_id).encode('ascii') + b'}\n'
+
+def job_response(job, inline):
+    '''
+    returns the response for a submitted job: the job_id and, if the job was computed
+    synchronously (inline is True), also its status and result
+    '''
+    if not inline:
+        return jsonify({"job_id": job['job_id']})
+
+    state, data = webserver.tasks_runner.jobs.get(job['job_id'])
+    if state == FAILED:
+        return jsonify({"job_id": job['job_id'], 'status': 'error', 'reason': data})
+    return Response(with_job_id(data, job['job_id']), mimetype='application/json')
+
+def with_timings(response, timings):
+    '''
+    returns the json response, with the timings of the job if they were asked for
+    '''
+    if timings is not None:
+        response['timings'] = timings
+    return jsonify(response)
+
+def queue_full(name, error):
+    '''
+    returns the 429 response for a job rejected because the job queue is full, its
+    Retry-After header tells the client when to try again
+    '''
+
+    # create log message
+    webserver.my_logger.warning("%s request rejected, retry after %d seconds", name,
+    error.retry_after)
+
+    return (jsonify({'status': 'error', 'reason': 'Job queue is full'}), 429,
+            {'Retry-After': str(error.retry_after)})
+
+@webserver.before_request
+def start_timer():
     '''
-    get type of question: best is min or best is max question
+    keeps the time the request started at, for the request metrics and the timings of the
+    jobs it submits
     '''
-    if question in webserver.data_ingestor.questions_best_is_min:
-        return 'min'
-    return 'max'
+    g.started = monotonic()
+
+@webserver.after_request
+def count_request(response):
+    '''
+    counts the request and adds the time it took to the histogram of its endpoint, in the
+    metrics shard of the request thread
+    '''
+    endpoint = request.url_rule.rule if request.url_rule is not None else 'unknown'
+    metrics = webserver.tasks_runner.metrics
+    metrics.inc('http_requests_total', (('endpoint', endpoint), ('method', request.method),
+                                        ('status', response.status_code)))
+    metrics.observe('http_request_duration_seconds', (('endpoint', endpoint),),
+                    monotonic() - g.started)
+    return response
 
 # Example endpoint definition
 @webserver.route('/api/post_endpoint', methods=['POST'])
@@ -65,513 +178,471 @@ def get_jobs():
     '''
     server gets a get request that returns the status of all the jobs
     submitted to the thread pool until then
+
+    the optional start and limit query parameters return only a page of the jobs
     '''
 
+    start = request.args.get('start', 1, type=int)
+    limit = request.args.get('limit', None, type=int)
+
     result = {}
     result['status'] = 'done'
-    result['data'] = []
-
-    for job in range(1, webserver.job_counter):
-        # verify whether there is a file for the job_id
-        job_id = f"job_id_{job}"
-        if os.path.exists(f"results/{job_id}.json"):
-            result['data'].append({job_id: "done"})
-        else:
-            result['data'].append({job_id: "running"})
+    result['data'] = [{f"job_id_{job_id}": job_status(state)}
+                      for job_id, state in webserver.tasks_runner.jobs.page(start, limit)]
 
     # create log message
     webserver.my_logger.info("Get jobs request")
 
     return jsonify(result)
 
-@webserver.route('/api/num_jobs', methods=['GET'])
-def get_num_jobs():
+@webserver.route('/api/jobs/stream', methods=['GET'])
+def get_jobs_stream():
     '''
-    server gets get request that returns the number of jobs left to process
-    by the thread pool
-    '''
-
-    cnt = 0
+    server gets a get request that opens a Server-Sent Events stream with an event for every
+    job that is done or fails from now on
 
-    for job in range(1, webserver.job_counter):
-        # verify whether there is a file for the job_id
+    the optional job_ids query parameter (comma separated ids) keeps only the events of those
+    jobs, the ones that are already finished are sent right away and the stream ends after
+    the last of them; with results=1 the result of the job is sent in the event too
 
-        job_id = f"job_id_{job}"
+    the events are dropped while the client is too slow to read them, the jobs of job_ids are
+    looked up again in the job table when the stream is idle, so their events are not lost;
+    a job of job_ids that is not in the job table (never submitted or already evicted) gets
+    an error event with the Invalid job_id reason, so the stream does not wait for it
+    '''
 
-        if not os.path.exists(f"results/{job_id}.json"):
-            # stop counting when the first job that is not done is found
-            break
+    job_ids = request.args.get('job_ids')
+    if job_ids is not None:
+        try:
+            job_ids = {int(job_id) for job_id in job_ids.split(',') if job_id}
+        except ValueError:
+            # create log message
+            webserver.my_logger.error("Invalid job_ids %s", job_ids)
+            return jsonify({'status': 'error', 'reason': 'Invalid job_ids'}), 400
+    with_results = request.args.get('results') in ('1', 'true')
+
+    # subscribe before looking at the finished jobs, so no completion is missed
+    events = webserver.tasks_runner.subscribe()
+
+    def job_event(job_id, state, data):
+        '''
+        formats the completion of a job as a Server-Sent Event
+        '''
+        status = job_status(state)
+        if with_results and state == DONE:
+            # the encoded response of the job already has the data and the status
+            event = with_job_id(data, job_id)[:-1]
+        else:
+            event = {'job_id': job_id, 'status': status}
+            if with_results:
+                event['reason'] = data
+            event = dumps(event)
+        return f"event: {status}\ndata: {event.decode('utf-8')}\n\n"
+
+    def finished_jobs():
+        '''
+        generator of the events of the jobs of job_ids that are already finished or that
+        are not in the job table
+        '''
+        for job_id in sorted(job_ids):
+            state, data = webserver.tasks_runner.jobs.get(job_id)
+            if state is None:
+                job_ids.discard(job_id)
+                event = dumps({'job_id': job_id, 'status': 'error', 'reason': 'Invalid job_id'})
+                yield f"event: error\ndata: {event.decode('utf-8')}\n\n"
+            elif state in (DONE, FAILED):
+                job_ids.discard(job_id)
+                yield job_event(job_id, state, data)
+
+    def stream():
+        '''
+        generator of the events, it unsubscribes when the stream ends or the client leaves
+        '''
+        try:
+            if job_ids is not None:
+                yield from finished_jobs()
 
-        cnt += 1
+            while job_ids is None or job_ids:
+                try:
+                    job_id, state, data = events.get(timeout=KEEPALIVE)
+                except Empty:
+                    if job_ids is not None:
+                        yield from finished_jobs()
+                    yield ": keepalive\n\n"
+                    continue
+
+                if job_ids is not None:
+                    if job_id not in job_ids:
+                        continue
+                    job_ids.discard(job_id)
+                yield job_event(job_id, state, data)
+        finally:
+            webserver.tasks_runner.unsubscribe(events)
 
     # create log message
-    webserver.my_logger.info("Get number of jobs left to process request")
+    webserver.my_logger.info("Job stream opened")
 
-    return jsonify({"num_jobs": webserver.job_counter - cnt - 1})
+    return Response(stream(), mimetype='text/event-stream')
 
-@webserver.route('/api/get_results/<job_id>', methods=['GET'])
-def get_response(job_id):
+@webserver.route('/api/num_jobs', methods=['GET'])
+def get_num_jobs():
     '''
-    server gets a get request that returns the result of a job
+    server gets get request that returns the number of jobs left to process
+    by the thread pool
     '''
 
-    # if the job_counter is smaller or equal than the job_id, return invalid job_id
-    if int(job_id) >= webserver.job_counter:
-        # create log message
-        webserver.my_logger.error("Invalid job_id %s", job_id)
-        return jsonify({'status': 'error', 'reason': 'Invalid job_id'})
-
-    # if the job_counter is bigger than the job_id but the job is not done, return running status
-    # we verify if the job is done by checking if the file for the job_id is in the results folder
+    # create log message
+    webserver.my_logger.info("Get number of jobs left to process request")
 
-    # verify if the file of the corresponding job_id exists
-    if os.path.exists(f"results/job_id_{job_id}.json"):
-        try:
-            # open the file and load the data
-            with open(f"results/job_id_{job_id}.json", 'r', encoding='utf-8') as file:
-                try:
-                    data = json.load(file)
+    return jsonify({"num_jobs": webserver.tasks_runner.jobs.num_pending()})
 
-                    # create log message
-                    webserver.my_logger.info("Job_id_%s processed successfully", job_id)
+@webserver.route('/api/latency', methods=['GET'])
+def get_latency():
+    '''
+    server gets a get request that returns the scheduling policy of the thread pool and the
+    p50, p95 and p99 latencies, from submit to done, of the last jobs of every endpoint
+    '''
 
-                    return jsonify({'status': 'done', 'data': data})
-                except json.JSONDecodeError:
-                    # if not all the data was written to the file,
-                    # the json.load will raise an error because the data will
-                    # not be in json format
+    # create log message
+    webserver.my_logger.info("Get latency request")
 
-                    # create log message
-                    webserver.my_logger.error("Error reading job_id_%s.json", job_id)
+    return jsonify({'scheduler': webserver.tasks_runner.job_queue.policy,
+                    'endpoints': webserver.tasks_runner.latency.percentiles()})
 
-                    return jsonify({'status': 'running'})
-        except (FileNotFoundError, PermissionError, IOError):
-            # if opening the file raises an error, the job is still running
+@webserver.route('/api/ready', methods=['GET'])
+def get_ready():
+    '''
+    server gets a get request that returns whether the data is loaded and the number of
+    rows and bytes read so far; the status code is 503 until the data is loaded, so the
+    endpoint can be used as a readiness check
+    '''
+    progress = dict(webserver.ingest_progress)
+    progress['ready'] = not loading()
+    if not progress['ready']:
+        return jsonify(progress), 503
 
-            # create log message
-            webserver.my_logger.error("Error opening job_id_%s.json", job_id)
+    progress['ingest_stats'] = webserver.data_ingestor.ingest_stats
+    return jsonify(progress)
 
-            return jsonify({'status': 'running'})
+@webserver.route('/api/queue', methods=['GET'])
+def get_queue():
+    '''
+    server gets a get request that returns the depth and the cost of the job queue, their
+    limits (0 for no limit), the number of rejected jobs and the number of jobs finished
+    per second lately
+    '''
 
-    # if the file does not exist, the job is still running
     # create log message
-    webserver.my_logger.info("File job_id_%s.json does not exist yet", job_id)
+    webserver.my_logger.info("Get queue request")
 
-    return jsonify({'status': 'running'})
+    return jsonify(webserver.tasks_runner.queue_stats())
 
-@webserver.route('/api/states_mean', methods=['POST'])
-def states_mean_request():
+@webserver.route('/api/metrics', methods=['GET'])
+def get_metrics():
     '''
-    extracts the data needed for solving the post request
-    creates a job and submits it to the thread pool
+    server gets a get request that returns the metrics of the server in the prometheus
+    text format: the requests and their latencies by endpoint, the wait and run times of
+    the jobs, the queue, the time every TaskRunner spent busy and idle, the job table and
+    the cache sizes and the ingestion stats
     '''
+    pool = webserver.tasks_runner
+    gauges = pool.gauges()
+    gauges.append(('di_rows_read', (), webserver.ingest_progress['rows']))
 
-    if shutting_down():
-        # if the the thread pool is shutting down, it will not accept any more jobs
-        return jsonify({'job_id': -1, 'reason': 'Shutting down'})
+    return Response(render(pool.metrics.collect(), gauges),
+                    mimetype='text/plain; version=0.0.4')
 
-    # Get request data
-    data = request.json
-
-    # extract the question from the request
-    question = data[QUESTION]
-
-    # get the data for the job based on the question
-    data_for_job, _ = op.get_job_data_for_question(question, webserver.data_ingestor.state_data)
+@webserver.route('/api/profile', methods=['GET'])
+def get_profile():
+    '''
+    server gets a get request that samples the stacks of the request threads and of the
+    TaskRunners for the given seconds (at most MAX_PROFILE) and returns them in the collapsed
+    format of the flame graph tools
 
-    # create the job as a dictionary
-    job = {
-        'job_id': webserver.job_counter,
-        'operation': op.states_means(),
-        'data': data_for_job
-    }
+    the optional interval query parameter is the number of seconds between two samples and
+    with workers=1 only the TaskRunners are sampled; one profile runs at a time, a request
+    made while another profile is running gets a 409 error
+    '''
+    seconds = min(request.args.get('seconds', 5, type=float), MAX_PROFILE)
+    interval = max(request.args.get('interval', 0.01, type=float), MIN_INTERVAL)
+    idents = None
+    if request.args.get('workers', 0, type=int):
+        idents = {thread.ident for thread in webserver.tasks_runner.threads}
 
-    # submit job
-    webserver.tasks_runner.submit(job)
+    if not profile_lock.acquire(blocking=False):
+        return jsonify({'status': 'error', 'reason': 'A profile is already running'}), 409
 
     # create log message
-    webserver.my_logger.info("States mean request submitted as job with id %d",
-    webserver.job_counter)
+    webserver.my_logger.info("Profiling for %.1f seconds", seconds)
+    try:
+        stacks = sample_stacks(seconds, interval, idents)
+    finally:
+        profile_lock.release()
 
-    # Increment job_id counter
-    webserver.job_counter += 1
+    return Response(collapse(stacks), mimetype='text/plain')
 
-    # Return associated job_id
-    return jsonify({"job_id": webserver.job_counter - 1})
-
-@webserver.route('/api/state_mean', methods=['POST'])
-def state_mean_request():
+@webserver.route('/api/get_results/<job_id>', methods=['GET'])
+def get_response(job_id):
     '''
-    extracts de data needed for solving the post request
-    creates a job and submits it to the thread pool
+    server gets a get request that returns the result of a job
+
+    with the optional wait query parameter the request waits up to that many seconds
+    (at most MAX_WAIT) for the job to finish instead of returning the running status
+    right away
+
+    with timings=1 the response also has the times, in seconds since the request that
+    submitted the job was received, of the stages the job went through so far
     '''
 
-    if shutting_down():
-        # if the the thread pool is shutting down, it will not accept any more jobs
-        return jsonify({'job_id': -1, 'reason': 'Shutting down'})
+    wait = min(request.args.get('wait', 0, type=float), MAX_WAIT)
+    if wait > 0:
+        state, data = webserver.tasks_runner.jobs.wait(int(job_id), wait)
+    else:
+        state, data = webserver.tasks_runner.jobs.get(int(job_id))
 
-    # get request data
-    data = request.json
+    timings = None
+    if request.args.get('timings', 0, type=int):
+        timings = webserver.tasks_runner.jobs.timings(int(job_id))
 
-    # extract the question and state from the request
-    question = data[QUESTION]
-    state = data[STATE]
+    # if the job is not in the job table, return invalid job_id
+    if state is None:
+        # create log message
+        webserver.my_logger.error("Invalid job_id %s", job_id)
+        return jsonify({'status': 'error', 'reason': 'Invalid job_id'})
 
-    # get the data for the job based on the question and state
-    data_for_job = op.get_job_data_for_state(question, state, webserver.data_ingestor.state_data)
+    if state == DONE:
+        # create log message
+        webserver.my_logger.info("Job_id_%s processed successfully", job_id)
 
-    # if the data_for_job contains a status key, it means that the state or question is invalid
-    if 'status' in data_for_job:
-        # create a log message
-        webserver.my_logger.error("State mean request failed with error %s",
-        {data_for_job['status']})
-        return jsonify(data_for_job)
+        # the response was encoded when the job finished, the timings are added as its
+        # last key, since the keys are sorted
+        if timings is not None:
+            data = data[:-2] + b',"timings":' + dumps(timings) + b'}\n'
+        return Response(data, mimetype='application/json')
 
-    # create job as a dictionary
-    job = {
-        'job_id': webserver.job_counter,
-        'operation': op.state_mean(),
-        'data': data_for_job
-    }
+    if state == FAILED:
+        # create log message
+        webserver.my_logger.error("Job_id_%s failed with error %s", job_id, data)
 
-    # submit job to the thread pool
-    webserver.tasks_runner.submit(job)
+        return with_timings({'status': 'error', 'reason': data}, timings)
 
+    # if the job is queued or running, return running status
     # create log message
-    webserver.my_logger.info("State mean request submitted as job with id %d",
-    webserver.job_counter)
-
-    # Increment job_id counter
-    webserver.job_counter += 1
+    webserver.my_logger.info("Job_id_%s is still running", job_id)
 
-    # Return associated job_id
-    return jsonify({"job_id": webserver.job_counter - 1})
+    return with_timings({'status': 'running'}, timings)
 
-@webserver.route('/api/best5', methods=['POST'])
-def best5_request():
+def submit_query(endpoint, name, with_state = False):
     '''
-    extracts de data needed for solving the post request
-    creates a job and submits it to the thread pool
+    common part of the post endpoints: reads the question (and the state if with_state is
+    True) from the request, creates a job and submits it to the thread pool
+
+    the job carries only its (endpoint, question, state) key, its data is extracted by the
+    TaskRunner that computes it, so the request does the same small amount of work for every
+    endpoint; the state and question are checked here, with the aggregate index
     '''
 
     if shutting_down():
         # if the the thread pool is shutting down, it will not accept any more jobs
         return jsonify({'job_id': -1, 'reason': 'Shutting down'})
 
+    if loading():
+        # the job cannot be checked until the data is read, the client should retry later
+        webserver.my_logger.warning("Request rejected, the data is not loaded yet")
+        return jsonify({'status': 'error', 'reason': 'Not ready'}), 503, {'Retry-After': '1'}
+
     # get request data
     data = request.json
 
-    # extract the question from the request
+    # extract the question and the state from the request
     question = data[QUESTION]
+    state = data[STATE] if with_state else None
 
-    # get the data for the job based on the question
-    data_for_job, _ = op.get_job_data_for_question(question, webserver.data_ingestor.state_data)
-
-    # based on the type of question, we will use the best5 or worst5 operation
-    # the types of questions are defined in the data_ingestor.py file
-    question_type = type_of_question(question)
-
-    if question_type == 'min':
-        operation = op.best5()
-    else:
-        operation = op.worst5()
+    # if the state, question or parameters are invalid, return the error instead of a job_id
+    key, error = query_key(endpoint, question, state, data)
+    if error is not None:
+        # create a log message
+        webserver.my_logger.error("%s request failed with error %s", name, error['status'])
+        return jsonify(error)
 
-    # create job as a dictionary
+    # create the job as a dictionary, with the time the request was received
     job = {
-        'job_id': webserver.job_counter,
-        'operation': operation,
-        'data': data_for_job
+        'key': key,
+        'received': g.started
     }
 
-    # submit job to the thread pool
-    webserver.tasks_runner.submit(job)
+    # submit job, it gets its job_id from the thread pool once it is admitted and it is
+    # computed right away if the client asked for a synchronous answer
+    # a 429 error is returned instead if the job queue is full
+    sync = sync_mode(data)
+    try:
+        done = webserver.tasks_runner.submit(job, sync)
+    except QueueFullError as error:
+        return queue_full(name, error)
 
     # create log message
-    webserver.my_logger.info("Best5 request submitted as job with id %d",
-    webserver.job_counter)
-
-    # Increment job_id counter
-    webserver.job_counter += 1
+    webserver.my_logger.info("%s request submitted as job with id %d", name, job['job_id'])
 
     # Return associated job_id
-    return jsonify({"job_id": webserver.job_counter - 1})
+    return job_response(job, sync and done)
 
-@webserver.route('/api/worst5', methods=['POST'])
-def worst5_request():
+@webserver.route('/api/states_mean', methods=['POST'])
+def states_mean_request():
     '''
-    extracts de data needed for solving the post request
-    creates a job and submits it to the thread pool
+    creates a states_mean job and submits it to the thread pool
     '''
+    return submit_query('states_mean', "States mean")
 
-    if shutting_down():
-        # if the the thread pool is shutting down, it will not accept any more jobs
-        return jsonify({'job_id': -1, 'reason': 'Shutting down'})
-
-    # get request data
-    data = request.json
-
-    # extract the question from the request
-    question = data[QUESTION]
-
-    # get the data for the job based on the question
-    data_for_job, _ = op.get_job_data_for_question(question, webserver.data_ingestor.state_data)
-
-    # based on the type of question, we will use the best5 or worst5 operation
-    question_type = type_of_question(question)
-    if question_type == 'min':
-        operation = op.worst5()
-    else:
-        operation = op.best5()
-
-    # create job as a dictionary
-    job = {
-        'job_id': webserver.job_counter,
-        'operation': operation,
-        'data': data_for_job
-    }
-
-    # submit job to the thread pool
-    webserver.tasks_runner.submit(job)
+@webserver.route('/api/state_mean', methods=['POST'])
+def state_mean_request():
+    '''
+    creates a state_mean job and submits it to the thread pool
+    '''
+    return submit_query('state_mean', "State mean", with_state=True)
 
-    # create log message
-    webserver.my_logger.info("Worst5 request submitted as job with id %d",
-    webserver.job_counter)
+@webserver.route('/api/best5', methods=['POST'])
+def best5_request():
+    '''
+    creates a best5 job and submits it to the thread pool
+    '''
+    return submit_query('best5', "Best5")
 
-    # Increment job_id counter
-    webserver.job_counter += 1
+@webserver.route('/api/worst5', methods=['POST'])
+def worst5_request():
+    '''
+    creates a worst5 job and submits it to the thread pool
+    '''
+    return submit_query('worst5', "Worst5")
 
-    # Return associated job_id
-    return jsonify({"job_id": webserver.job_counter - 1})
+@webserver.route('/api/top_k', methods=['POST'])
+def top_k_request():
+    '''
+    creates a top_k job and submits it to the thread pool: the k states with the best
+    means, or worst, lowest or highest ones given by order, for all the values of the
+    question or, with level stratification, separately for every stratification
+    '''
+    return submit_query('top_k', "Top k")
 
 @webserver.route('/api/global_mean', methods=['POST'])
 def global_mean_request():
     '''
-    extracts de data needed for solving the post request
-    creates a job and submits it to the thread pool
+    creates a global_mean job and submits it to the thread pool
     '''
-
-    if shutting_down():
-        # if the the thread pool is shutting down, it will not accept any more jobs
-        return jsonify({'job_id': -1, 'reason': 'Shutting down'})
-
-    # get request data
-    data  = request.json
-
-    # extract the question from the request
-    question = data[QUESTION]
-
-    # get global data needed for the job
-    _, data_for_job = op.get_job_data_for_question(question, webserver.data_ingestor.state_data,
-    global_data=True, normal_data=False)
-
-    # create job as a dictionary
-    job = {
-        'job_id': webserver.job_counter,
-        'operation': op.global_mean(),
-        'data': data_for_job
-    }
-
-    # submit job to the thread pool
-    webserver.tasks_runner.submit(job)
-
-    # create log message
-    webserver.my_logger.info("Global mean request submitted as job with id %d",
-    webserver.job_counter)
-
-    # Increment job_id counter
-    webserver.job_counter += 1
-
-    # Return associated job_id
-    return jsonify({"job_id": webserver.job_counter - 1})
+    return submit_query('global_mean', "Global mean")
 
 @webserver.route('/api/diff_from_mean', methods=['POST'])
 def diff_from_mean_request():
     '''
-    extracts de data needed for solving the post request
-    creates a job and submits it to the thread pool
+    creates a diff_from_mean job and submits it to the thread pool
     '''
-
-    if shutting_down():
-        # if the the thread pool is shutting down, it will not accept any more jobs
-        return jsonify({'job_id': -1, 'reason': 'Shutting down'})
-
-    # get request data
-    data = request.json
-
-    # extract the question from the request
-    question = data[QUESTION]
-
-    # get the data for each state and the global data needed for the job
-    data_for_job, data_for_global = op.get_job_data_for_question(question,
-    webserver.data_ingestor.state_data, global_data=True)
-
-    # create job as a dictionary
-    job = {
-        'job_id': webserver.job_counter,
-        'operation': op.diff_from_mean(),
-        'data': data_for_job,
-        'global_operation': op.global_mean(),
-        'global_data': data_for_global
-    }
-
-    # submit job to the thread pool
-    webserver.tasks_runner.submit(job)
-
-    # create log message
-    webserver.my_logger.info("Diff from mean request submitted as job with id %d",
-    webserver.job_counter)
-
-    # Increment job_id counter
-    webserver.job_counter += 1
-
-    return jsonify({"job_id": webserver.job_counter - 1})
+    return submit_query('diff_from_mean', "Diff from mean")
 
 @webserver.route('/api/state_diff_from_mean', methods=['POST'])
 def state_diff_from_mean_request():
     '''
-    extracts de data needed for solving the post request
-    creates a job and submits it to the thread pool
+    creates a state_diff_from_mean job and submits it to the thread pool
     '''
-
-    if shutting_down():
-        # if the the thread pool is shutting down, it will not accept any more jobs
-        return jsonify({'job_id': -1, 'reason': 'Shutting down'})
-
-    # get request data
-    data = request.json
-
-    # extract the question and state from the request
-    question = data[QUESTION]
-    state = data[STATE]
-
-    # get the data for the job based on the question and state
-    data_for_job = op.get_job_data_for_state(question, state, webserver.data_ingestor.state_data)
-
-    # if the data_for_job contains a status key, it means that the state or question is invalid
-    if 'status' in data_for_job:
-        # create log message
-        webserver.my_logger.error("State diff from mean request failed with error %s",
-        data_for_job['status'])
-        return jsonify(data_for_job)
-
-    # get the global data needed for the job
-    _, data_for_global = op.get_job_data_for_question(question, webserver.data_ingestor.state_data,
-    global_data=True, normal_data=False)
-
-    # create job as a dictionary
-    job = {
-        'job_id': webserver.job_counter,
-        'operation': op.diff_from_mean(),
-        'data': data_for_job,
-        'global_operation': op.global_mean(),
-        'global_data': data_for_global
-    }
-
-    # submit job to the thread pool
-    webserver.tasks_runner.submit(job)
-
-    # create log message
-    webserver.my_logger.info("State diff from mean request submitted as job with id %d",
-    webserver.job_counter)
-
-    # Increment job_id counter
-    webserver.job_counter += 1
-
-    # Return associated job_id
-    return jsonify({"job_id": webserver.job_counter - 1})
+    return submit_query('state_diff_from_mean', "State diff from mean", with_state=True)
 
 @webserver.route('/api/mean_by_category', methods=['POST'])
 def mean_by_category_request():
     '''
-    extracts de data needed for solving the post request
-    creates a job and submits it to the thread pool
+    creates a mean_by_category job and submits it to the thread pool
+    '''
+    return submit_query('mean_by_category', "Mean by category")
+
+@webserver.route('/api/state_mean_by_category', methods=['POST'])
+def state_mean_by_category_request():
+    '''
+    creates a state_mean_by_category job and submits it to the thread pool
+    '''
+    return submit_query('state_mean_by_category', "State mean by category", with_state=True)
+
+@webserver.route('/api/batch', methods=['POST'])
+def batch_request():
+    '''
+    gets a list of sub-queries, each one with an endpoint, a question and a state for the
+    endpoints that need it, and submits all of them to the thread pool as a single job
+
+    the TaskRunner plans the sub-queries on the same question together, so the data of the
+    question is extracted and aggregated only once; every sub-query gets its own job_id and
+    its result is the same as the result of the endpoint it names
     '''
 
     if shutting_down():
         # if the the thread pool is shutting down, it will not accept any more jobs
         return jsonify({'job_id': -1, 'reason': 'Shutting down'})
 
+    if loading():
+        # the job cannot be checked until the data is read, the client should retry later
+        webserver.my_logger.warning("Request rejected, the data is not loaded yet")
+        return jsonify({'status': 'error', 'reason': 'Not ready'}), 503, {'Retry-After': '1'}
+
     # get request data
     data = request.json
 
-    # extract the question from the request
-    question = data[QUESTION]
-
-    # get the data for the job based on the question
-    data_for_job = op.get_job_data_for_categories(question, webserver.data_ingestor.state_data)
+    # check all the sub-queries before submitting any of them
+    jobs = []
+    for query in data['queries']:
+        key, error = query_key(query.get('endpoint'), query[QUESTION], query.get(STATE), query)
 
-    # if the data_for_job contains a status key, it means that the state or question is invalid
-    if 'status' in data_for_job:
-        # create log message
-        webserver.my_logger.error("Mean by category request failed with error %s",
-        data_for_job['status'])
-        return jsonify(data_for_job)
-
-    # create job as a dictionary
-    job = {
-        'job_id': webserver.job_counter,
-        'operation': op.category_means(),
-        'data': data_for_job
-    }
+        # if there is an error, the sub-query is invalid
+        if error is not None:
+            # create log message
+            webserver.my_logger.error("Batch request failed with error %s", error['status'])
+            return jsonify(error)
+        jobs.append({'key': key, 'received': g.started})
 
-    # submit job to the thread pool
-    webserver.tasks_runner.submit(job)
+    # submit the batch as a single job to the thread pool, every sub-query gets its job_id
+    # once the batch is admitted, a 429 error is returned instead if the job queue is full
+    try:
+        webserver.tasks_runner.submit({'batch': list(jobs)})
+    except QueueFullError as error:
+        return queue_full("Batch", error)
 
     # create log message
-    webserver.my_logger.info("Mean by category request submitted as job with id %d",
-    webserver.job_counter)
-
-    # Increment job_id counter
-    webserver.job_counter += 1
+    webserver.my_logger.info("Batch request submitted as %d jobs", len(jobs))
 
-    return jsonify({"job_id": webserver.job_counter - 1})
+    return jsonify({"job_ids": [job['job_id'] for job in jobs]})
 
-@webserver.route('/api/state_mean_by_category', methods=['POST'])
-def state_mean_by_category_request():
+@webserver.route('/api/ingest', methods=['POST'])
+def ingest_request():
     '''
-    extracts de data needed for solving the post request
-    creates a job and submits it to the thread pool
-    '''
-    if shutting_down():
-        # if the the thread pool is shutting down, it will not accept any more jobs
-        return jsonify({'job_id': -1, 'reason': 'Shutting down'})
+    server gets a post request with new csv rows, with the same header as the csv file, and
+    adds them to the data without a restart
 
-    # get request data
-    data = request.json
-
-    # extract the question and state from the request
-    question = data[QUESTION]
-    state = data[STATE]
-
-    # get the data for the job based on the question and state
-    data_for_job = op.get_job_data_for_categ_per_state(question, state,
-    webserver.data_ingestor.state_data)
+    the rows are added to a new version of the data that replaces the current one, the jobs
+    that are running finish with the data they started with and the cached results for
+    the questions of the new rows are dropped
+    '''
 
-    # if the data_for_job contains a status key, it means that the state or question is invalid
-    if 'status' in data_for_job:
+    if shutting_down():
+        # if the the thread pool is shutting down, it will not accept any more rows
+        return jsonify({'status': 'error', 'reason': 'Shutting down'})
+
+    if loading():
+        # the rows cannot be added until the data is read, the client should retry later
+        return jsonify({'status': 'error', 'reason': 'Not ready'}), 503, {'Retry-After': '1'}
+
+    # parse the rows and add them, all or none of them are added
+    try:
+        rows = list(parse_rows(request.get_data(as_text=True).splitlines()))
+        data_ingestor = webserver.tasks_runner.ingest(rows)
+    except (KeyError, ValueError) as error:
         # create log message
-        webserver.my_logger.error("State mean by category request failed with error %s",
-        data_for_job['status'])
-        return jsonify(data_for_job)
-
-    # create job as a dictionary
-    job = {
-       'job_id': webserver.job_counter,
-       'operation': op.state_mean_by_category(),
-       'data': data_for_job
-    }
-
-    # submit job to the thread pool
-    webserver.tasks_runner.submit(job)
+        webserver.my_logger.error("Ingest request failed with error %s", error)
+        return jsonify({'status': 'error', 'reason': str(error)}), 400
 
-    # Increment job_id counter
-    webserver.job_counter += 1
+    # the routes check the queries with the latest version of the data
+    with webserver.tasks_runner.ingest_lock:
+        webserver.data_ingestor = webserver.tasks_runner.data_ingestor
 
     # create log message
-    webserver.my_logger.info("State mean by category request submitted as job with id %d",
-    webserver.job_counter)
+    webserver.my_logger.info("Ingested %d rows, data version %d", len(rows),
+    data_ingestor.version)
 
-    return jsonify({"job_id": webserver.job_counter - 1})
+    return jsonify({'status': 'done', 'rows': len(rows), 'version': data_ingestor.version,
+                    'questions': sorted({row[1] for row in rows})})
 
 # You can check localhost in your browser to see what this displays
 @webserver.route('/')
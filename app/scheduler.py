@@ -0,0 +1,139 @@
+'''
+scheduler.py
+'''
+from collections import deque
+from heapq import heappush, heappop
+from itertools import count
+from queue import Queue
+from threading import Lock
+from time import monotonic
+from typing import Callable, TypedDict
+
+# scheduling policies of the JobScheduler
+FIFO = 'fifo'
+SJF = 'sjf'
+
+class Job(TypedDict, total=False):
+    '''
+    the keys a job can have, a job is a plain dictionary with only some of them: the route
+    gives the key (or the batch), the ThreadPool adds the job_id, the cost and the timings
+    once the job is admitted and the ResultCache the followers of the job
+
+    a job with a key has its operation and data planned by the TaskRunner, a job built by
+    plan_query has them from the start
+    '''
+    # the (endpoint, question, state) of the query, with the (k, order, level) of a top_k
+    key: tuple
+    # the jobs computed one after the other by the same TaskRunner
+    batch: list
+    job_id: int
+    # the estimated cost the scheduler orders the jobs by
+    cost: int
+    # the monotonic() time the route got the request
+    received: float
+    # the monotonic() times of the stages of the job, shared with the job table
+    timings: dict
+    # the job_ids of the identical jobs attached to this one and the cache version it read
+    followers: list
+    cache_version: int
+    # the operations and their data, the global ones only for the diff_from_mean endpoints
+    operation: Callable
+    data: dict
+    global_operation: Callable
+    global_data: dict
+    # the reason the query is invalid, set only in the dictionary plan_query returns
+    status: str
+
+class JobScheduler(Queue):
+    '''
+    job queue that can give the jobs in shortest job first order instead of FIFO order,
+    so a few expensive jobs do not delay many cheap ones
+
+    it is a Queue that keeps the jobs in a heap, the same way PriorityQueue does, so
+    put(), get(), task_done() and join() work like for the plain job queue
+    '''
+    def __init__(self, policy = SJF, aging = 0.00001, maxsize = 0):
+        '''
+        with the sjf policy the priority of a job is the time it was queued plus its cost
+        multiplied by aging (seconds per unit of cost): cheap jobs go first, but an expensive
+        job is not starved, since every job queued later gets a later time
+        '''
+        self.policy = policy
+        self.aging = aging
+        super().__init__(maxsize)
+
+    def _init(self, maxsize):
+        '''
+        the heap of (priority, sequence number, job) entries, the sequence number keeps the
+        FIFO order between jobs with the same priority
+        '''
+        self.heap = []
+        self.sequence = count()
+
+        # the sum of the costs of the queued jobs
+        self.queued_cost = 0
+
+    def _qsize(self):
+        return len(self.heap)
+
+    def _put(self, item: Job):
+        sequence = next(self.sequence)
+        if self.policy == SJF:
+            priority = monotonic() + item.get('cost', 0) * self.aging
+        else:
+            priority = sequence
+        heappush(self.heap, (priority, sequence, item))
+        self.queued_cost += item.get('cost', 0)
+
+    def _get(self):
+        item = heappop(self.heap)[2]
+        self.queued_cost -= item.get('cost', 0)
+        return item
+
+class LatencyStats:
+    '''
+    keeps the latencies (from submit to done) of the last window jobs of every endpoint
+    '''
+    def __init__(self, window = 1000):
+        '''
+        the latencies of every endpoint are kept in a deque of at most window items
+        '''
+        self.window = window
+        self.samples = {}
+        self.lock = Lock()
+
+    def record(self, endpoint, seconds):
+        '''
+        adds the latency of a job of the endpoint
+        '''
+        with self.lock:
+            if endpoint not in self.samples:
+                self.samples[endpoint] = deque(maxlen=self.window)
+            self.samples[endpoint].append(seconds)
+
+    def percentiles(self):
+        '''
+        returns, for every endpoint, the number of samples and the p50, p95 and p99
+        latencies in seconds
+        '''
+        with self.lock:
+            samples = {endpoint: sorted(values) for endpoint, values in self.samples.items()}
+
+        return {
+            endpoint: {
+                'count': len(values),
+                'p50': percentile(values, 50),
+                'p95': percentile(values, 95),
+                'p99': percentile(values, 99)
+            }
+            for endpoint, values in samples.items()
+        }
+
+def percentile(values, rank):
+    '''
+    nearest rank percentile of a sorted list of values
+    '''
+    if not values:
+        return None
+    index = max(0, -(-len(values) * rank // 100) - 1)
+    return values[index]
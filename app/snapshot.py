@@ -0,0 +1,95 @@
+'''
+snapshot.py
+'''
+import pickle
+from hashlib import blake2b
+from os import stat, replace, remove
+from struct import Struct, error as StructError
+from app.columnar import ColumnarStore
+
+# the start of a snapshot file: the magic bytes and the offset and length of the header
+MAGIC = b'DISNAP01'
+PREFIX = Struct('<8sQQ')
+
+# the columns of a columnar snapshot start after the prefix, at this offset
+COLUMNS_OFFSET = 64
+
+def source_key(csv_path):
+    '''
+    returns the key of the csv file a snapshot is valid for: its size, its modification time
+    and the hash of its content
+    '''
+    info = stat(csv_path)
+    digest = blake2b()
+    with open(csv_path, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            digest.update(block)
+    return {'size': info.st_size, 'mtime_ns': info.st_mtime_ns, 'hash': digest.hexdigest()}
+
+def write_snapshot(path, key, ingestor):
+    '''
+    writes the parsed data and the indexes of the ingestor to the snapshot file
+
+    the file starts with the prefix, then come the columns of the columnar store (if the
+    ingestor has one), written by ColumnarStore.dump() so they can be mapped back, and
+    the pickled header with the key, the state_data and the indexes
+
+    the snapshot is written to a temporary file that replaces the old one at the end, so a
+    server that has the old one mapped keeps its data and a crash leaves no half written file
+    '''
+    header = {
+        'key': key,
+        'columnar': ingestor.columnar is not None,
+        'state_data': ingestor.state_data,
+        'aggregates': ingestor.aggregates,
+        'row_counts': ingestor.row_counts
+    }
+
+    temp_path = f"{path}.tmp"
+    try:
+        with open(temp_path, 'wb') as file:
+            file.seek(COLUMNS_OFFSET)
+            if ingestor.columnar is not None:
+                header['layout'] = ingestor.columnar.dump(file)
+                header['tables'] = ingestor.columnar.tables
+
+            data = pickle.dumps(header, protocol=pickle.HIGHEST_PROTOCOL)
+            header_offset = file.tell()
+            file.write(data)
+
+            file.seek(0)
+            file.write(PREFIX.pack(MAGIC, header_offset, len(data)))
+        replace(temp_path, path)
+    except OSError:
+        try:
+            remove(temp_path)
+        except OSError:
+            pass
+        raise
+
+def read_snapshot(path, key, columnar):
+    '''
+    returns the header of the snapshot file, with the mapped columnar store as 'store' (or
+    None if the snapshot has no columns), if the snapshot was written for the csv file with
+    the given key and in the same mode (columnar or not), otherwise returns None
+
+    the snapshot is written by the server itself, a missing or damaged file is not an error,
+    the data is read from the csv file instead
+    '''
+    try:
+        with open(path, 'rb') as file:
+            magic, header_offset, header_length = PREFIX.unpack(file.read(PREFIX.size))
+            if magic != MAGIC:
+                return None
+            file.seek(header_offset)
+            header = pickle.loads(file.read(header_length))
+    except (OSError, EOFError, ValueError, pickle.UnpicklingError, AttributeError, StructError):
+        return None
+
+    if header['key'] != key or header['columnar'] != columnar:
+        return None
+
+    header['store'] = None
+    if columnar:
+        header['store'] = ColumnarStore.map(path, header['layout'], header['tables'])
+    return header
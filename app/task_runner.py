@@ -1,43 +1,207 @@
 '''
 task_runner.py
 '''
-from queue import Queue
-from threading import Thread, Event, Condition
+from collections import deque
+from itertools import count
+from math import ceil
+from queue import Queue, Full
+from threading import Thread, Event, Condition, Lock
+from time import monotonic
 from os import cpu_count, environ, makedirs
-import json
-from app.my_logging import CustomLogging
+from app.json_codec import dumps, encode_response
+from app.my_logging import get_logger
+from app.result_cache import ResultCache
+from app.job_table import JobTable
+from app.metrics import Metrics
+from app.scheduler import Job, JobScheduler, LatencyStats, SJF
+import app.operations as op
+
+def write_result(job_id, res):
+    '''
+    writes the result of a job to results/job_id_<job_id>.json
+    '''
+    try:
+        with open(f"results/job_id_{job_id}.json", 'wb') as file:
+            file.write(dumps(res))
+    except OSError as error:
+        # create a log message
+        get_logger().error("Failed to write to file: %s", error)
+        exit(1)
+
+def data_cost(data):
+    '''
+    counts the values (or partial aggregates) in the data of a job
+    '''
+    if isinstance(data, dict):
+        return sum(data_cost(value) for value in data.values())
+    if isinstance(data, list):
+        return len(data)
+    return 1
+
+def job_cost(job: Job):
+    '''
+    estimates the cost of a job as the number of values its operations read, the jobs that
+    carry only their key have the cost estimated by the ThreadPool when they are submitted
+    '''
+    if 'batch' in job:
+        return sum(job_cost(sub_job) for sub_job in job['batch'])
+    if 'cost' in job:
+        return job['cost']
+    return data_cost(job['data']) + data_cost(job.get('global_data', {}))
+
+def run_job(job: Job, ingestor = None, plan = None):
+    '''
+    computes the result of a job
+
+    a job that carries only its (endpoint, question, state) key gets its data extracted
+    here, from the ingestor, with plan shared by the jobs of a batch; the key of a job with
+    parameters (top_k) has them as a fourth item
+    '''
+    if 'operation' not in job:
+        endpoint, question, state, *params = job['key']
+        job = op.plan_query(endpoint, question, state, ingestor, plan, *params)
+        if 'status' in job:
+            raise ValueError(job['status'])
+
+    # depending on the type of operation needed for the job
+    if 'global_operation' in job:
+        return job['operation'](job['data'], job['global_operation'](job['global_data']))
+    return job['operation'](job['data'])
+
+def computed_timings(job):
+    '''
+    the times the job was taken from the queue and computed, shared with the identical
+    jobs that were attached to it
+    '''
+    return {stage: job['timings'][stage] for stage in ('dequeued', 'compute_start',
+            'compute_end') if stage in job['timings']}
+
+def slow_job_report(timings):
+    '''
+    the seconds a job spent in the route, in the queue, waiting for the other jobs taken
+    with it, computing and storing its result
+    '''
+    phases = (('route', 'received', 'submitted'), ('queue', 'submitted', 'dequeued'),
+              ('batch', 'dequeued', 'compute_start'), ('compute', 'compute_start', 'compute_end'),
+              ('store', 'compute_end', 'stored'), ('persist', 'stored', 'persisted'))
+    return ', '.join(f"{name} {timings[end] - timings[start]:.3f} s"
+                     for name, start, end in phases if start in timings and end in timings)
+
+class QueueFullError(Exception):
+    '''
+    raised by ThreadPool.submit() when the job queue is full, retry_after is the estimated
+    number of seconds until there is room for the job
+    '''
+    def __init__(self, retry_after):
+        super().__init__(f"job queue is full, retry after {retry_after} seconds")
+        self.retry_after = retry_after
 
 class ThreadPool:
     '''
     class that defines a ThreadPool
     '''
-    def __init__(self):
+    def __init__(self, data_ingestor = None):
         '''
         implement a ThreadPool of TaskRunners
+
+        the jobs that carry only their key are computed over the data of data_ingestor
         '''
+        self.data_ingestor = data_ingestor
 
         # get the value of environment variable TP_NUM_OF_THREADS is defined,
         # otherwise use what the hardware concurrency allows with
         # the cpu_count() function
-        self.num_threads = environ.get('TP_NUM_OF_THREADS', cpu_count())
+        self.num_threads = int(environ.get('TP_NUM_OF_THREADS', cpu_count()))
 
         # declare the job queue, the event to signal the shutdown of the thread pool,
         # the condition variable to signal the availability of a job in the queue
-        self.job_queue = Queue()
+        # the queue gives the jobs in the order of the TP_SCHEDULER policy: sjf (shortest
+        # job first, with TP_AGING seconds of delay per unit of cost) or fifo
+        self.job_queue = JobScheduler(environ.get('TP_SCHEDULER', SJF),
+                                      float(environ.get('TP_AGING', 0.00001)))
         self.shutdown_event = Event()
         self.job_available = Condition()
 
         # The pool of threads:
-        # create self.num_threads number of threads
-        self.threads = [TaskRunner(self.shutdown_event, self.job_available, self.job_queue)
-        for _ in range(self.num_threads)]
+        # create self.num_threads number of threads, named TaskRunner-<index> in the metrics
+        self.threads = [TaskRunner(self.shutdown_event, self.job_available, self.job_queue,
+        self) for _ in range(self.num_threads)]
+        for index, thread in enumerate(self.threads):
+            thread.name = f'TaskRunner-{index}'
+
+        # the cache of the results of the jobs that have a key, with their encoded responses
+        # as (result, body) pairs, its size is given by the environment variable TP_CACHE_SIZE
+        self.cache = ResultCache(int(environ.get('TP_CACHE_SIZE', 128)))
+
+        # the state and the result of the submitted jobs, only the last TP_MAX_JOBS finished
+        # jobs are kept and only while their encoded results take at most TP_MAX_RESULT_BYTES
+        # (0 for no limit)
+        self.jobs = JobTable(int(environ.get('TP_MAX_JOBS', 100000)),
+                             int(environ.get('TP_MAX_RESULT_BYTES', 256 * 1024 * 1024)))
+
+        # the results are also written to results/job_id_<job_id>.json only if the
+        # environment variable TP_PERSIST_RESULTS is set
+        self.persist_results = 'TP_PERSIST_RESULTS' in environ
 
         # create a results directory if it does not exist already
-        makedirs("results", exist_ok=True)
+        if self.persist_results:
+            makedirs("results", exist_ok=True)
+
+        # the jobs with a cost of at most TP_SYNC_THRESHOLD values can be computed on the
+        # request thread, when the client asks for it or for all requests if TP_SYNC is set
+        self.sync_threshold = int(environ.get('TP_SYNC_THRESHOLD', 1000))
+        self.sync_default = 'TP_SYNC' in environ
+
+        # costs given for some endpoints instead of the estimate from the row counts, as
+        # TP_ENDPOINT_COSTS=endpoint=cost,endpoint=cost
+        self.endpoint_costs = {
+            endpoint: int(cost) for endpoint, cost in
+            (item.split('=') for item in environ.get('TP_ENDPOINT_COSTS', '').split(',') if item)
+        }
+
+        # the latencies from submit to done of the jobs of every endpoint
+        self.latency = LatencyStats()
+
+        # the counters and the histograms shown by the /api/metrics endpoint, every thread
+        # writes to its own shard of them
+        self.metrics = Metrics()
+
+        # admission control: no more jobs are accepted when there are TP_MAX_QUEUE jobs
+        # in the queue or when the sum of their costs is over TP_MAX_QUEUE_COST (0 means
+        # no limit); the times of the last finished jobs give the rate the queue drains at
+        self.max_queue = int(environ.get('TP_MAX_QUEUE', 0))
+        self.max_queue_cost = int(environ.get('TP_MAX_QUEUE_COST', 0))
+        self.finished_times = deque(maxlen=100)
+        self.rejected = 0
+
+        # a TaskRunner takes up to TP_COALESCE jobs from the queue at once, waiting at most
+        # TP_COALESCE_LINGER seconds for more jobs after the first one, and computes the jobs
+        # on the same question together, so their data is extracted only once
+        self.coalesce = int(environ.get('TP_COALESCE', 1))
+        self.coalesce_linger = float(environ.get('TP_COALESCE_LINGER', 0))
+
+        # the jobs that take longer than TP_SLOW_JOB seconds, from the request to the stored
+        # result, are logged with the time of every stage; 0 turns the log off
+        self.slow_job = float(environ.get('TP_SLOW_JOB', 1))
+
+        # the queues of the subscribers notified every time a job is done or fails, each one
+        # holds at most TP_STREAM_QUEUE events, the next ones are dropped until the subscriber
+        # catches up, so a slow client does not make the server keep every completion
+        self.subscribers = []
+        self.subscriber_queue_size = int(environ.get('TP_STREAM_QUEUE', 1000))
+        self.subscribers_lock = Lock()
+
+        # serializes the updates of the data made by ingest()
+        self.ingest_lock = Lock()
 
         # create a shutdown flag attribute for the ThreadPool
         self.shutdown_flag = False
 
+        # the job_ids given to the submitted jobs that do not have one, taken under the lock
+        # so two requests never get the same job_id
+        self.job_ids = count(1)
+        self.job_ids_lock = Lock()
+
     def start(self):
         '''
         This will start all TaskRunners
@@ -45,17 +209,362 @@ class ThreadPool:
         for thread in self.threads:
             thread.start()
 
-    def submit(self, job):
+    def submit(self, job: Job, sync = False):
         '''
         a job was submitted to the ThreadPool
         so it will be added to the job queue
 
         notifies the TaskRunners that a job is available
         and the job queue is not empty
+
+        if the job has a key, its result is taken from the cache when possible and if an
+        identical job is already queued or running the job is attached to it instead
+        of being added to the queue
+
+        a batch job ({'batch': [jobs]}) is added to the queue as a single job whose jobs are
+        computed one after the other by the same TaskRunner, the jobs of the batch that are
+        cached or attached to identical jobs are left out
+
+        if sync is True and the estimated cost of the job is at most sync_threshold, the job
+        is computed on the calling thread instead
+
+        the job (or every job of the batch) gets its job_id, if it has none, once it is
+        admitted, so a rejected job does not use up job_ids
+
+        returns True if the job is already done (or failed) when the method returns
+
+        raises QueueFullError if the queue is full and the job would have to be queued
         '''
+        self.admit(job, sync)
+        self.assign_ids(job.get('batch', [job]))
+
+        if 'batch' in job:
+            job['batch'] = [sub_job for sub_job in job['batch'] if self.claim(sub_job) == 'submit']
+            if not job['batch']:
+                return False
+        else:
+            status = self.claim(job)
+            if status != 'submit':
+                return status == 'cached'
+
+        # the cost is estimated before the job is queued, the scheduler orders the jobs by it
+        cost = self.cost(job)
+        if sync and cost <= self.sync_threshold:
+            self.execute(job)
+            return True
+
         self.job_queue.put(job)
         with self.job_available:
             self.job_available.notify()
+        return False
+
+    def assign_ids(self, jobs):
+        '''
+        gives the next job_ids to the jobs that do not have one, the jobs of a batch get
+        consecutive job_ids
+        '''
+        with self.job_ids_lock:
+            for job in jobs:
+                if 'job_id' not in job:
+                    job['job_id'] = next(self.job_ids)
+
+    def admit(self, job, sync = False):
+        '''
+        raises QueueFullError if the queue is over its limits, unless the job would not be
+        queued: it is computed on the calling thread, its result is cached or an identical
+        job is in flight
+
+        the limits are checked before the job is queued without holding a lock, so the queue
+        can go a few jobs over them when many jobs are submitted at the same time
+        '''
+        if not self.max_queue and not self.max_queue_cost:
+            return
+
+        if 'key' in job and self.cache.contains(job['key']):
+            return
+
+        cost = self.cost(job)
+        if sync and cost <= self.sync_threshold:
+            return
+
+        depth = self.job_queue.qsize()
+        over_depth = self.max_queue and depth >= self.max_queue
+        over_cost = (self.max_queue_cost and
+                     self.job_queue.queued_cost + cost > self.max_queue_cost)
+        if not over_depth and not over_cost:
+            return
+
+        self.rejected += 1
+        raise QueueFullError(self.retry_after(depth - self.max_queue + 1 if over_depth else 1))
+
+    def drain_rate(self):
+        '''
+        returns the number of jobs per second finished lately or None if it is not known
+        '''
+        times = list(self.finished_times)
+        if len(times) < 2 or times[-1] == times[0]:
+            return None
+        return (len(times) - 1) / (times[-1] - times[0])
+
+    def retry_after(self, excess):
+        '''
+        estimates in how many seconds excess jobs will leave the queue
+        '''
+        rate = self.drain_rate()
+        if rate is None:
+            return 1
+        return max(1, ceil(excess / rate))
+
+    def queue_stats(self):
+        '''
+        returns the depth and the cost of the queue, their limits, the number of rejected
+        jobs and the rate the queue drains at
+        '''
+        return {
+            'depth': self.job_queue.qsize(),
+            'max_depth': self.max_queue,
+            'queued_cost': self.job_queue.queued_cost,
+            'max_queued_cost': self.max_queue_cost,
+            'rejected': self.rejected,
+            'drain_rate': self.drain_rate()
+        }
+
+    def gauges(self):
+        '''
+        returns the (name, labels, value) of the metrics that are read when they are
+        scraped: the queue, the time every TaskRunner spent busy and idle, the job table,
+        the cache and the stats of the data ingestor
+        '''
+        now = monotonic()
+        counts, body_bytes, evicted = self.jobs.stats()
+        gauges = [
+            ('tp_queue_depth', (), self.job_queue.qsize()),
+            ('tp_queue_cost', (), self.job_queue.queued_cost),
+            ('tp_queue_rejected_total', (), self.rejected),
+            ('tp_result_bytes', (), body_bytes),
+            ('tp_jobs_evicted_total', (), evicted),
+            ('tp_result_cache_entries', (), len(self.cache))
+        ]
+        for state, count in counts.items():
+            gauges.append(('tp_jobs', (('state', state),), count))
+
+        for thread in self.threads:
+            busy, idle = thread.times(now)
+            labels = (('runner', thread.name),)
+            gauges.append(('tp_runner_busy_seconds_total', labels, round(busy, 6)))
+            gauges.append(('tp_runner_idle_seconds_total', labels, round(idle, 6)))
+            gauges.append(('tp_runner_jobs_total', labels, thread.jobs_taken))
+
+        if self.data_ingestor is not None:
+            stats = self.data_ingestor.ingest_stats
+            gauges.extend([
+                ('di_ingest_seconds', (), stats['seconds']),
+                ('di_ingest_workers', (), stats['workers']),
+                ('di_peak_rss_bytes', (), stats['peak_rss_kb'] * 1024),
+                ('di_data_version', (), self.data_ingestor.version)
+            ])
+        return gauges
+
+    def ingest(self, rows):
+        '''
+        adds the rows to the data: a new version of the data ingestor is built with them and
+        swapped in, the jobs that are running keep the version they started with and the
+        next ones use the new one; the cached results for the questions of the rows are
+        dropped after the swap, so no result computed from the old version is cached again
+
+        returns the new data ingestor, raises ValueError if the rows cannot be added
+        '''
+        with self.ingest_lock:
+            data_ingestor = self.data_ingestor.with_rows(rows)
+            self.data_ingestor = data_ingestor
+
+        for question in {row[1] for row in rows}:
+            self.cache.invalidate(question)
+        return data_ingestor
+
+    def cost(self, job):
+        '''
+        returns the estimated cost of the job, the cost of a job that carries only its key
+        is estimated from the row counts of the data ingestor and kept in the job
+        '''
+        if 'batch' in job:
+            job['cost'] = sum(self.cost(sub_job) for sub_job in job['batch'])
+            return job['cost']
+        if 'operation' not in job and 'cost' not in job:
+            endpoint = job['key'][0]
+            if endpoint in self.endpoint_costs:
+                job['cost'] = self.endpoint_costs[endpoint]
+            else:
+                job['cost'] = op.estimate_cost(*job['key'][:3], self.data_ingestor)
+        return job_cost(job)
+
+    def claim(self, job):
+        '''
+        adds the job to the job table and, if it has a key, looks for it in the cache
+
+        returns 'cached' if the result was cached and the job is already done, 'attached'
+        if the job was attached to an identical one or 'submit' if it has to be computed
+        '''
+        # the times of the stages of the job, the route gives the time the request was
+        # received; the job table keeps the same dictionary
+        job['timings'] = {'submitted': monotonic()}
+        if 'received' in job:
+            job['timings']['received'] = job['received']
+        self.jobs.add(job['job_id'], job['timings'])
+        if 'key' not in job:
+            return 'submit'
+
+        # the cache keeps the result with its encoded response, every job that gets it from
+        # the cache shares the same body
+        status, cached = self.cache.claim(job)
+        if status == 'cached':
+            res, body = cached
+            self.finish(job['job_id'], res, body)
+        return status
+
+    def execute(self, job, plan = None):
+        '''
+        computes the job and stores its result or marks it as failed if the operation
+        raises an error
+
+        the jobs of a batch share the same plan, so the data of a question is extracted only
+        once for all of them
+        '''
+        if 'batch' in job:
+            plan = {} if plan is None else plan
+            for sub_job in job['batch']:
+                self.execute(sub_job, plan)
+            return
+
+        timings = job['timings']
+        self.jobs.start(job['job_id'])
+        timings['compute_start'] = monotonic()
+        try:
+            res = run_job(job, self.data_ingestor, plan)
+        except Exception as error: # pylint: disable=broad-exception-caught
+            timings['compute_end'] = monotonic()
+            # a failing job must not stop the TaskRunner
+            get_logger().error("Job_id_%s failed: %s", job['job_id'], error)
+            self.fail(job, str(error))
+        else:
+            timings['compute_end'] = monotonic()
+            # store the result, cache it and give it to the identical jobs that were
+            # attached to this one
+            self.complete(job, res)
+
+        finished = monotonic()
+        endpoint = job['key'][0] if 'key' in job else 'other'
+        self.latency.record(endpoint, finished - timings['submitted'])
+        self.finished_times.append(finished)
+
+        # the time the job waited to be computed and the time it took
+        labels = (('endpoint', endpoint),)
+        self.metrics.observe('tp_job_wait_seconds', labels,
+                             timings['compute_start'] - timings['submitted'])
+        self.metrics.observe('tp_job_run_seconds', labels,
+                             timings['compute_end'] - timings['compute_start'])
+
+        # the jobs that took longer than TP_SLOW_JOB seconds are logged with the time spent
+        # in every stage
+        total = finished - timings.get('received', timings['submitted'])
+        if self.slow_job and total > self.slow_job:
+            self.metrics.inc('tp_slow_jobs_total', labels)
+            get_logger().warning("Slow job_id_%s (%s) took %.3f s: %s", job['job_id'],
+                                 endpoint, total, slow_job_report(timings))
+
+    def execute_many(self, jobs):
+        '''
+        computes the jobs taken together from the queue: they are grouped by question and
+        share the same plan, so the partial aggregates of a question are merged once and
+        every job gets its own result from them
+        '''
+        groups = {}
+        for job in jobs:
+            groups.setdefault(job['key'][1] if 'key' in job else None, []).append(job)
+
+        plan = {}
+        for group in groups.values():
+            for job in group:
+                self.execute(job, plan)
+
+    def subscribe(self):
+        '''
+        returns a queue that gets a (job_id, state, data) tuple every time a job is done
+        or fails, until it is given to unsubscribe(); data is the encoded response of a done
+        job and the reason of a failed one, like JobTable.get() returns
+
+        the events are dropped while the queue is full
+        '''
+        events = Queue(self.subscriber_queue_size)
+        with self.subscribers_lock:
+            self.subscribers.append(events)
+        return events
+
+    def unsubscribe(self, events):
+        '''
+        stops sending the job completions to the queue
+        '''
+        with self.subscribers_lock:
+            self.subscribers.remove(events)
+
+    def notify(self, job_id):
+        '''
+        sends the completion of the job to the subscribers
+        '''
+        if not self.subscribers:
+            return
+
+        state, data = self.jobs.get(job_id)
+        with self.subscribers_lock:
+            for events in self.subscribers:
+                try:
+                    events.put_nowait((job_id, state, data))
+                except Full:
+                    self.metrics.inc('tp_stream_events_dropped_total')
+
+    def finish(self, job_id, res, body = None, timings = None):
+        '''
+        stores the result of a job in the job table, with the get_results response for it
+        encoded once (body, if it was already encoded), and writes it to disk if the
+        results are persisted
+
+        timings are the times of the stages of the job that computed the result, given to
+        the jobs that were attached to it
+        '''
+        if body is None:
+            body = encode_response({'status': 'done', 'data': res})
+        self.jobs.finish(job_id, body, timings)
+        if self.persist_results:
+            write_result(job_id, res)
+            self.jobs.stamp(job_id, 'persisted')
+        self.notify(job_id)
+
+    def complete(self, job, res):
+        '''
+        called by a TaskRunner when a job is done, the result is stored for the job and
+        for the identical jobs that were attached to it and it is cached
+
+        the response is encoded once and shared by all these jobs
+        '''
+        body = encode_response({'status': 'done', 'data': res})
+        self.finish(job['job_id'], res, body)
+        if 'key' in job:
+            timings = computed_timings(job)
+            for job_id in self.cache.complete(job, (res, body)):
+                self.finish(job_id, res, body, timings)
+
+    def fail(self, job, reason):
+        '''
+        called by a TaskRunner when computing a job raised an error, the job and the
+        identical jobs that were attached to it are marked as failed
+        '''
+        self.jobs.fail(job['job_id'], reason)
+        self.notify(job['job_id'])
+        if 'key' in job:
+            timings = computed_timings(job)
+            for job_id in self.cache.complete(job, None, cacheable=False):
+                self.jobs.fail(job_id, reason, timings)
+                self.notify(job_id)
 
     def shutdown(self):
         '''
@@ -85,7 +594,7 @@ class TaskRunner(Thread):
     '''
     class for defining a TaskRunner
     '''
-    def __init__(self, terminate, job_available, queue):
+    def __init__(self, terminate, job_available, queue, pool):
         '''
         initialize the necessary data structures shared by the
         threads
@@ -94,11 +603,43 @@ class TaskRunner(Thread):
         self.terminate = terminate
         self.job_available = job_available
         self.queue = queue
+        self.pool = pool
+
+        # the seconds spent computing jobs and waiting for them, only this thread writes
+        # them; busy tells which one is counted since the monotonic time since
+        self.busy_seconds = 0.0
+        self.idle_seconds = 0.0
+        self.busy = False
+        self.since = monotonic()
+        self.jobs_taken = 0
+
+    def times(self, now):
+        '''
+        returns the seconds the TaskRunner spent busy and idle until now
+        '''
+        busy, since = self.busy, self.since
+        if busy:
+            return self.busy_seconds + max(0.0, now - since), self.idle_seconds
+        return self.busy_seconds, self.idle_seconds + max(0.0, now - since)
+
+    def switch(self, busy):
+        '''
+        adds the time since the last switch to the busy or idle seconds and starts counting
+        the other one
+        '''
+        now = monotonic()
+        if self.busy:
+            self.busy_seconds += now - self.since
+        else:
+            self.idle_seconds += now - self.since
+        self.since = now
+        self.busy = busy
 
     def run(self):
         '''
         each TaskRunner will run this method
         '''
+        self.since = monotonic()
         while True:
             with self.job_available:
                 # the wait_for() method waits until the queue is not empty or
@@ -110,25 +651,37 @@ class TaskRunner(Thread):
                 if self.terminate.is_set():
                     break
 
-            # get the job from the queue
-            # the condition variable is used to signal that the queue is not empty
-            # because the get() method blocks if the queue is empty
-            job = self.queue.get()
+                # get the job from the queue while holding the condition, so another
+                # TaskRunner that saw the same job cannot block in get() after it was taken
+                jobs = [self.queue.get_nowait()]
 
-            # depending on the type of operation needed for the job
-            if 'global_operation' in job:
-                res = job['operation'](job['data'], job['global_operation'](job['global_data']))
+                # take more jobs, up to the coalesce size of the pool, waiting for them at
+                # most the linger time (wait_for() releases the condition while waiting)
+                deadline = monotonic() + self.pool.coalesce_linger
+                while len(jobs) < self.pool.coalesce and self.job_available.wait_for(
+                    lambda: not self.queue.empty() or self.terminate.is_set(),
+                    deadline - monotonic()
+                ):
+                    if self.queue.empty():
+                        break
+                    jobs.append(self.queue.get_nowait())
+
+            # the time the jobs (and the jobs of the batches) were taken from the queue
+            dequeued = monotonic()
+            for job in jobs:
+                for sub_job in job.get('batch', (job,)):
+                    sub_job['timings']['dequeued'] = dequeued
+
+            # compute the jobs and store their results
+            self.switch(True)
+            self.jobs_taken += len(jobs)
+            if len(jobs) == 1:
+                self.pool.execute(jobs[0])
             else:
-                res = job['operation'](job['data'])
-
-            # write the result to a file
-            try:
-                with open(f"results/job_id_{job['job_id']}.json", 'w', encoding='utf-8') as file:
-                    json.dump(res, file)
-            except OSError as error:
-                # create a log message
-                CustomLogging().get_logger().error("Failed to write to file: %s", error)
-                exit(1)
-
-            # signal to the queue that the job is done
-            self.queue.task_done()
+                self.pool.execute_many(jobs)
+
+            self.switch(False)
+
+            # signal to the queue that the jobs are done
+            for _ in jobs:
+                self.queue.task_done()
@@ -0,0 +1,4 @@
+'''
+benchmarks for the webserver, run them from the root of the repository with
+python3 -m benchmarks.<name>
+'''
@@ -0,0 +1,82 @@
+'''
+coalescing.py
+compares the throughput of the TaskRunners taking one job at a time from a deep queue with
+the one of the TaskRunners taking up to TP_COALESCE jobs at once
+
+run it from the root of the repository with:
+python3 -m benchmarks.coalescing [num_rows] [num_threads]
+'''
+import sys
+from os import environ, close, remove
+from tempfile import mkstemp
+from time import perf_counter
+
+# environment variable set in order to avoid the code from __init__.py to run
+environ['NO_SERVER'] = 'true'
+
+# pylint: disable=wrong-import-position
+from app.data_ingestor import DataIngestor
+from app.task_runner import ThreadPool
+from benchmarks.synthetic import write_csv, QUESTIONS, STATES
+
+# the sizes of the coalesced batches, 1 takes the jobs one at a time
+BATCH_SIZES = [1, 4, 16, 64]
+
+def make_keys():
+    '''
+    every endpoint for every question, the state endpoints for every state, so no two jobs
+    have the same key and none of them is deduplicated by the cache
+    '''
+    keys = []
+    for question in QUESTIONS:
+        for endpoint in ('states_mean', 'global_mean', 'best5', 'worst5', 'diff_from_mean',
+                         'mean_by_category'):
+            keys.append((endpoint, question, None))
+        for state in STATES:
+            for endpoint in ('state_mean', 'state_diff_from_mean'):
+                keys.append((endpoint, question, state))
+    return keys
+
+def measure(ingestor, keys, batch_size, num_threads):
+    '''
+    queues all the jobs before the TaskRunners start, so the queue is as deep as it gets,
+    and returns the number of jobs per second it takes to drain it
+    '''
+    environ['TP_COALESCE'] = str(batch_size)
+    environ['TP_NUM_OF_THREADS'] = str(num_threads)
+    environ['TP_CACHE_SIZE'] = '0'
+    pool = ThreadPool(ingestor)
+
+    for job_id, key in enumerate(keys, 1):
+        pool.submit({'job_id': job_id, 'key': key})
+
+    start = perf_counter()
+    pool.start()
+    pool.shutdown()
+    return len(keys) / (perf_counter() - start)
+
+def main():
+    '''
+    runs the benchmark
+    '''
+    num_rows = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    num_threads = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+
+    descriptor, csv_path = mkstemp(suffix='.csv')
+    close(descriptor)
+    write_csv(csv_path, num_rows)
+    ingestor = DataIngestor(csv_path)
+    remove(csv_path)
+
+    keys = make_keys()
+
+    print(f"{num_rows} rows, {len(keys)} queued jobs, {num_threads} TaskRunners")
+    print(f"{'batch':>6} {'jobs/s':>10} {'speedup':>8}")
+    baseline = None
+    for batch_size in BATCH_SIZES:
+        throughput = measure(ingestor, keys, batch_size, num_threads)
+        baseline = baseline or throughput
+        print(f"{batch_size:>6} {throughput:>10.1f} {throughput / baseline:>8.2f}")
+
+if __name__ == '__main__':
+    main()
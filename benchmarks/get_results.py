@@ -0,0 +1,84 @@
+'''
+get_results.py
+compares the cost of answering a get_results poll for a large mean_by_category result:
+- the old path: the result is written to a json file once, then every poll loads the file
+and encodes the response with jsonify
+- the response encoded once, when the job finishes, with the json module or with orjson,
+and sent as it is on every poll
+
+run it from the root of the repository with:
+python3 -m benchmarks.get_results [num_rows] [num_polls]
+'''
+import json
+import sys
+from os import environ, close, remove
+from tempfile import mkstemp
+from time import perf_counter
+
+# environment variable set in order to avoid the code from __init__.py to run
+environ['NO_SERVER'] = 'true'
+
+# pylint: disable=wrong-import-position
+from flask import Flask, Response, jsonify
+from app.data_ingestor import DataIngestor
+from app.task_runner import run_job
+from app import json_codec
+from benchmarks.synthetic import write_csv, QUESTIONS, STATES, STRATIFICATIONS
+
+def measure(poll, num_polls):
+    '''
+    returns the microseconds per poll
+    '''
+    start = perf_counter()
+    for _ in range(num_polls):
+        poll()
+    return (perf_counter() - start) / num_polls * 1e6
+
+def main():
+    '''
+    runs the benchmark
+    '''
+    num_rows = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    num_polls = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+
+    descriptor, csv_path = mkstemp(suffix='.csv')
+    close(descriptor)
+    write_csv(csv_path, num_rows)
+    ingestor = DataIngestor(csv_path)
+    remove(csv_path)
+
+    res = run_job({'key': ('mean_by_category', QUESTIONS[0], None)}, ingestor)
+
+    descriptor, result_path = mkstemp(suffix='.json')
+    with open(descriptor, 'w', encoding='utf-8') as file:
+        json.dump(res, file)
+
+    def old_poll():
+        with open(result_path, 'r', encoding='utf-8') as file:
+            return jsonify({'status': 'done', 'data': json.load(file)}).get_data()
+
+    body = json.dumps({'status': 'done', 'data': res}, sort_keys=True,
+                      separators=(',', ':')).encode('utf-8') + b'\n'
+    fast_body = json_codec.encode_response({'status': 'done', 'data': res})
+
+    print(f"mean_by_category result with {len(res)} groups ({len(STATES)} states, "
+          f"{len(STRATIFICATIONS)} stratifications), {len(body)} bytes, {num_polls} polls")
+    print(f"{'path':>28} {'encode us':>10} {'poll us':>9}")
+    with Flask(__name__).app_context():
+        print(f"{'file + json.load + jsonify':>28} {'':>10} {measure(old_poll, num_polls):>9.1f}")
+        encode = measure(lambda: json.dumps({'status': 'done', 'data': res}, sort_keys=True,
+                                            separators=(',', ':')).encode('utf-8'), 100)
+        poll = measure(lambda: Response(body, mimetype='application/json').get_data(),
+                       num_polls)
+        print(f"{'pre-encoded, json':>28} {encode:>10.1f} {poll:>9.1f}")
+        if json_codec.orjson is not None:
+            encode = measure(lambda: json_codec.encode_response({'status': 'done',
+                                                                 'data': res}), 100)
+            poll = measure(lambda: Response(fast_body, mimetype='application/json').get_data(),
+                           num_polls)
+            print(f"{'pre-encoded, orjson':>28} {encode:>10.1f} {poll:>9.1f}")
+
+    remove(result_path)
+
+if __name__ == '__main__':
+    main()
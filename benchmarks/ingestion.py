@@ -0,0 +1,69 @@
+'''
+ingestion.py
+compares the time and the peak memory of reading the csv file line by line with the ones
+of parsing it with an increasing number of worker processes
+
+run it from the root of the repository with:
+python3 -m benchmarks.ingestion [num_rows] [max_workers]
+'''
+import sys
+from multiprocessing import get_context
+from os import environ, close, cpu_count, remove
+from tempfile import mkstemp
+
+# environment variable set in order to avoid the code from __init__.py to run
+environ['NO_SERVER'] = 'true'
+
+# pylint: disable=wrong-import-position
+from app.data_ingestor import DataIngestor
+from benchmarks.synthetic import write_csv
+
+def ingest(csv_path, num_workers, results):
+    '''
+    reads the csv file and puts the ingestion statistics in results, it runs in a new
+    process so the peak memory of every run is measured on its own
+    '''
+    results.put(DataIngestor(csv_path, num_workers=num_workers).ingest_stats)
+
+def measure(csv_path, num_workers):
+    '''
+    returns the ingestion statistics of a run with num_workers
+    '''
+    context = get_context('fork')
+    results = context.SimpleQueue()
+    process = context.Process(target=ingest, args=(csv_path, num_workers, results))
+    process.start()
+    stats = results.get()
+    process.join()
+    return stats
+
+def main():
+    '''
+    runs the benchmark
+    '''
+    num_rows = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    max_workers = int(sys.argv[2]) if len(sys.argv) > 2 else max(cpu_count(), 2)
+
+    descriptor, csv_path = mkstemp(suffix='.csv')
+    close(descriptor)
+    write_csv(csv_path, num_rows)
+
+    print(f"{num_rows} rows")
+    print(f"{'workers':>8} {'seconds':>8} {'speedup':>8} {'peak RSS MB':>12} "
+          f"{'worker RSS MB':>14}")
+
+    # 1 worker reads the file line by line, on the calling process
+    baseline = None
+    num_workers = 1
+    while num_workers <= max_workers:
+        stats = measure(csv_path, num_workers)
+        baseline = baseline or stats['seconds']
+        print(f"{num_workers:>8} {stats['seconds']:>8.2f} "
+              f"{baseline / stats['seconds']:>8.2f} {stats['peak_rss_kb'] / 1024:>12.1f} "
+              f"{stats['workers_peak_rss_kb'] / 1024:>14.1f}")
+        num_workers *= 2
+
+    remove(csv_path)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,406 @@
+'''
+load_test.py
+drives the webserver over http with many concurrent clients: every client submits a query
+to one of the post endpoints, picked from a weighted mix, polls get_results until the job
+is done and starts over, until the duration of the run is over
+
+for every size of the synthetic dataset it reports the number of jobs done per second, the
+p50, p95 and p99 latencies from the submit to the result, by endpoint and overall, and the
+cpu time used by the server, and it saves all of them as json so the runs of two commits
+can be compared with --compare
+
+the server is started on localhost in a new process for every dataset, or with
+--mode inprocess it runs in a forked process and the clients call it through the test
+client of flask, without the http server; the environment variables of the server (like
+TP_NUM_OF_THREADS or TP_CACHE_SIZE=0) are given with --env
+
+run it from the root of the repository with:
+python3 -m benchmarks.load_test [--rows 10000,100000] [--clients 16] [--duration 10]
+    [--mix states_mean=2,best5=1,...] [--mode localhost|inprocess] [--env NAME=VALUE]
+    [--output load_test.json] [--compare old_load_test.json]
+'''
+import argparse
+import json
+import sys
+from datetime import datetime, timezone
+from http.client import HTTPConnection
+from importlib import reload
+from multiprocessing import get_context
+from os import environ, chdir, cpu_count, path, sysconf
+from random import Random
+from resource import getrusage, RUSAGE_SELF
+from shutil import rmtree
+from socket import socket
+from subprocess import Popen, DEVNULL, run, CalledProcessError
+from tempfile import mkdtemp
+from threading import Thread
+from time import monotonic, sleep
+
+# environment variable set in order to avoid the code from __init__.py to run
+environ['NO_SERVER'] = 'true'
+
+# pylint: disable=wrong-import-position
+from app.scheduler import percentile
+from benchmarks.synthetic import write_csv, QUESTIONS, STATES
+
+# the post endpoints in the default mix, the batch endpoint can be added to it with a weight
+ENDPOINTS = ['states_mean', 'state_mean', 'best5', 'worst5', 'top_k', 'global_mean',
+             'diff_from_mean', 'state_diff_from_mean', 'mean_by_category',
+             'state_mean_by_category']
+
+# the endpoints that need a state
+STATE_ENDPOINTS = {'state_mean', 'state_diff_from_mean', 'state_mean_by_category'}
+
+# the name of the csv file the server reads, in its working directory
+CSV_NAME = 'nutrition_activity_obesity_usa_subset.csv'
+
+# the root of the repository, the server is started with it in its PYTHONPATH
+ROOT = path.dirname(path.dirname(path.abspath(__file__)))
+
+def parse_mix(text):
+    '''
+    the weights of the endpoints from endpoint=weight,endpoint=weight, every query endpoint
+    has weight 1 if no mix is given
+    '''
+    if not text:
+        return {endpoint: 1 for endpoint in ENDPOINTS}
+    mix = {}
+    for item in text.split(','):
+        endpoint, weight = item.split('=')
+        if endpoint not in ENDPOINTS and endpoint != 'batch':
+            raise SystemExit(f"Unknown endpoint {endpoint}")
+        mix[endpoint] = float(weight)
+    return mix
+
+def make_query(endpoint, rng):
+    '''
+    returns the path and the body of a random query to the endpoint, a batch has one query
+    to every endpoint of the default mix
+    '''
+    if endpoint == 'batch':
+        return '/api/batch', {'queries': [dict(make_query(name, rng)[1], endpoint=name)
+                                          for name in ENDPOINTS]}
+    body = {'question': rng.choice(QUESTIONS)}
+    if endpoint in STATE_ENDPOINTS:
+        body['state'] = rng.choice(STATES)
+    if endpoint == 'top_k':
+        body.update(k=rng.randint(1, 10), order=rng.choice(['best', 'worst']))
+    return f'/api/{endpoint}', body
+
+class HTTPClient:
+    '''
+    sends the requests of a client over its own keep alive connection
+    '''
+    def __init__(self, port):
+        self.connection = HTTPConnection('127.0.0.1', port, timeout=60)
+
+    def request(self, method, url, body = None):
+        '''
+        returns the status and the decoded json of the response
+        '''
+        headers = {}
+        if body is not None:
+            body = json.dumps(body)
+            headers['Content-Type'] = 'application/json'
+        self.connection.request(method, url, body, headers)
+        response = self.connection.getresponse()
+        return response.status, json.loads(response.read())
+
+class InProcessClient:
+    '''
+    sends the requests of a client through the test client of the flask app
+    '''
+    def __init__(self, webserver):
+        self.client = webserver.test_client()
+
+    def request(self, method, url, body = None):
+        '''
+        returns the status and the decoded json of the response
+        '''
+        response = self.client.open(url, method=method, json=body)
+        return response.status_code, response.get_json()
+
+def drive(make_client, mix, deadline, poll_interval, seed):
+    '''
+    the loop of one client, returns its latencies by endpoint and its request counts
+    '''
+    client = make_client()
+    rng = Random(seed)
+    names, weights = list(mix), list(mix.values())
+    stats = {'latencies': {}, 'jobs': 0, 'requests': 0, 'polls': 0, 'rejected': 0,
+             'errors': 0}
+
+    while monotonic() < deadline:
+        endpoint = rng.choices(names, weights)[0]
+        url, body = make_query(endpoint, rng)
+
+        start = monotonic()
+        status, data = client.request('POST', url, body)
+        stats['requests'] += 1
+        if status == 429:
+            # the queue is full, the client waits a bit before the next query
+            stats['rejected'] += 1
+            sleep(poll_interval)
+            continue
+        if status != 200 or ('job_id' not in data and 'job_ids' not in data):
+            stats['errors'] += 1
+            continue
+
+        for job_id in data.get('job_ids', [data.get('job_id')]):
+            stats['jobs'] += 1
+            while True:
+                status, result = client.request('GET', f'/api/get_results/{job_id}')
+                stats['requests'] += 1
+                stats['polls'] += 1
+                if result['status'] != 'running':
+                    break
+                sleep(poll_interval)
+            if result['status'] != 'done':
+                stats['errors'] += 1
+
+        stats['latencies'].setdefault(endpoint, []).append(monotonic() - start)
+    return stats
+
+def run_clients(make_client, args, mix):
+    '''
+    runs the clients for the duration of the run and returns the merged statistics, with
+    the number of seconds it took until the last client got its last result
+    '''
+    results = [None] * args.clients
+
+    def client(index):
+        results[index] = drive(make_client, mix, deadline, args.poll_interval, index)
+
+    deadline = monotonic() + args.duration
+    start = monotonic()
+    threads = [Thread(target=client, args=(index,)) for index in range(args.clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = monotonic() - start
+
+    merged = {'seconds': elapsed, 'latencies': {}, 'jobs': 0, 'requests': 0, 'polls': 0,
+              'rejected': 0, 'errors': 0}
+    for stats in results:
+        for endpoint, values in stats.pop('latencies').items():
+            merged['latencies'].setdefault(endpoint, []).extend(values)
+        for name, value in stats.items():
+            merged[name] += value
+    return merged
+
+def free_port():
+    '''
+    a port no one listens on
+    '''
+    with socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def process_cpu(pid):
+    '''
+    the user and system cpu seconds used so far by the process, from /proc
+    '''
+    with open(f'/proc/{pid}/stat', encoding='utf-8') as file:
+        fields = file.read().rsplit(')', 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / sysconf('SC_CLK_TCK')
+
+def run_localhost(directory, args, mix):
+    '''
+    starts the server on localhost in the directory of the dataset and drives it
+    '''
+    port = free_port()
+    env = dict(environ, PYTHONPATH=ROOT, **args.env)
+    env.pop('NO_SERVER')
+    server = Popen([sys.executable, '-c', 'from app import webserver; '
+                    f'webserver.run(host="127.0.0.1", port={port}, threaded=True)'],
+                   cwd=directory, env=env, stdout=DEVNULL, stderr=DEVNULL)
+    try:
+        # the server listens once the data is read
+        while True:
+            if server.poll() is not None:
+                raise SystemExit("The server did not start")
+            try:
+                status, ready = HTTPClient(port).request('GET', '/api/ready')
+                if status == 200:
+                    break
+            except OSError:
+                pass
+            sleep(0.1)
+
+        cpu = process_cpu(server.pid)
+        client_cpu = getrusage(RUSAGE_SELF)
+        stats = run_clients(lambda: HTTPClient(port), args, mix)
+        stats['cpu_seconds'] = process_cpu(server.pid) - cpu
+        usage = getrusage(RUSAGE_SELF)
+        stats['client_cpu_seconds'] = (usage.ru_utime + usage.ru_stime -
+                                       client_cpu.ru_utime - client_cpu.ru_stime)
+        stats['ingest_seconds'] = ready['ingest_stats']['seconds']
+        HTTPClient(port).request('GET', '/api/graceful_shutdown')
+    finally:
+        server.terminate()
+        server.wait()
+    return stats
+
+def serve_inprocess(directory, args, mix, results):
+    '''
+    runs in a forked process: creates the server in the directory of the dataset and
+    drives it through the test client; the app package was imported without the server
+    (NO_SERVER is set), it is imported again to create it
+    '''
+    chdir(directory)
+    environ.update(args.env)
+    del environ['NO_SERVER']
+    app = reload(sys.modules['app'])
+
+    usage = getrusage(RUSAGE_SELF)
+    stats = run_clients(lambda: InProcessClient(app.webserver), args, mix)
+    end = getrusage(RUSAGE_SELF)
+    # the clients run in the same process, their cpu time is counted as well
+    stats['cpu_seconds'] = end.ru_utime + end.ru_stime - usage.ru_utime - usage.ru_stime
+    stats['client_cpu_seconds'] = None
+    stats['ingest_seconds'] = app.webserver.data_ingestor.ingest_stats['seconds']
+    app.webserver.tasks_runner.shutdown()
+    results.put(stats)
+
+def run_inprocess(directory, args, mix):
+    '''
+    drives the server in a forked process and returns its statistics
+    '''
+    context = get_context('fork')
+    results = context.SimpleQueue()
+    process = context.Process(target=serve_inprocess, args=(directory, args, mix, results))
+    process.start()
+    stats = results.get()
+    process.join()
+    return stats
+
+def summary(values):
+    '''
+    the number of latencies, their mean and their p50, p95 and p99 in milliseconds
+    '''
+    values = sorted(values)
+    return {
+        'count': len(values),
+        'mean_ms': round(sum(values) / len(values) * 1000, 3) if values else None,
+        'p50_ms': round(percentile(values, 50) * 1000, 3) if values else None,
+        'p95_ms': round(percentile(values, 95) * 1000, 3) if values else None,
+        'p99_ms': round(percentile(values, 99) * 1000, 3) if values else None
+    }
+
+def report(num_rows, stats):
+    '''
+    the result of the run on a dataset, as it is saved in the json file; a batch query
+    counts as one query and as one job for every query it has
+    '''
+    latencies = stats.pop('latencies')
+    seconds = stats['seconds']
+    return dict(stats, rows=num_rows, queries=sum(len(values) for values in latencies.values()),
+                throughput=round(stats['jobs'] / seconds, 2),
+                request_rate=round(stats['requests'] / seconds, 2),
+                cpu_utilization=round(stats['cpu_seconds'] / seconds, 3),
+                latency=summary([value for values in latencies.values() for value in values]),
+                endpoints={endpoint: summary(values)
+                           for endpoint, values in sorted(latencies.items())})
+
+def print_run(run_report):
+    '''
+    prints the throughput, the cpu usage and the latencies of a run
+    '''
+    print(f"\n{run_report['rows']} rows: {run_report['jobs']} jobs in "
+          f"{run_report['seconds']:.1f} s, {run_report['throughput']:.1f} jobs/s, "
+          f"{run_report['request_rate']:.1f} requests/s, {run_report['rejected']} rejected, "
+          f"{run_report['errors']} errors, server cpu {run_report['cpu_utilization']:.2f} "
+          f"cores (ingest {run_report['ingest_seconds']:.2f} s)")
+    print(f"{'endpoint':>24} {'count':>7} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+    rows = list(run_report['endpoints'].items()) + [('all', run_report['latency'])]
+    for endpoint, latency in rows:
+        if latency['count']:
+            print(f"{endpoint:>24} {latency['count']:>7} {latency['p50_ms']:>8.2f} "
+                  f"{latency['p95_ms']:>8.2f} {latency['p99_ms']:>8.2f}")
+
+def compare(old, new):
+    '''
+    prints the change of the throughput and of the latencies from the old results to the
+    new ones, for the datasets both have
+    '''
+    print(f"\ncompared with {old['commit']} ({old['timestamp']})")
+    print(f"{'rows':>10} {'jobs/s':>16} {'p50 ms':>16} {'p99 ms':>16}")
+    old_runs = {run_report['rows']: run_report for run_report in old['runs']}
+    for run_report in new['runs']:
+        before = old_runs.get(run_report['rows'])
+        if before is None:
+            continue
+        print(f"{run_report['rows']:>10} "
+              f"{before['throughput']:>7.1f} > {run_report['throughput']:<6.1f} "
+              f"{before['latency']['p50_ms']:>7.2f} > {run_report['latency']['p50_ms']:<6.2f} "
+              f"{before['latency']['p99_ms']:>7.2f} > {run_report['latency']['p99_ms']:<6.2f}")
+
+def commit():
+    '''
+    the commit the benchmark runs on, None if it is not in a git repository
+    '''
+    try:
+        return run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                   check=True, text=True).stdout.strip()
+    except (OSError, CalledProcessError):
+        return None
+
+def main():
+    '''
+    runs the benchmark
+    '''
+    parser = argparse.ArgumentParser(description='load test of the webserver')
+    parser.add_argument('--rows', default='10000,100000',
+                        help='comma separated sizes of the synthetic datasets')
+    parser.add_argument('--clients', type=int, default=16, help='concurrent clients')
+    parser.add_argument('--duration', type=float, default=10,
+                        help='seconds the clients submit queries for, on every dataset')
+    parser.add_argument('--mix', default='', help='endpoint=weight,... (default: all 1)')
+    parser.add_argument('--poll-interval', type=float, default=0.005,
+                        help='seconds between two get_results polls of a job')
+    parser.add_argument('--mode', choices=['localhost', 'inprocess'], default='localhost')
+    parser.add_argument('--env', action='append', default=[], metavar='NAME=VALUE',
+                        help='environment variable of the server, can be repeated')
+    parser.add_argument('--output', default='load_test.json', help='json file of the results')
+    parser.add_argument('--compare', help='json file of an earlier run to compare with')
+    args = parser.parse_args()
+    args.env = dict(item.split('=', 1) for item in args.env)
+    mix = parse_mix(args.mix)
+
+    results = {
+        'commit': commit(),
+        'timestamp': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'python': sys.version.split()[0],
+        'cpu_count': cpu_count(),
+        'config': {'clients': args.clients, 'duration': args.duration, 'mix': mix,
+                   'poll_interval': args.poll_interval, 'mode': args.mode, 'env': args.env},
+        'runs': []
+    }
+    print(f"{args.clients} clients for {args.duration} s per dataset, {args.mode}, "
+          f"commit {results['commit']}")
+
+    for num_rows in (int(rows) for rows in args.rows.split(',')):
+        directory = mkdtemp()
+        try:
+            write_csv(path.join(directory, CSV_NAME), num_rows)
+            if args.mode == 'localhost':
+                stats = run_localhost(directory, args, mix)
+            else:
+                stats = run_inprocess(directory, args, mix)
+        finally:
+            rmtree(directory)
+
+        results['runs'].append(report(num_rows, stats))
+        print_run(results['runs'][-1])
+
+    with open(args.output, 'w', encoding='utf-8') as file:
+        json.dump(results, file, indent=2)
+    print(f"\nresults saved to {args.output}")
+
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as file:
+            compare(json.load(file), results)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+'''
+request_logging.py
+compares the latency of a request that logs one info message, like the routes do, with
+logging off, with the rotating file handler called on the request thread and with the
+records put in a queue that a background thread writes to the file (with and without
+sampling), while several client threads send requests at the same time
+
+run it from the root of the repository with:
+python3 -m benchmarks.request_logging [num_requests] [num_threads]
+'''
+import sys
+from logging import getLogger, INFO
+from os import environ, chdir, getcwd
+from tempfile import mkdtemp
+from threading import Thread
+from time import perf_counter
+
+# environment variable set in order to avoid the code from __init__.py to run
+environ['NO_SERVER'] = 'true'
+
+# pylint: disable=wrong-import-position
+from flask import Flask, jsonify
+from app.my_logging import file_handler, queue_handler
+
+def make_app(logger):
+    '''
+    a flask app with one route that logs and answers like the get_results endpoint
+    '''
+    webserver = Flask(__name__)
+
+    @webserver.route('/api/get_results/<job_id>')
+    def get_results(job_id):
+        '''
+        logs one info message for the job and sends a small json response
+        '''
+        logger.info("Job_id_%s processed successfully", job_id)
+        return jsonify({'status': 'done', 'data': {'global_mean': 31.7}})
+
+    return webserver
+
+def measure(webserver, num_requests, num_threads):
+    '''
+    every thread sends num_requests requests, returns the sorted latencies in microseconds
+    and the number of requests per second
+    '''
+    latencies = []
+
+    def client():
+        '''
+        sends the requests one after the other and records the latency of each one
+        '''
+        test_client = webserver.test_client()
+        for job_id in range(num_requests):
+            start = perf_counter()
+            test_client.get(f'/api/get_results/{job_id}')
+            latencies.append((perf_counter() - start) * 1e6)
+
+    threads = [Thread(target=client) for _ in range(num_threads)]
+    start = perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = perf_counter() - start
+    return sorted(latencies), len(latencies) / elapsed
+
+def main():
+    '''
+    runs the benchmark
+    '''
+    num_requests = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    num_threads = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+
+    # webserver.log is written in a temporary directory
+    current = getcwd()
+    chdir(mkdtemp())
+
+    print(f"{num_threads} threads x {num_requests} requests")
+    print(f"{'logging':>14} {'p50 us':>8} {'p99 us':>8} {'req/s':>8}")
+    for mode in ('off', 'sync', 'queue', 'queue 10%'):
+        logger = getLogger(f'benchmark.{mode}')
+        logger.setLevel(INFO)
+        logger.propagate = False
+        listener = None
+        if mode == 'sync':
+            logger.addHandler(file_handler())
+        elif mode.startswith('queue'):
+            handler, listener = queue_handler(file_handler(), 0.1 if '%' in mode else 1)
+            logger.addHandler(handler)
+        else:
+            logger.disabled = True
+
+        latencies, throughput = measure(make_app(logger), num_requests, num_threads)
+        # the records still queued are written before the next mode runs
+        if listener is not None:
+            listener.stop()
+
+        print(f"{mode:>14} {latencies[len(latencies) // 2]:>8.1f} "
+              f"{latencies[len(latencies) * 99 // 100]:>8.1f} {throughput:>8.0f}")
+
+    chdir(current)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,49 @@
+'''
+snapshot.py
+compares the startup time of the data ingestor reading the csv file with the one of
+loading the binary snapshot, for the dictionary and the columnar modes
+
+run it from the root of the repository with:
+python3 -m benchmarks.snapshot [num_rows]
+'''
+import sys
+from os import environ, close, remove, path
+from tempfile import mkstemp
+
+# environment variable set in order to avoid the code from __init__.py to run
+environ['NO_SERVER'] = 'true'
+
+# pylint: disable=wrong-import-position
+from app.data_ingestor import DataIngestor
+from benchmarks.synthetic import write_csv
+
+def main():
+    '''
+    runs the benchmark
+    '''
+    num_rows = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+
+    descriptor, csv_path = mkstemp(suffix='.csv')
+    close(descriptor)
+    write_csv(csv_path, num_rows)
+    snapshot_path = csv_path + '.snapshot'
+
+    print(f"{num_rows} rows, csv {path.getsize(csv_path) / 2 ** 20:.1f} MB")
+    print(f"{'mode':>9} {'csv s':>8} {'write s':>8} {'load s':>8} {'speedup':>8} "
+          f"{'snapshot MB':>12}")
+    for columnar in (False, True):
+        from_csv = DataIngestor(csv_path, columnar=columnar).ingest_stats['seconds']
+        written = DataIngestor(csv_path, columnar=columnar, snapshot=snapshot_path)
+        loaded = DataIngestor(csv_path, columnar=columnar, snapshot=snapshot_path)
+        assert loaded.ingest_stats['snapshot'] == 'loaded'
+
+        load = loaded.ingest_stats['seconds']
+        print(f"{'columnar' if columnar else 'dict':>9} {from_csv:>8.2f} "
+              f"{written.ingest_stats['seconds']:>8.2f} {load:>8.2f} {from_csv / load:>8.1f} "
+              f"{path.getsize(snapshot_path) / 2 ** 20:>12.1f}")
+        remove(snapshot_path)
+
+    remove(csv_path)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,47 @@
+'''
+synthetic.py
+generates csv files with the same columns as nutrition_activity_obesity_usa_subset.csv
+'''
+from csv import writer
+from random import Random
+from app.data_ingestor import STATE, QUESTION, DATA_VALUE, STRATIFCAT1, STRATIF1
+
+STATES = [f"State {i}" for i in range(54)]
+
+QUESTIONS = [
+    'Percent of adults aged 18 years and older who have an overweight classification',
+    'Percent of adults aged 18 years and older who have obesity',
+    'Percent of adults who engage in no leisure-time physical activity',
+    'Percent of adults who report consuming fruit less than one time daily',
+    'Percent of adults who report consuming vegetables less than one time daily',
+    'Percent of adults who engage in muscle-strengthening activities on 2 or more days a week',
+]
+
+STRATIFICATIONS = [
+    ('Total', 'Total'),
+    ('Gender', 'Male'),
+    ('Gender', 'Female'),
+    ('Age (years)', '18 - 24'),
+    ('Age (years)', '25 - 34'),
+    ('Age (years)', '35 - 44'),
+    ('Education', 'High school graduate'),
+    ('Education', 'College graduate'),
+    ('Income', '$15,000 - $24,999'),
+    ('Income', '$75,000 or greater'),
+    ('Race/Ethnicity', 'Hispanic'),
+    ('Race/Ethnicity', 'Asian'),
+]
+
+def write_csv(csv_path, num_rows, seed = 0):
+    '''
+    writes num_rows random rows to csv_path, the rows of every state, question and
+    stratification are interleaved like in the real file
+    '''
+    rng = Random(seed)
+    with open(csv_path, 'w', encoding='utf-8', newline='') as file:
+        csv_writer = writer(file)
+        csv_writer.writerow(['', STATE, QUESTION, DATA_VALUE, STRATIFCAT1, STRATIF1])
+        for row in range(num_rows):
+            stratcat, strat = rng.choice(STRATIFICATIONS)
+            csv_writer.writerow([row, rng.choice(STATES), rng.choice(QUESTIONS),
+                                 round(rng.uniform(5, 70), 1), stratcat, strat])
@@ -4,20 +4,68 @@ to test it use command: python3 -m unittest -v unittests/my_tests.py
 for the unittests I used a sample.csv file
 '''
 
+import sys
 import unittest
-from os import environ
+from importlib import reload
+from logging import LogRecord, INFO, ERROR
+from os import environ, remove, getcwd, chdir, path, close
+from tempfile import mkstemp, mkdtemp
+from subprocess import run
+from threading import Timer, Thread, Event, get_ident
+from time import monotonic, sleep
+from weakref import ref
+from flask import Flask
+
 # environment variable set in order to avoid the code from __init__.py to run
 # because of the import of the DataIngestor class
 environ['NO_SERVER'] = 'true'
 
 from app.data_ingestor import DataIngestor
+from app.columnar import ColumnarStore
+from app.parallel_ingest import split_chunks
+from app.result_cache import ResultCache
+from app.job_table import JobTable, QUEUED, RUNNING, DONE, FAILED
+from app.json_codec import encode_response
+from app.task_runner import ThreadPool, QueueFullError, job_cost, run_job, slow_job_report
+from app.scheduler import JobScheduler, LatencyStats, FIFO, SJF
+from app.my_logging import CustomLogging, SampleFilter, get_logger
+from app.metrics import Metrics, render
+from app.profiler import sample_stacks, collapse
 import app.operations as op
+import app.json_codec as json_codec
+from benchmarks.synthetic import write_csv, QUESTIONS, STATES
 
 # constants to avoid repetition
 # QUESTION1 and 2 are of type best is min
 QUESTION1 = 'Percent of adults aged 18 years and older who have an overweight classification'
 QUESTION2 = 'Percent of adults aged 18 years and older who have obesity'
 
+SAMPLE_CSV = path.abspath('unittests/sample.csv')
+
+def start_server(**env):
+    '''
+    creates the flask server on sample.csv (unless DI_CSV is given) with the given environment
+    variables and returns it; it runs in a temporary directory, so its log file is written there
+
+    the app package was imported without the server (NO_SERVER is set), it is imported
+    again to create it and the routes are registered on the new server
+    '''
+    saved = dict(environ)
+    current = getcwd()
+    environ.update({'DI_CSV': SAMPLE_CSV}, **env)
+    del environ['NO_SERVER']
+    chdir(mkdtemp())
+    try:
+        routes_loaded = 'app.routes' in sys.modules
+        server = reload(sys.modules['app'])
+        if routes_loaded:
+            reload(sys.modules['app.routes'])
+        return server.webserver
+    finally:
+        chdir(current)
+        environ.clear()
+        environ.update(saved)
+
 class TestWebserver(unittest.TestCase):
     '''
     test the webserver
@@ -32,7 +80,7 @@ class TestWebserver(unittest.TestCase):
         '''
         test the states mean
         '''
-        data, _ = op.get_job_data_for_question(QUESTION1, self.sample_data.state_data)
+        data, _ = op.get_aggregates_for_question(QUESTION1, self.sample_data.aggregates)
         result = op.states_means()(data)
         self.assertEqual(result, {'Alabama': 30.0, 'Alaska': 33.4})
 
@@ -40,7 +88,7 @@ class TestWebserver(unittest.TestCase):
         '''
         test the state mean
         '''
-        data = op.get_job_data_for_state(QUESTION1, 'Alabama', self.sample_data.state_data)
+        data = op.get_aggregates_for_state(QUESTION1, 'Alabama', self.sample_data.aggregates)
         result = op.state_mean()(data)
         self.assertEqual(result, {'Alabama': 30.0})
 
@@ -48,7 +96,7 @@ class TestWebserver(unittest.TestCase):
         '''
         test the best 5
         '''
-        data, _ = op.get_job_data_for_question(QUESTION2, self.sample_data.state_data)
+        data, _ = op.get_aggregates_for_question(QUESTION2, self.sample_data.aggregates)
         result = op.best5()(data)
         self.assertEqual(result, {'Oregon': 20.6, 'Texas': 20.8, 'Ohio': 29.9, 'Alabama': 35.6,
         'Indiana': 45.6})
@@ -57,7 +105,7 @@ class TestWebserver(unittest.TestCase):
         '''
         test the worst 5
         '''
-        data, _ = op.get_job_data_for_question(QUESTION2, self.sample_data.state_data)
+        data, _ = op.get_aggregates_for_question(QUESTION2, self.sample_data.aggregates)
         result = op.worst5()(data)
         self.assertEqual(result, {'Idaho': 55.6, 'Indiana': 45.6, 'Alabama': 35.6, 'Ohio': 29.9,
         'Texas': 20.8})
@@ -66,7 +114,8 @@ class TestWebserver(unittest.TestCase):
         '''
         test the global mean
         '''
-        _, data = op.get_job_data_for_question(QUESTION1, self.sample_data.state_data, True, False)
+        _, data = op.get_aggregates_for_question(QUESTION1, self.sample_data.aggregates, True,
+        False)
         result = op.global_mean()(data)
         self.assertEqual(result, {'global_mean': 31.7})
 
@@ -74,7 +123,8 @@ class TestWebserver(unittest.TestCase):
         '''
         test the global mean
         '''
-        _, data = op.get_job_data_for_question(QUESTION2, self.sample_data.state_data, True, False)
+        _, data = op.get_aggregates_for_question(QUESTION2, self.sample_data.aggregates, True,
+        False)
         result = op.global_mean()(data)
         self.assertEqual(result, {'global_mean': 34.68333333333333})
 
@@ -82,8 +132,8 @@ class TestWebserver(unittest.TestCase):
         '''
         test the diff from mean
         '''
-        data, global_data = op.get_job_data_for_question(QUESTION1, self.sample_data.state_data,
-        True, True)
+        data, global_data = op.get_aggregates_for_question(QUESTION1,
+        self.sample_data.aggregates, True, True)
         result = op.diff_from_mean()(data, op.global_mean()(global_data))
         self.assertEqual(result, {'Alabama': 1.6999999999999993, 'Alaska': -1.6999999999999993})
 
@@ -91,8 +141,8 @@ class TestWebserver(unittest.TestCase):
         '''
         test the state diff from mean
         '''
-        data = op.get_job_data_for_state(QUESTION1, 'Alabama', self.sample_data.state_data)
-        _, global_data = op.get_job_data_for_question(QUESTION1, self.sample_data.state_data,
+        data = op.get_aggregates_for_state(QUESTION1, 'Alabama', self.sample_data.aggregates)
+        _, global_data = op.get_aggregates_for_question(QUESTION1, self.sample_data.aggregates,
         True, False)
         result = op.diff_from_mean()(data, op.global_mean()(global_data))
         self.assertEqual(result, {'Alabama': 1.6999999999999993})
@@ -101,7 +151,7 @@ class TestWebserver(unittest.TestCase):
         '''
         test the mean by category
         '''
-        data = op.get_job_data_for_categories(QUESTION1, self.sample_data.state_data)
+        data = op.get_categories_for_question(QUESTION1, self.sample_data.category_index)
         result = op.category_means()(data)
         self.assertEqual(result, {"('Alabama', 'Total', 'Total')": 30.0,
         "('Alaska', 'Total', 'Total')": 33.4})
@@ -110,7 +160,1270 @@ class TestWebserver(unittest.TestCase):
         '''
         test the state mean by category
         '''
-        data = op.get_job_data_for_categ_per_state(QUESTION1, 'Alabama',
-        self.sample_data.state_data)
+        data = op.get_categories_for_state(QUESTION1, 'Alabama',
+        self.sample_data.category_index, self.sample_data.aggregates)
         result = op.state_mean_by_category()(data)
         self.assertEqual(result, {'Alabama': {"('Total', 'Total')": 30.0}})
+
+class TestColumnarStore(unittest.TestCase):
+    '''
+    test that the columnar store gives the same results as the dictionary based state_data
+    '''
+    def setUp(self):
+        '''
+        setup the test
+        '''
+        self.sample_data = DataIngestor('unittests/sample.csv')
+        self.columnar_data = DataIngestor('unittests/sample.csv', columnar=True)
+
+    def test_columns(self):
+        '''
+        test the code columns and the tables decoding them
+        '''
+        store = self.columnar_data.columnar
+        self.assertEqual(len(store), 10)
+        self.assertEqual(store.states[:2], ['Alabama', 'Alaska'])
+        self.assertEqual(store.stratcats, ['Total'])
+        self.assertEqual(store.values.dtype.name, 'float64')
+        self.assertEqual(store.codes[0].dtype.name, 'uint8')
+
+    def test_question_operations(self):
+        '''
+        test the operations that use the data for a question
+        '''
+        for question in (QUESTION1, QUESTION2):
+            for endpoint in ('states_mean', 'best5', 'worst5', 'global_mean', 'diff_from_mean',
+                             'top_k'):
+                self.assertEqual(
+                    run_job(op.plan_query(endpoint, question, None, self.columnar_data)),
+                    run_job(op.plan_query(endpoint, question, None, self.sample_data)))
+
+    def test_state_operations(self):
+        '''
+        test the operations that use the data for a question and a state
+        '''
+        for endpoint, state in (('state_mean', 'Alaska'), ('state_diff_from_mean', 'Alaska'),
+                                ('state_mean_by_category', 'Alabama')):
+            self.assertEqual(run_job(op.plan_query(endpoint, QUESTION1, state,
+            self.columnar_data)), run_job(op.plan_query(endpoint, QUESTION1, state,
+            self.sample_data)))
+
+        self.assertEqual(op.plan_query('state_mean', QUESTION1, 'Ohio', self.columnar_data),
+        {"status": "Invalid question"})
+        self.assertEqual(op.plan_query('state_mean', QUESTION1, 'Utah', self.columnar_data),
+        {"status": "Invalid state"})
+
+    def test_category_operations(self):
+        '''
+        test the operations that use the data for the categories
+        '''
+        self.assertEqual(run_job(op.plan_query('mean_by_category', QUESTION2, None,
+        self.columnar_data)), run_job(op.plan_query('mean_by_category', QUESTION2, None,
+        self.sample_data)))
+
+    def test_mapped_store(self):
+        '''
+        test that a store mapped from the file written by dump() gives the same results
+        '''
+        store = self.columnar_data.columnar
+        descriptor, file_path = mkstemp()
+        with open(descriptor, 'wb') as file:
+            layout = store.dump(file)
+
+        mapped = DataIngestor(None, store=ColumnarStore.map(file_path, layout, store.tables))
+        for endpoint in ('states_mean', 'best5', 'global_mean', 'mean_by_category'):
+            self.assertEqual(run_job(op.plan_query(endpoint, QUESTION2, None, mapped)),
+            run_job(op.plan_query(endpoint, QUESTION2, None, self.columnar_data)))
+        self.assertEqual(mapped.aggregates, self.columnar_data.aggregates)
+
+        del mapped
+        remove(file_path)
+
+    def test_generated_dataset(self):
+        '''
+        test that both modes give exactly the same results on a generated dataset with many
+        stratifications for every state, so the partials are merged in the same order
+        '''
+        descriptor, csv_path = mkstemp(suffix='.csv')
+        close(descriptor)
+        write_csv(csv_path, 5000)
+        dict_data = DataIngestor(csv_path)
+        columnar_data = DataIngestor(csv_path, columnar=True)
+        remove(csv_path)
+
+        self.assertEqual(columnar_data.aggregates, dict_data.aggregates)
+        for question in QUESTIONS:
+            for endpoint in op.ENDPOINTS:
+                states = STATES[:3] if endpoint in op.STATE_ENDPOINTS else [None]
+                for state in states:
+                    self.assertEqual(
+                        run_job(op.plan_query(endpoint, question, state, columnar_data)),
+                        run_job(op.plan_query(endpoint, question, state, dict_data)))
+
+class TestAggregateIndex(unittest.TestCase):
+    '''
+    test the mean operations over the aggregate index
+    '''
+    def setUp(self):
+        '''
+        setup the test
+        '''
+        self.sample_data = DataIngestor('unittests/sample.csv')
+        self.columnar_data = DataIngestor('unittests/sample.csv', columnar=True)
+
+    def test_index(self):
+        '''
+        test the partial aggregates kept in the index
+        '''
+        for ingestor in (self.sample_data, self.columnar_data):
+            self.assertEqual(ingestor.aggregates['Alaska'][QUESTION1]["('Total', 'Total')"],
+            op.Partial(66.8, 2, 33.3, 33.5))
+            self.assertEqual(list(ingestor.aggregates), list(self.sample_data.state_data))
+
+    def test_merge_order(self):
+        '''
+        test that the means merged from the partial aggregates match the means of the lists
+        of values, summed one value after the other like before the index, to about 1e-12:
+        the partial sums are added in another order, so the last bits can differ
+        '''
+        descriptor, csv_path = mkstemp(suffix='.csv')
+        close(descriptor)
+        write_csv(csv_path, 5000)
+        ingestor = DataIngestor(csv_path)
+        remove(csv_path)
+
+        for question in QUESTIONS:
+            values = {state: [value for group in questions[question].values() for value in group]
+                      for state, questions in ingestor.state_data.items() if question in questions}
+            all_values = [value for state_values in values.values() for value in state_values]
+            data, global_data = op.get_aggregates_for_question(question, ingestor.aggregates,
+            True, True)
+
+            self.assertEqual(list(data), list(values))
+            for state, state_values in values.items():
+                self.assertAlmostEqual(op.mean(data[state]), sum(state_values) / len(state_values),
+                                       delta=1e-12 * abs(op.mean(data[state])))
+            self.assertAlmostEqual(op.mean(global_data['global_mean']),
+                                   sum(all_values) / len(all_values),
+                                   delta=1e-12 * abs(op.mean(global_data['global_mean'])))
+
+    def test_states_mean(self):
+        '''
+        test the states mean
+        '''
+        data, _ = op.get_aggregates_for_question(QUESTION1, self.sample_data.aggregates)
+        result = op.states_means()(data)
+        self.assertEqual(result, {'Alabama': 30.0, 'Alaska': 33.4})
+
+    def test_best5_worst5(self):
+        '''
+        test the best 5 and worst 5
+        '''
+        data, _ = op.get_aggregates_for_question(QUESTION2, self.columnar_data.aggregates)
+        self.assertEqual(op.best5()(data), {'Oregon': 20.6, 'Texas': 20.8, 'Ohio': 29.9,
+        'Alabama': 35.6, 'Indiana': 45.6})
+        self.assertEqual(op.worst5()(data), {'Idaho': 55.6, 'Indiana': 45.6, 'Alabama': 35.6,
+        'Ohio': 29.9, 'Texas': 20.8})
+
+    def test_global_mean(self):
+        '''
+        test the global mean
+        '''
+        _, data = op.get_aggregates_for_question(QUESTION2, self.sample_data.aggregates,
+        True, False)
+        self.assertEqual(op.global_mean()(data), {'global_mean': 34.68333333333333})
+
+    def test_state_diff_from_mean(self):
+        '''
+        test the state diff from mean
+        '''
+        data = op.get_aggregates_for_state(QUESTION1, 'Alabama', self.sample_data.aggregates)
+        _, global_data = op.get_aggregates_for_question(QUESTION1, self.sample_data.aggregates,
+        True, False)
+        result = op.diff_from_mean()(data, op.global_mean()(global_data))
+        self.assertEqual(result, {'Alabama': 1.6999999999999993})
+        self.assertEqual(op.get_aggregates_for_state(QUESTION2, 'Alaska',
+        self.sample_data.aggregates), {"status": "Invalid question"})
+
+    def test_top_k(self):
+        '''
+        test the top k states with the orders and the grouping levels
+        '''
+        job = op.plan_query('top_k', QUESTION2, None, self.sample_data, params=(3, 'best',
+        'state'))
+        self.assertEqual(run_job(job), {'Oregon': 20.6, 'Texas': 20.8, 'Ohio': 29.9})
+        job = op.plan_query('top_k', QUESTION2, None, self.sample_data, params=(2, 'highest',
+        'state'))
+        self.assertEqual(run_job(job), {'Idaho': 55.6, 'Indiana': 45.6})
+        self.assertEqual(run_job(op.plan_query('top_k', QUESTION2, None, self.sample_data)),
+        run_job(op.plan_query('best5', QUESTION2, None, self.sample_data)))
+
+        job = op.plan_query('top_k', QUESTION1, None, self.columnar_data, params=(1, 'worst',
+        'stratification'))
+        self.assertEqual(run_job(job), {"('Total', 'Total')": {'Alaska': 33.4}})
+
+        self.assertEqual(op.validate_top_k(0, 'best', 'state'), {"status": "Invalid k"})
+        self.assertEqual(op.validate_top_k(3, 'median', 'state'), {"status": "Invalid order"})
+        self.assertIsNone(op.validate_top_k(3, 'lowest', 'stratification'))
+
+    def test_category_index(self):
+        '''
+        test that the stratification index gives the same results as the categories in
+        state_data
+        '''
+        for ingestor in (self.sample_data, self.columnar_data):
+            data = op.get_categories_for_question(QUESTION1, ingestor.category_index)
+            self.assertEqual(op.category_means()(data), {"('Alabama', 'Total', 'Total')": 30.0,
+            "('Alaska', 'Total', 'Total')": 33.4})
+
+            data = op.get_categories_for_state(QUESTION1, 'Alabama', ingestor.category_index,
+            ingestor.aggregates)
+            self.assertEqual(op.state_mean_by_category()(data),
+            {'Alabama': {"('Total', 'Total')": 30.0}})
+            self.assertEqual(op.get_categories_for_state(QUESTION1, 'Utah',
+            ingestor.category_index, ingestor.aggregates), {"status": "Invalid state"})
+
+class TestParallelIngest(unittest.TestCase):
+    '''
+    test the ingestion of the csv file by worker processes
+    '''
+    def test_split_chunks(self):
+        '''
+        test that the chunks cover the rows without cutting them
+        '''
+        data = b'header\nrow 1\nrow number 2\nrow 3\n'
+        chunks = split_chunks(data, 7, 3)
+        self.assertEqual([data[begin:end] for begin, end in chunks],
+        [b'row 1\nrow number 2\n', b'row 3\n'])
+
+    def test_same_state_data(self):
+        '''
+        test that the workers build the same state_data, in the same order
+        '''
+        sample_data = DataIngestor('unittests/sample.csv')
+        parallel_data = DataIngestor('unittests/sample.csv', num_workers=2)
+        self.assertEqual(parallel_data.state_data, sample_data.state_data)
+        self.assertEqual(list(parallel_data.state_data), list(sample_data.state_data))
+        self.assertEqual(parallel_data.aggregates, sample_data.aggregates)
+        self.assertEqual(parallel_data.ingest_stats['workers'], 2)
+
+    def test_worker_error(self):
+        '''
+        test that an error in a worker stops the ingestion
+        '''
+        descriptor, csv_path = mkstemp(suffix='.csv')
+        with open(descriptor, 'w', encoding='utf-8') as file, \
+             open('unittests/sample.csv', 'r', encoding='utf-8') as sample:
+            file.write(sample.read().replace('20.6', 'n/a'))
+        try:
+            with self.assertRaises(ValueError):
+                DataIngestor(csv_path, num_workers=2)
+        finally:
+            remove(csv_path)
+
+    def test_server_start(self):
+        '''
+        test that a new server reads the data with the workers while the app package is
+        imported for the first time, before it starts its threads even with DI_BACKGROUND
+        '''
+        env = dict(environ, DI_WORKERS='2', DI_BACKGROUND='1', DI_CSV=SAMPLE_CSV,
+                   PYTHONPATH=getcwd())
+        del env['NO_SERVER']
+        server = run([sys.executable, '-c', "import app; app.webserver.tasks_runner.shutdown(); "
+                      "print(app.webserver.data_ingestor.ingest_stats['workers'])"],
+                     cwd=mkdtemp(), env=env, capture_output=True, timeout=60, check=True)
+        self.assertEqual(server.stdout, b'2\n')
+
+    def test_progress(self):
+        '''
+        test that all the rows and bytes are counted in the progress
+        '''
+        for num_workers in (1, 2):
+            progress = {}
+            DataIngestor('unittests/sample.csv', num_workers=num_workers, progress=progress)
+            self.assertEqual(progress['rows'], 10)
+            self.assertEqual(progress['bytes'], progress['total_bytes'])
+
+class TestSnapshot(unittest.TestCase):
+    '''
+    test the binary snapshot of the parsed data
+    '''
+    def setUp(self):
+        '''
+        copies the sample csv file, so it can be changed, and picks a snapshot path
+        '''
+        descriptor, self.csv_path = mkstemp(suffix='.csv')
+        with open(descriptor, 'w', encoding='utf-8') as file, \
+             open('unittests/sample.csv', 'r', encoding='utf-8') as sample:
+            file.write(sample.read())
+        self.snapshot_path = self.csv_path + '.snapshot'
+
+    def tearDown(self):
+        '''
+        removes the files
+        '''
+        remove(self.csv_path)
+        remove(self.snapshot_path)
+
+    def test_snapshot(self):
+        '''
+        test that the snapshot is written on the first load and gives the same data later
+        '''
+        first = DataIngestor(self.csv_path, snapshot=self.snapshot_path)
+        second = DataIngestor(self.csv_path, snapshot=self.snapshot_path)
+        self.assertEqual(first.ingest_stats['snapshot'], 'written')
+        self.assertEqual(second.ingest_stats['snapshot'], 'loaded')
+        self.assertEqual(second.state_data, first.state_data)
+        self.assertEqual(second.aggregates, first.aggregates)
+        self.assertEqual(second.row_counts, first.row_counts)
+
+    def test_columnar_snapshot(self):
+        '''
+        test that the columns of the columnar store are mapped from the snapshot
+        '''
+        first = DataIngestor(self.csv_path, columnar=True, snapshot=self.snapshot_path)
+        second = DataIngestor(self.csv_path, columnar=True, snapshot=self.snapshot_path)
+        self.assertEqual(second.ingest_stats['snapshot'], 'loaded')
+        self.assertEqual(list(second.columnar.values), list(first.columnar.values))
+        self.assertEqual(second.aggregates, first.aggregates)
+
+    def test_stale_snapshot(self):
+        '''
+        test that the snapshot is not used after the csv file changes or in another mode
+        '''
+        DataIngestor(self.csv_path, snapshot=self.snapshot_path)
+        self.assertEqual(DataIngestor(self.csv_path, columnar=True,
+        snapshot=self.snapshot_path).ingest_stats['snapshot'], 'written')
+
+        with open(self.csv_path, 'a', encoding='utf-8') as file:
+            file.write(f"\n10,Alaska,{QUESTION2},40.0,Total,Total\n")
+        data = DataIngestor(self.csv_path, snapshot=self.snapshot_path)
+        self.assertEqual(data.ingest_stats['snapshot'], 'written')
+        self.assertEqual(data.state_data['Alaska'][QUESTION2]["('Total', 'Total')"][-1], 40.0)
+
+class TestIncrementalIngest(unittest.TestCase):
+    '''
+    test adding rows to the data without reading the csv file again
+    '''
+    def setUp(self):
+        '''
+        setup the test
+        '''
+        self.sample_data = DataIngestor('unittests/sample.csv')
+        self.rows = [('Alaska', QUESTION2, '40.0', 'Total', 'Total'),
+                     ('Utah', QUESTION1, '25.5', 'Gender', 'Male'),
+                     ('Alaska', QUESTION2, '42.0', 'Total', 'Total')]
+
+    def test_with_rows(self):
+        '''
+        test that the new version has the same data as reading all the rows from the start
+        and that the old version is not changed
+        '''
+        descriptor, csv_path = mkstemp(suffix='.csv')
+        with open(descriptor, 'w', encoding='utf-8') as file, \
+             open('unittests/sample.csv', 'r', encoding='utf-8') as sample:
+            file.write(sample.read() + '\n')
+            for row in self.rows:
+                file.write(f"0,{','.join(row)}\n")
+        all_data = DataIngestor(csv_path)
+        remove(csv_path)
+
+        old_aggregates = self.sample_data.aggregates['Alaska']
+        new_data = self.sample_data.with_rows(self.rows)
+        self.assertEqual(new_data.version, 1)
+        self.assertEqual(new_data.state_data, all_data.state_data)
+        self.assertEqual(new_data.aggregates, all_data.aggregates)
+        self.assertEqual(new_data.row_counts, all_data.row_counts)
+        self.assertEqual(new_data.category_index, all_data.category_index)
+
+        self.assertEqual(DataIngestor('unittests/sample.csv').state_data,
+        self.sample_data.state_data)
+        self.assertIs(self.sample_data.aggregates['Alaska'], old_aggregates)
+        self.assertNotIn(QUESTION2, old_aggregates)
+        self.assertNotIn('Utah', self.sample_data.state_data)
+
+    def test_partial_updated(self):
+        '''
+        test that the partial aggregate updated with the new values has the same total as the
+        one computed from the whole list of values, to the last bit
+        '''
+        values = ['0.1', '0.7', '1e-17', '0.2', '123456.789']
+        new_data = self.sample_data.with_rows(
+            [('Alabama', QUESTION1, value, 'Total', 'Total') for value in values])
+        key = "('Total', 'Total')"
+        self.assertEqual(new_data.aggregates['Alabama'][QUESTION1][key],
+        op.aggregate(new_data.state_data['Alabama'][QUESTION1][key]))
+
+    def test_invalid_rows(self):
+        '''
+        test that no row is added when one of them is invalid
+        '''
+        with self.assertRaises(ValueError):
+            self.sample_data.with_rows(self.rows + [('Utah', QUESTION1, '', 'Total', 'Total')])
+
+    def test_ingest_invalidates_cache(self):
+        '''
+        test that the pool swaps the data and drops the cached results of the question
+        '''
+        pool = ThreadPool(self.sample_data)
+        pool.cache.results[('global_mean', QUESTION2, None)] = {'global_mean': 34.68333333333333}
+        pool.cache.results[('global_mean', QUESTION1, None)] = {'global_mean': 31.7}
+        pool.ingest(self.rows[:1])
+
+        self.assertEqual(pool.data_ingestor.version, 1)
+        self.assertEqual(list(pool.cache.results), [('global_mean', QUESTION1, None)])
+
+class TestResultCache(unittest.TestCase):
+    '''
+    test the result cache and the deduplication of identical jobs
+    '''
+    def test_single_flight(self):
+        '''
+        test that identical jobs attach to the in flight job and get its result
+        '''
+        cache = ResultCache(2)
+        leader = {'job_id': 1, 'key': ('best5', QUESTION1, None)}
+        follower = {'job_id': 2, 'key': ('best5', QUESTION1, None)}
+
+        self.assertEqual(cache.claim(leader), ('submit', None))
+        self.assertEqual(cache.claim(follower), ('attached', leader))
+        self.assertEqual(cache.complete(leader, {'Alabama': 30.0}), [2])
+
+        self.assertEqual(cache.claim({'job_id': 3, 'key': ('best5', QUESTION1, None)}),
+        ('cached', {'Alabama': 30.0}))
+
+    def test_lru_eviction(self):
+        '''
+        test that the least recently used result is evicted
+        '''
+        cache = ResultCache(2)
+        jobs = [{'job_id': i, 'key': ('states_mean', question, None)}
+                for i, question in enumerate(('q1', 'q2', 'q3'))]
+
+        for job in jobs[:2]:
+            cache.claim(job)
+            cache.complete(job, job['job_id'])
+
+        # use q1 so that q2 becomes the least recently used
+        self.assertEqual(cache.claim({'job_id': 4, 'key': jobs[0]['key']}), ('cached', 0))
+        cache.claim(jobs[2])
+        cache.complete(jobs[2], 2)
+
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.claim({'job_id': 5, 'key': jobs[1]['key']})[0], 'submit')
+
+    def test_invalidate(self):
+        '''
+        test that invalidated and stale results are not served
+        '''
+        cache = ResultCache()
+        job = {'job_id': 1, 'key': ('global_mean', QUESTION1, None)}
+        cache.claim(job)
+        cache.complete(job, {'global_mean': 31.7})
+
+        stale = {'job_id': 2, 'key': ('global_mean', QUESTION2, None)}
+        cache.claim(stale)
+        cache.invalidate(QUESTION1)
+
+        self.assertEqual(cache.claim({'job_id': 3, 'key': job['key']})[0], 'submit')
+        # the result of a job submitted before the invalidation is not cached
+        cache.complete(stale, {'global_mean': 34.6})
+        self.assertEqual(cache.claim({'job_id': 4, 'key': stale['key']})[0], 'submit')
+
+class TestJobTable(unittest.TestCase):
+    '''
+    test the in memory job table
+    '''
+    def test_states(self):
+        '''
+        test the transitions of the jobs and the counters
+        '''
+        jobs = JobTable()
+        for job_id in range(1, 4):
+            jobs.add(job_id)
+        jobs.start(1)
+        jobs.start(2)
+        jobs.finish(1, b'{"data":{"global_mean":31.7},"status":"done"}\n')
+        jobs.fail(2, 'division by zero')
+
+        self.assertEqual(jobs.get(1), (DONE, b'{"data":{"global_mean":31.7},"status":"done"}\n'))
+        self.assertEqual(jobs.get(2), (FAILED, 'division by zero'))
+        self.assertEqual(jobs.get(3), (QUEUED, None))
+        self.assertEqual(jobs.get(4), (None, None))
+        self.assertEqual(jobs.num_pending(), 1)
+
+    def test_page(self):
+        '''
+        test getting a page of the jobs
+        '''
+        jobs = JobTable()
+        for job_id in range(1, 11):
+            jobs.add(job_id)
+        jobs.start(5)
+
+        self.assertEqual(len(jobs.page()), 10)
+        self.assertEqual(jobs.page(4, 3), [(4, QUEUED), (5, RUNNING), (6, QUEUED)])
+        self.assertEqual(jobs.page(10, 5), [(10, QUEUED)])
+
+    def test_wait(self):
+        '''
+        test waiting for a job to finish
+        '''
+        jobs = JobTable()
+        jobs.add(1)
+        jobs.add(2)
+
+        # the job finishes while the client waits
+        timer = Timer(0.05, jobs.finish, (1, b'{"data":{"Alabama":30.0},"status":"done"}\n'))
+        timer.start()
+        self.assertEqual(jobs.wait(1, 5), (DONE, b'{"data":{"Alabama":30.0},"status":"done"}\n'))
+        timer.join()
+
+        # the timeout expires before the job finishes
+        self.assertEqual(jobs.wait(2, 0.01), (QUEUED, None))
+        self.assertEqual(jobs.wait(3, 0.01), (None, None))
+
+    def test_max_body_bytes(self):
+        '''
+        test that the oldest finished jobs are evicted while the bodies are too big and that
+        a body shared by many jobs is counted once
+        '''
+        body = b'{"data":{"Ohio":29.9},"status":"done"}\n'
+        jobs = JobTable(max_body_bytes=2 * len(body))
+        for job_id in range(1, 6):
+            jobs.add(job_id)
+        for job_id in (1, 2, 3):
+            jobs.finish(job_id, body)
+        self.assertEqual(jobs.stats(), ({QUEUED: 2, RUNNING: 0, DONE: 3, FAILED: 0},
+                                        len(body), 0))
+
+        # equal bodies that are different objects are counted separately
+        jobs.finish(4, body[:-1] + b'\n')
+        jobs.finish(5, body[:-1] + b'\n')
+        self.assertEqual([job_id for job_id, _ in jobs.page()], [4, 5])
+        self.assertEqual(jobs.stats(), ({QUEUED: 0, RUNNING: 0, DONE: 2, FAILED: 0},
+                                        2 * len(body), 3))
+
+    def test_max_finished(self):
+        '''
+        test that only the last finished jobs are kept, the pending ones are never evicted
+        '''
+        jobs = JobTable(max_finished=2)
+        for job_id in range(1, 6):
+            jobs.add(job_id)
+        jobs.finish(2, b'{"data":{},"status":"done"}\n')
+        jobs.fail(1, 'division by zero')
+        jobs.finish(4, b'{"data":{"Ohio":29.9},"status":"done"}\n')
+
+        self.assertEqual(jobs.get(2), (None, None))
+        self.assertEqual(jobs.get(1), (FAILED, 'division by zero'))
+        self.assertEqual(jobs.page(), [(1, FAILED), (3, QUEUED), (4, DONE), (5, QUEUED)])
+        self.assertEqual(jobs.stats(), ({QUEUED: 2, RUNNING: 0, DONE: 1, FAILED: 1},
+                                        len(b'{"data":{"Ohio":29.9},"status":"done"}\n'), 1))
+
+        # the evicted job_ids before the oldest job are skipped by the pages
+        jobs.fail(3, 'division by zero')
+        jobs.finish(5, b'{"data":{},"status":"done"}\n')
+        self.assertEqual(jobs.first_job_id, 3)
+        self.assertEqual(jobs.page(1, 2), [(3, FAILED)])
+        self.assertEqual(jobs.page(1), [(3, FAILED), (5, DONE)])
+
+class TestJobExecution(unittest.TestCase):
+    '''
+    test the cost estimate and the execution of the jobs used by the synchronous mode
+    '''
+    def setUp(self):
+        '''
+        setup the test
+        '''
+        self.sample_data = DataIngestor('unittests/sample.csv')
+
+    def test_job_cost(self):
+        '''
+        test that the cost counts the values and the partial aggregates read by the job
+        '''
+        self.assertEqual(job_cost({'data': {'Ohio': [29.9, 30.1], 'Utah': [28.4]},
+                                   'global_data': {'global_mean': [29.9, 30.1, 28.4]}}), 6)
+
+        data, _ = op.get_aggregates_for_question(QUESTION2, self.sample_data.aggregates)
+        self.assertEqual(job_cost({'data': data}), 6)
+
+    def test_run_job(self):
+        '''
+        test that running a job gives the same result as the operation
+        '''
+        data, global_data = op.get_aggregates_for_question(QUESTION1,
+        self.sample_data.aggregates, True, True)
+        job = {'operation': op.diff_from_mean(), 'data': data,
+               'global_operation': op.global_mean(), 'global_data': global_data}
+        self.assertEqual(run_job(job), {'Alabama': 1.6999999999999993,
+        'Alaska': -1.6999999999999993})
+
+    def test_run_job_by_key(self):
+        '''
+        test that a job that carries only its key gets the same result as the one
+        with the extracted data
+        '''
+        job = {'key': ('diff_from_mean', QUESTION1, None)}
+        self.assertEqual(run_job(job, self.sample_data), {'Alabama': 1.6999999999999993,
+        'Alaska': -1.6999999999999993})
+
+        job = {'key': ('best5', QUESTION2, None)}
+        self.assertEqual(run_job(job, self.sample_data), {'Oregon': 20.6, 'Texas': 20.8,
+        'Ohio': 29.9, 'Alabama': 35.6, 'Indiana': 45.6})
+
+    def test_validate_and_estimate(self):
+        '''
+        test checking a query and estimating its cost without extracting its data
+        '''
+        self.assertIsNone(op.validate_query('state_mean', QUESTION1, 'Alabama',
+        self.sample_data))
+        self.assertEqual(op.validate_query('state_mean', QUESTION1, 'Ohio', self.sample_data),
+        {"status": "Invalid question"})
+        self.assertEqual(op.validate_query('median', QUESTION1, None, self.sample_data),
+        {"status": "Invalid endpoint"})
+
+        self.assertEqual(op.estimate_cost('mean_by_category', QUESTION2, None,
+        self.sample_data), 6)
+        self.assertEqual(op.estimate_cost('states_mean', QUESTION1, None, self.sample_data), 2)
+        self.assertEqual(op.estimate_cost('state_mean_by_category', QUESTION1, 'Alaska',
+        self.sample_data), 1)
+
+        # the categories endpoints are costed by their stratifications, not by their rows
+        mean_data = DataIngestor('unittests/sample.csv')
+        mean_data = mean_data.with_rows([('Alaska', QUESTION1, 33.7, 'Gender', 'Male')] * 4)
+        self.assertEqual(op.estimate_cost('state_mean_by_category', QUESTION1, 'Alaska',
+        mean_data), 2)
+        self.assertEqual(op.estimate_cost('mean_by_category', QUESTION1, None, mean_data), 3)
+
+class TestThreadPool(unittest.TestCase):
+    '''
+    test the ThreadPool without starting its TaskRunners
+    '''
+    def test_cached_body_shared(self):
+        '''
+        test that the jobs that get a result from the cache share its encoded response
+        '''
+        pool = ThreadPool()
+        key = ('global_mean', QUESTION1, None)
+        for job_id in (1, 2, 3):
+            job = {'job_id': job_id, 'key': key}
+            if pool.claim(job) == 'submit':
+                pool.complete(job, {'global_mean': 31.7})
+
+        _, body = pool.jobs.get(1)
+        self.assertIs(pool.jobs.get(2)[1], body)
+        self.assertIs(pool.jobs.get(3)[1], body)
+        self.assertEqual(pool.jobs.stats()[1], len(body))
+
+    def test_subscriber_full(self):
+        '''
+        test that the events are dropped while the queue of a subscriber is full
+        '''
+        pool = ThreadPool()
+        pool.subscriber_queue_size = 1
+        events = pool.subscribe()
+        for job_id in (1, 2):
+            pool.jobs.add(job_id)
+            pool.fail({'job_id': job_id}, 'division by zero')
+
+        self.assertEqual(events.get_nowait(), (1, FAILED, 'division by zero'))
+        self.assertTrue(events.empty())
+        self.assertEqual(pool.metrics.collect()['counters'],
+                         {('tp_stream_events_dropped_total', ()): 1})
+
+    def test_subscribe(self):
+        '''
+        test that the subscribers get the completions of the jobs
+        '''
+        pool = ThreadPool()
+        events = pool.subscribe()
+        pool.jobs.add(1)
+        pool.finish(1, {'global_mean': 31.7})
+        pool.jobs.add(2)
+        pool.fail({'job_id': 2}, 'division by zero')
+
+        self.assertEqual(events.get_nowait(),
+                         (1, DONE, b'{"data":{"global_mean":31.7},"status":"done"}\n'))
+        self.assertEqual(events.get_nowait(), (2, FAILED, 'division by zero'))
+
+        pool.unsubscribe(events)
+        pool.jobs.add(3)
+        pool.finish(3, {})
+        self.assertTrue(events.empty())
+
+    def test_job_timings(self):
+        '''
+        test the stages recorded for a computed job and for the identical job attached to it
+        '''
+        pool = ThreadPool(DataIngestor("./unittests/sample.csv"))
+        pool.submit({'job_id': 1, 'key': ('global_mean', QUESTION1, None),
+                     'received': monotonic()})
+        pool.submit({'job_id': 2, 'key': ('global_mean', QUESTION1, None)})
+        self.assertEqual(list(pool.jobs.timings(2)), ['submitted'])
+        pool.start()
+        pool.shutdown()
+
+        computed = pool.jobs.timings(1)
+        self.assertEqual(list(computed), ['received', 'submitted', 'dequeued', 'compute_start',
+                                          'compute_end', 'stored'])
+        self.assertEqual(computed['received'], 0)
+        self.assertEqual(list(computed.values()), sorted(computed.values()))
+        attached = pool.jobs.timings(2)
+        self.assertEqual(list(attached), ['submitted', 'dequeued', 'compute_start',
+                                          'compute_end', 'stored'])
+        self.assertIsNone(pool.jobs.timings(3))
+
+    def test_slow_job_report(self):
+        '''
+        test the stages shown in the slow job log
+        '''
+        report = slow_job_report({'received': 1.0, 'submitted': 1.001, 'dequeued': 1.5,
+                                  'compute_start': 1.5, 'compute_end': 3.25, 'stored': 3.25})
+        self.assertEqual(report, "route 0.001 s, queue 0.499 s, batch 0.000 s, "
+                                 "compute 1.750 s, store 0.000 s")
+
+    def test_encoded_result(self):
+        '''
+        test that the get_results response is encoded once when the job is done
+        '''
+        pool = ThreadPool()
+        pool.jobs.add(1)
+        self.assertEqual(pool.jobs.get(1), (QUEUED, None))
+        pool.finish(1, {'global_mean': 31.7})
+        self.assertEqual(pool.jobs.get(1),
+                         (DONE, b'{"data":{"global_mean":31.7},"status":"done"}\n'))
+
+    def test_queue_full(self):
+        '''
+        test that the jobs are rejected when the queue is full, except the cached ones
+        '''
+        environ['TP_MAX_QUEUE'] = '2'
+        try:
+            pool = ThreadPool()
+        finally:
+            del environ['TP_MAX_QUEUE']
+
+        pool.submit({'job_id': 1, 'cost': 5})
+        pool.submit({'job_id': 2, 'cost': 7})
+        with self.assertRaises(QueueFullError) as error:
+            pool.submit({'job_id': 3, 'cost': 1})
+        self.assertEqual(error.exception.retry_after, 1)
+        self.assertEqual(pool.jobs.get(3), (None, None))
+
+        result = {'global_mean': 31.7}
+        pool.cache.results[('global_mean', QUESTION1, None)] = (result, encode_response(result))
+        self.assertTrue(pool.submit({'job_id': 4, 'key': ('global_mean', QUESTION1, None)}))
+
+        self.assertEqual(pool.queue_stats(), {'depth': 2, 'max_depth': 2, 'queued_cost': 12,
+        'max_queued_cost': 0, 'rejected': 1, 'drain_rate': None})
+
+    def test_coalesce(self):
+        '''
+        test that the jobs taken together from the queue get the same results as the jobs
+        computed one by one
+        '''
+        environ['TP_COALESCE'] = '8'
+        try:
+            pool = ThreadPool(DataIngestor('unittests/sample.csv'))
+        finally:
+            del environ['TP_COALESCE']
+
+        keys = [('states_mean', QUESTION1, None), ('global_mean', QUESTION2, None),
+                ('diff_from_mean', QUESTION1, None), ('state_mean', QUESTION1, 'Alaska'),
+                ('mean_by_category', QUESTION2, None), ('best5', QUESTION1, None)]
+        for job_id, key in enumerate(keys, 1):
+            pool.submit({'job_id': job_id, 'key': key})
+
+        pool.start()
+        pool.shutdown()
+        for job_id, key in enumerate(keys, 1):
+            self.assertEqual(pool.jobs.get(job_id), (DONE, encode_response(
+            {'status': 'done', 'data': run_job({'key': key}, pool.data_ingestor)})))
+
+class TestScheduler(unittest.TestCase):
+    '''
+    test the job scheduler and the latency statistics
+    '''
+    def test_shortest_job_first(self):
+        '''
+        test that cheap jobs are given before an expensive one queued before them
+        '''
+        queue = JobScheduler(SJF, aging=0.001)
+        queue.put({'job_id': 1, 'cost': 100000})
+        queue.put({'job_id': 2, 'cost': 1})
+        queue.put({'job_id': 3, 'cost': 54})
+        self.assertEqual([queue.get()['job_id'] for _ in range(3)], [2, 3, 1])
+
+    def test_aging(self):
+        '''
+        test that an expensive job is not starved by the cheap jobs queued long after it
+        '''
+        queue = JobScheduler(SJF, aging=0)
+        queue.put({'job_id': 1, 'cost': 100000})
+        queue.put({'job_id': 2, 'cost': 1})
+        self.assertEqual(queue.get()['job_id'], 1)
+
+    def test_fifo(self):
+        '''
+        test the fifo policy
+        '''
+        queue = JobScheduler(FIFO)
+        for job_id, cost in ((1, 100000), (2, 1), (3, 54)):
+            queue.put({'job_id': job_id, 'cost': cost})
+        self.assertEqual([queue.get()['job_id'] for _ in range(3)], [1, 2, 3])
+
+    def test_latency_percentiles(self):
+        '''
+        test the percentiles of the latencies
+        '''
+        stats = LatencyStats(window=100)
+        for millis in range(1, 201):
+            stats.record('state_mean', millis / 1000)
+        self.assertEqual(stats.percentiles()['state_mean'], {'count': 100, 'p50': 0.15,
+        'p95': 0.195, 'p99': 0.199})
+
+class TestLogging(unittest.TestCase):
+    '''
+    class for testing the queue based logging
+    '''
+    def test_set_up_once(self):
+        '''
+        test that the handlers are added only once, whoever creates the logger
+        '''
+        current = getcwd()
+        chdir(mkdtemp())
+        try:
+            logger = CustomLogging().get_logger()
+            handlers = list(logger.handlers)
+            self.assertIs(get_logger(), logger)
+            self.assertEqual(CustomLogging().get_logger().handlers, handlers)
+            self.assertEqual(len(handlers), 1)
+        finally:
+            chdir(current)
+
+    def test_sample_filter(self):
+        '''
+        test that only the info messages are sampled
+        '''
+        sampler = SampleFilter(0)
+        info = LogRecord('app', INFO, __file__, 1, 'Get jobs request', None, None)
+        error = LogRecord('app', ERROR, __file__, 1, 'Job_id_1 failed', None, None)
+        self.assertFalse(sampler.filter(info))
+        self.assertTrue(sampler.filter(error))
+        self.assertTrue(SampleFilter(1).filter(info))
+
+class TestMetrics(unittest.TestCase):
+    '''
+    class for testing the metrics shards and their text format
+    '''
+    def test_ended_threads_retired(self):
+        '''
+        test that the shards of the ended threads are retired by the new threads, so only a
+        few of them are kept when the metrics are never collected
+        '''
+        metrics = Metrics()
+        threads = []
+        for _ in range(500):
+            thread = Thread(target=metrics.inc, args=('http_requests_total',))
+            thread.start()
+            thread.join()
+            threads.append(ref(thread))
+            self.assertLessEqual(len(metrics.shards), Metrics.RETIRE_STEP)
+
+        # the ended threads are not referenced by the metrics any more
+        del thread
+        self.assertLessEqual(sum(thread() is not None for thread in threads),
+                             Metrics.RETIRE_STEP)
+        self.assertEqual(metrics.collect()['counters'], {('http_requests_total', ()): 500})
+
+    def test_threads_merged(self):
+        '''
+        test that the shards of the threads, the ended ones too, are merged when collected
+        '''
+        metrics = Metrics()
+        def count():
+            for _ in range(1000):
+                metrics.inc('http_requests_total', (('endpoint', '/api/jobs'),))
+            metrics.observe('tp_job_run_seconds', (), 0.003)
+        threads = [Thread(target=count) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        count()
+
+        collected = metrics.collect()
+        self.assertEqual(len(metrics.shards), 1)
+        self.assertEqual(collected['counters'][('http_requests_total',
+                                                (('endpoint', '/api/jobs'),))], 5000)
+        histogram = collected['histograms'][('tp_job_run_seconds', ())]
+        self.assertEqual(sum(histogram[:-1]), 5)
+        self.assertAlmostEqual(histogram[-1], 0.015)
+
+    def test_render(self):
+        '''
+        test the prometheus text format of a counter, a histogram and a gauge
+        '''
+        metrics = Metrics()
+        metrics.inc('http_requests_total', (('endpoint', '/api/jobs'), ('status', 200)))
+        metrics.observe('tp_job_wait_seconds', (('endpoint', 'best5'),), 0.002)
+        text = render(metrics.collect(), [('tp_queue_depth', (), 3), ('tp_queue_cost', (), None)])
+
+        self.assertIn('# TYPE http_requests_total counter\n'
+                      'http_requests_total{endpoint="/api/jobs",status="200"} 1\n', text)
+        self.assertIn('tp_job_wait_seconds_bucket{endpoint="best5",le="0.001"} 0\n'
+                      'tp_job_wait_seconds_bucket{endpoint="best5",le="0.0025"} 1\n', text)
+        self.assertIn('tp_job_wait_seconds_bucket{endpoint="best5",le="+Inf"} 1\n'
+                      'tp_job_wait_seconds_sum{endpoint="best5"} 0.002\n'
+                      'tp_job_wait_seconds_count{endpoint="best5"} 1\n', text)
+        self.assertIn('# TYPE tp_queue_depth gauge\ntp_queue_depth 3\n', text)
+        self.assertNotIn('tp_queue_cost', text)
+
+    def test_pool_metrics(self):
+        '''
+        test the job and TaskRunner metrics of the thread pool
+        '''
+        environ['TP_NUM_OF_THREADS'] = '2'
+        try:
+            pool = ThreadPool(DataIngestor("./unittests/sample.csv"))
+        finally:
+            del environ['TP_NUM_OF_THREADS']
+        pool.start()
+        pool.submit({'job_id': 1, 'key': ('global_mean', QUESTION1, None)})
+        pool.submit({'job_id': 2, 'key': ('best5', QUESTION2, None)})
+        pool.shutdown()
+
+        collected = pool.metrics.collect()
+        for endpoint in ('global_mean', 'best5'):
+            labels = (('endpoint', endpoint),)
+            self.assertEqual(sum(collected['histograms'][('tp_job_run_seconds', labels)][:-1]), 1)
+            self.assertEqual(sum(collected['histograms'][('tp_job_wait_seconds', labels)][:-1]),
+                             1)
+
+        gauges = {(name, labels): value for name, labels, value in pool.gauges()}
+        self.assertEqual(gauges[('tp_jobs', (('state', 'done'),))], 2)
+        self.assertEqual(gauges[('tp_queue_depth', ())], 0)
+        self.assertEqual(sum(value for (name, _), value in gauges.items()
+                             if name == 'tp_runner_jobs_total'), 2)
+        self.assertGreater(gauges[('tp_result_bytes', ())], 0)
+
+class TestJSONCodec(unittest.TestCase):
+    '''
+    test that the json backends encode the responses the same way
+    '''
+    def test_non_ascii(self):
+        '''
+        test that the characters that are not ascii are written in utf-8 by both backends
+        and by jsonify
+        '''
+        obj = {'status': 'done', 'data': {'Puérto Rico': 30.5, 'Ohio': 29.9}}
+        expected = '{"data":{"Ohio":29.9,"Puérto Rico":30.5},"status":"done"}'.encode('utf-8')
+        self.assertEqual(json_codec.stdlib_dumps(obj), expected)
+        self.assertEqual(json_codec.dumps(obj), expected)
+
+        flask_app = Flask(__name__)
+        flask_app.json.ensure_ascii = json_codec.ENSURE_ASCII
+        providers = [flask_app.json]
+        if json_codec.orjson is not None:
+            providers.append(json_codec.FastJSONProvider(flask_app))
+        with flask_app.app_context():
+            for provider in providers:
+                self.assertEqual(provider.response(obj).get_data(), expected + b'\n')
+
+class TestProfiler(unittest.TestCase):
+    '''
+    class for testing the sampling profiler
+    '''
+    def test_sample_stacks(self):
+        '''
+        test that the stacks of a busy thread are sampled and collapsed
+        '''
+        stop = Event()
+        def spin():
+            while not stop.is_set():
+                pass
+        thread = Thread(target=spin)
+        thread.start()
+        try:
+            stacks = sample_stacks(0.1, 0.005, {thread.ident})
+        finally:
+            stop.set()
+            thread.join()
+
+        self.assertGreater(sum(stacks.values()), 5)
+        for stack in stacks:
+            self.assertTrue(stack[0].startswith('Thread._bootstrap ('))
+        # the thread is sampled in spin or in the Event.is_set() it calls
+        self.assertTrue(any(frame.startswith('TestProfiler.test_sample_stacks.<locals>.spin (')
+                            for stack in stacks for frame in stack[-2:]))
+
+        lines = collapse(stacks).splitlines()
+        self.assertEqual(len(lines), len(stacks))
+        frames, count = lines[0].rsplit(' ', 1)
+        self.assertEqual(stacks[tuple(frames.split(';'))], int(count))
+
+    def test_other_threads_left_out(self):
+        '''
+        test that only the given threads are sampled and never the calling one
+        '''
+        self.assertEqual(sample_stacks(0.02, 0.005, set()), {})
+        self.assertEqual(sample_stacks(0.02, 0.005, {get_ident()}), {})
+
+class TestRoutes(unittest.TestCase):
+    '''
+    class for testing the endpoints through the test client of the server
+    '''
+    def setUp(self):
+        self.webserver = start_server()
+        self.client = self.webserver.test_client()
+
+    def tearDown(self):
+        self.webserver.tasks_runner.shutdown()
+
+    def submit_concurrently(self, sync):
+        '''
+        8 clients submit 30 queries each at the same time, returns the (job_id, query)
+        pairs they got
+        '''
+        queries = [('states_mean', {'question': QUESTION1}),
+                   ('states_mean', {'question': QUESTION2}),
+                   ('state_mean', {'question': QUESTION2, 'state': 'Ohio'}),
+                   ('global_mean', {'question': QUESTION2})]
+        submitted = []
+
+        def client(index):
+            test_client = self.webserver.test_client()
+            for request_index in range(30):
+                endpoint, body = queries[(index + request_index) % len(queries)]
+                body = dict(body, sync=1) if sync else body
+                job_id = test_client.post(f'/api/{endpoint}', json=body).get_json()['job_id']
+                submitted.append((job_id, endpoint, body.get('question'), body.get('state')))
+
+        threads = [Thread(target=client, args=(index,)) for index in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return submitted
+
+    def check_concurrent(self, sync):
+        '''
+        every query gets its own job_id and the result of its own query
+        '''
+        submitted = self.submit_concurrently(sync)
+        self.assertEqual(len({job_id for job_id, *_ in submitted}), 240)
+
+        results = {}
+        for job_id, *query in submitted:
+            response = self.client.get(f'/api/get_results/{job_id}?wait=5').get_json()
+            self.assertEqual(response['status'], 'done')
+            self.assertEqual(results.setdefault(tuple(query), response['data']),
+                             response['data'])
+        self.assertEqual(len(results), 4)
+
+    def test_concurrent_job_ids(self):
+        '''
+        test the job_ids of queries submitted at the same time
+        '''
+        self.check_concurrent(sync=False)
+
+    def test_concurrent_job_ids_sync(self):
+        '''
+        test the job_ids of queries computed on the request threads at the same time
+        '''
+        self.check_concurrent(sync=True)
+
+    def fill_queue(self):
+        '''
+        puts a job in the queue without waking up the TaskRunners and limits the queue to one
+        job, so the next jobs are rejected; returns a function that empties it again
+        '''
+        pool = self.webserver.tasks_runner
+        pool.max_queue = 1
+        pool.job_queue.put({'job_id': 0, 'cost': 1})
+
+        def empty():
+            pool.max_queue = 0
+            pool.job_queue.get_nowait()
+            pool.job_queue.task_done()
+        return empty
+
+    def test_batch_rejected(self):
+        '''
+        test that a rejected batch gets a 429 with Retry-After and uses up no job_ids
+        '''
+        empty = self.fill_queue()
+        queries = [{'endpoint': 'states_mean', 'question': QUESTION1},
+                   {'endpoint': 'state_mean', 'question': QUESTION2, 'state': 'Ohio'}]
+        response = self.client.post('/api/batch', json={'queries': queries})
+        empty()
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response.headers['Retry-After'], '1')
+
+        response = self.client.post('/api/batch', json={'queries': queries})
+        self.assertEqual(response.get_json(), {'job_ids': [1, 2]})
+        self.assertEqual(self.client.get('/api/get_results/2?wait=5').get_json(),
+                         {'status': 'done', 'data': {'Ohio': 29.9}})
+
+    def test_batch_endpoints(self):
+        '''
+        test that every sub-query of a batch gets the same result as the request to its own
+        endpoint, with the result cache disabled so all of them are computed
+        '''
+        self.webserver.tasks_runner.shutdown()
+        self.webserver = start_server(TP_CACHE_SIZE='0')
+        self.client = self.webserver.test_client()
+
+        queries = []
+        for question in (QUESTION1, QUESTION2):
+            for endpoint in op.ENDPOINTS:
+                query = {'endpoint': endpoint, 'question': question}
+                if endpoint in op.STATE_ENDPOINTS:
+                    query['state'] = 'Alabama'
+                queries.append(query)
+            queries.append({'endpoint': 'top_k', 'question': question, 'k': 1,
+                            'order': 'highest', 'level': 'stratification'})
+
+        job_ids = self.client.post('/api/batch', json={'queries': queries}).get_json()
+        self.assertEqual(len(job_ids['job_ids']), len(queries))
+        for job_id, query in zip(job_ids['job_ids'], queries):
+            body = {key: value for key, value in query.items() if key != 'endpoint'}
+            single = self.client.post(f"/api/{query['endpoint']}", json=body).get_json()
+            expected = self.client.get(f"/api/get_results/{single['job_id']}?wait=5")
+            result = self.client.get(f'/api/get_results/{job_id}?wait=5')
+            self.assertEqual(result.get_json()['status'], 'done')
+            self.assertEqual(result.get_json(), expected.get_json(), query)
+
+    def test_sync_and_wait(self):
+        '''
+        test the result sent with a job computed on the request thread and the result of a
+        job waited for with ?wait
+        '''
+        expected = run_job({'key': ('global_mean', QUESTION2, None)},
+                           self.webserver.data_ingestor)
+        response = self.client.post('/api/global_mean?sync=1', json={'question': QUESTION2})
+        self.assertEqual(response.get_json(), {'job_id': 1, 'status': 'done', 'data': expected})
+
+        job_id = self.client.post('/api/global_mean', json={'question': QUESTION2}).get_json()
+        response = self.client.get(f"/api/get_results/{job_id['job_id']}?wait=5&timings=1")
+        self.assertEqual(response.get_json()['data'], expected)
+        self.assertIn('stored', response.get_json()['timings'])
+        self.assertEqual(self.client.get('/api/get_results/9?wait=0.01').get_json(),
+                         {'status': 'error', 'reason': 'Invalid job_id'})
+
+    def test_ingest(self):
+        '''
+        test that the ingested rows are added and that invalid rows are rejected with a 400
+        without adding any of the rows
+        '''
+        header = ',LocationDesc,Question,Data_Value,StratificationCategory1,Stratification1\n'
+        row = f'10,Ohio,{QUESTION1},31.5,Total,Total\n'
+        response = self.client.post('/api/ingest', data=header + row)
+        self.assertEqual(response.get_json(), {'status': 'done', 'rows': 1, 'version': 1,
+                                               'questions': [QUESTION1]})
+
+        for rows, reason in ((row + f'11,Ohio,{QUESTION1}\n', 'row 2 has missing fields'),
+                             (row.replace('31.5', 'n/a'), "could not convert string to float: "
+                                                          "'n/a'")):
+            response = self.client.post('/api/ingest', data=header + rows)
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(response.get_json(), {'status': 'error', 'reason': reason})
+
+        # no rows: an empty body or only the header
+        for body in ('', header):
+            response = self.client.post('/api/ingest', data=body)
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(response.get_json(), {'status': 'error',
+                                                   'reason': 'no rows to add'})
+
+        # a column we need is missing, with or without rows
+        short_header = header.replace(',Data_Value', '')
+        for rows in ('', f'10,Ohio,{QUESTION1},Total,Total\n'):
+            response = self.client.post('/api/ingest', data=short_header + rows)
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(response.get_json(), {'status': 'error',
+                                                   'reason': 'missing columns Data_Value'})
+        self.assertEqual(self.webserver.data_ingestor.version, 1)
+
+    def test_jobs_stream(self):
+        '''
+        test the events of the job stream for the given job_ids and the invalid job_ids
+        '''
+        self.client.post('/api/state_mean?sync=1', json={'question': QUESTION2, 'state': 'Ohio'})
+        self.client.post('/api/global_mean?sync=1', json={'question': QUESTION1})
+        response = self.client.get('/api/jobs/stream?job_ids=1,2&results=1')
+        self.assertEqual(response.mimetype, 'text/event-stream')
+        self.assertEqual(response.get_data(as_text=True),
+                         'event: done\ndata: {"data":{"Ohio":29.9},"status":"done","job_id":1}\n\n'
+                         'event: done\ndata: {"data":{"global_mean":31.7},"status":"done",'
+                         '"job_id":2}\n\n')
+
+        # job 3 was never submitted, the stream ends after its error event
+        response = self.client.get('/api/jobs/stream?job_ids=3,1')
+        self.assertEqual(response.get_data(as_text=True),
+                         'event: done\ndata: {"job_id":1,"status":"done"}\n\n'
+                         'event: error\ndata: {"job_id":3,"reason":"Invalid job_id",'
+                         '"status":"error"}\n\n')
+
+        response = self.client.get('/api/jobs/stream?job_ids=1,two')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.get_json(), {'status': 'error', 'reason': 'Invalid job_ids'})
+
+    def test_query_rejected(self):
+        '''
+        test that a query gets a 429 with Retry-After while the queue is full and uses up
+        no job_id
+        '''
+        empty = self.fill_queue()
+        response = self.client.post('/api/states_mean', json={'question': QUESTION1})
+        empty()
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response.headers['Retry-After'], '1')
+
+        response = self.client.post('/api/states_mean', json={'question': QUESTION1})
+        self.assertEqual(response.get_json(), {'job_id': 1})
+
+    def test_top_k(self):
+        '''
+        test the top_k endpoint with parameters, with the defaults and with an invalid k
+        '''
+        data_ingestor = self.webserver.data_ingestor
+        response = self.client.post('/api/top_k?sync=1', json={'question': QUESTION2, 'k': 2,
+                                                                'order': 'highest'})
+        self.assertEqual(response.get_json()['data'], run_job(op.plan_query(
+            'top_k', QUESTION2, None, data_ingestor, params=(2, 'highest', 'state'))))
+        self.assertEqual(set(response.get_json()['data']), {'Idaho', 'Indiana'})
+
+        response = self.client.post('/api/top_k?sync=1', json={'question': QUESTION2})
+        self.assertEqual(response.get_json()['data'], run_job(op.plan_query(
+            'top_k', QUESTION2, None, data_ingestor, params=op.TOP_K_DEFAULTS)))
+
+        response = self.client.post('/api/top_k', json={'question': QUESTION2, 'k': 0})
+        self.assertEqual(response.get_json(), {'status': 'Invalid k'})
+
+    def test_not_ready(self):
+        '''
+        test that the server answers 503 while the data is read in the background and shows
+        the error when reading it fails
+        '''
+        response = self.client.get('/api/ready')
+        self.assertEqual((response.status_code, response.get_json()['ready']), (200, True))
+
+        self.webserver.tasks_runner.shutdown()
+        self.webserver = start_server(DI_BACKGROUND='1',
+                                      DI_CSV=path.join(mkdtemp(), 'missing.csv'))
+        self.client = self.webserver.test_client()
+
+        response = self.client.post('/api/states_mean', json={'question': QUESTION1})
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.headers['Retry-After'], '1')
+
+        # wait for the background thread to give up
+        deadline = monotonic() + 5
+        while self.webserver.ingest_progress['error'] is None and monotonic() < deadline:
+            sleep(0.01)
+        response = self.client.get('/api/ready')
+        self.assertEqual(response.status_code, 503)
+        self.assertFalse(response.get_json()['ready'])
+        self.assertIn('missing.csv', response.get_json()['error'])